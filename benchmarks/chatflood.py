@@ -0,0 +1,370 @@
+"""
+replays chat traffic against the real Bot command handlers and a local hackmd stand-in.
+
+    PYTHONPATH=src python benchmarks/chatflood.py --prefill 10000 --commands 5000 --out results.json
+    PYTHONPATH=src python benchmarks/chatflood.py --trace benchmarks/traces/example.jsonl --compare results.json
+
+synthetic traces mix request/replace/search/upgrade/next/scam/position commands (see --mix),
+recorded traces are json lines {"t": seconds, "user": "...", "mod": false, "content": "?request 12"}.
+per command we report p50/p95/p99 latency, plus throughput, memory and hackmd calls, as json
+"""
+
+from collections import defaultdict
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from mock_hackmd import MockHackMD
+from requestnonsense.requestnonsense import Bot, RequestTuple
+
+DEFAULT_MIX = "request=40,replace=15,search=5,position=30,upgrade=3,next=4,scam=3"
+
+
+class FakeChatter:
+    def __init__(self, name: str, is_mod: bool = False):
+        self.name = name
+        self.is_mod = is_mod
+        self._ws = None
+
+
+class FakeChannel:
+    """collects what the bot says instead of sending it to twitch"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.sent = []
+
+    async def send(self, content: str):
+        self.sent.append(content)
+
+    def get_chatter(self, name: str):
+        return None
+
+
+class FakeMessage:
+    def __init__(self, channel: FakeChannel, author: FakeChatter, content: str):
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.echo = False
+        self.tags = {}
+
+
+def write_songlist(path: str, songs: int):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("Artist;Title;Arrangements\n")
+        for i in range(songs):
+            f.write(f"Artist {i % 300};Title {i};Lead, Bass\n")
+
+
+def synthetic_trace(
+    commands: int, users: int, songs: int, mix: str, seed: int
+) -> list[dict]:
+    rng = random.Random(seed)
+    kinds, weights = zip(
+        *(
+            (kind, float(weight))
+            for kind, weight in (part.split("=") for part in mix.split(","))
+        )
+    )
+    queued = []
+    events = []
+    for i in range(commands):
+        kind = rng.choices(kinds, weights)[0]
+        user = f"user{rng.randrange(users)}"
+        mod = False
+        if kind == "request":
+            content = f"?request {rng.randint(1, songs)}"
+            queued.append(user)
+        elif kind == "replace":
+            user = rng.choice(queued) if queued else user
+            content = f"?request {rng.randint(1, songs)}"
+        elif kind == "search":
+            song = rng.randrange(songs)
+            content = f"?request artist {song % 300} title {song}"
+            queued.append(user)
+        elif kind == "position":
+            user = rng.choice(queued) if queued and rng.random() < 0.8 else user
+            content = "?position"
+        elif kind == "upgrade":
+            target = rng.choice(queued) if queued else user
+            user, mod = "mod", True
+            content = f"?upgrade_request @{target}"
+        elif kind == "scam":
+            user, mod = "mod", True
+            content = f"?scam {rng.randrange(1, 20)}"
+        else:
+            user, mod = "mod", True
+            content = f"?{kind}"
+        events.append(
+            {"t": i, "user": user, "mod": mod, "content": content, "kind": kind}
+        )
+    return events
+
+
+def load_trace(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    start = events[0].get("t", 0.0) if events else 0.0
+    for i, event in enumerate(events):
+        event["t"] = event.get("t", i) - start
+    return events
+
+
+def percentiles(samples: list[float]) -> dict:
+    samples = sorted(samples)
+    cuts = (
+        statistics.quantiles(samples, n=100, method="inclusive")
+        if len(samples) > 1
+        else samples * 99
+    )
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": cuts[49] * 1000,
+        "p95_ms": cuts[94] * 1000,
+        "p99_ms": cuts[98] * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+def version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def prefill(bot: Bot, requests: int, songs: int):
+    queue = bot.queue
+    now = time.time()
+    for i in range(requests):
+        queue.append(
+            RequestTuple(True, True, now + i * 1e-6, i % songs + 1, f"queued{i}")
+        )
+    await queue.safe_queue()
+
+
+async def replay(
+    bot: Bot, events: list[dict], rate: float, speed: float, limiter: bool
+) -> dict:
+    channel = FakeChannel(bot.main_channel)
+    latencies = defaultdict(list)
+
+    async def handle(event: dict, scheduled: float):
+        author = FakeChatter(event["user"], event.get("mod", False))
+        message = FakeMessage(channel, author, event["content"])
+        if limiter:
+            await bot.event_message(message)
+        else:
+            await bot.invoke(await bot.get_context(message))
+        kind = event.get("kind") or event["content"].split(" ", 1)[0].lstrip("?!")
+        latencies[kind].append(time.perf_counter() - scheduled)
+
+    start = time.perf_counter()
+    if rate or speed:
+        # open loop: commands arrive on schedule no matter how far behind the bot is
+        tasks = []
+        for i, event in enumerate(events):
+            at = start + (i / rate if rate else event["t"] / speed)
+            if (delay := at - time.perf_counter()) > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(handle(event, at)))
+        await asyncio.gather(*tasks)
+    else:
+        for event in events:
+            await handle(event, time.perf_counter())
+    wall = time.perf_counter() - start
+    return {"wall": wall, "latencies": latencies, "replies": channel}
+
+
+async def run(args) -> dict:
+    mock = MockHackMD(latency=args.hackmd_latency)
+    endpoint = await mock.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "songs.csv")
+        write_songlist(csv_path, args.songs)
+        bot = Bot(
+            csv_path=csv_path,
+            hackmd_token="bench",
+            hackmd_tags="requestnonsense",
+            queue_path=os.path.join(tmp, "queue.bin"),
+            twitch_token="oauth:bench",
+            bot_prefix=["?"],
+            channel="bench",
+            cfsm=False,
+            usage_path=os.path.join(tmp, "usage.json"),
+            notes_path=os.path.join(tmp, "notes.json"),
+            monthly_budget=10**9,
+            publish_window=args.publish_window,
+            queue_storage=args.storage,
+            queue_max_rows=args.max_rows,
+        )
+        bot.hackmd.endpoint = endpoint
+        await bot.prepare()
+        await prefill(bot, args.prefill, args.songs)
+
+        if args.trace:
+            events = load_trace(args.trace)
+        else:
+            events = synthetic_trace(
+                args.commands, args.users, args.songs, args.mix, args.seed
+            )
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        result = await replay(bot, events, args.rate, args.speed, args.limiter)
+        peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+        tracemalloc.stop()
+
+        flush_start = time.perf_counter()
+        await bot.queue.publisher.flush()
+        flush = time.perf_counter() - flush_start
+        backlog = bot.chat_backlog
+        for sender in bot.senders.values():
+            if sender._task is not None:
+                sender._task.cancel()
+        startup = bot.timings
+        queue_length = bot.queue.len()
+        await bot.hackmd.close()
+        bot.queue.storage.close()
+    await mock.stop()
+
+    latencies = result["latencies"]
+    all_samples = [sample for samples in latencies.values() for sample in samples]
+    return {
+        "version": version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "params": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("out", "compare")
+        },
+        "events": len(events),
+        "queue_length": queue_length,
+        "wall_s": result["wall"],
+        "throughput_per_s": len(events) / result["wall"] if result["wall"] else None,
+        "commands": {
+            kind: percentiles(samples) for kind, samples in sorted(latencies.items())
+        },
+        "all": percentiles(all_samples) if all_samples else None,
+        "flush_s": flush,
+        "startup_s": startup,
+        "hackmd": {**mock.calls, "bytes": mock.bytes},
+        "chat": {"sent": len(result["replies"].sent), "backlog": backlog},
+        "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "tracemalloc_peak_kb": peak // 1024 if peak is not None else None,
+    }
+
+
+def compare(old: dict, new: dict):
+    print(f"{'':12} {'p95 alt':>10} {'p95 neu':>10} {'':>7}")
+    for kind, stats in new["commands"].items():
+        if kind not in old["commands"]:
+            continue
+        before, after = old["commands"][kind]["p95_ms"], stats["p95_ms"]
+        print(
+            f"{kind:12} {before:10.3f} {after:10.3f} {after / before if before else 0:7.2f}x"
+        )
+    print(
+        f"throughput   {old['throughput_per_s']:10.1f} {new['throughput_per_s']:10.1f}"
+    )
+    print(
+        f"hackmd       {sum(old['hackmd'].values()) - old['hackmd'].get('bytes', 0):10} "
+        f"{sum(new['hackmd'].values()) - new['hackmd'].get('bytes', 0):10}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--prefill",
+        type=int,
+        default=1000,
+        help="requests in the queue before the replay",
+    )
+    parser.add_argument(
+        "--commands", type=int, default=2000, help="length of a synthetic trace"
+    )
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--songs", type=int, default=5000)
+    parser.add_argument(
+        "--mix", default=DEFAULT_MIX, help="command weights of a synthetic trace"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--trace", help="replay a recorded trace (json lines) instead")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="commands per second, 0 replays back to back",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=0,
+        help="replay a recorded trace at its timing times this",
+    )
+    parser.add_argument(
+        "--limiter",
+        action="store_true",
+        help="go through the rate limiter like real chat",
+    )
+    parser.add_argument(
+        "--storage", default="binary", choices=["binary", "journal", "sqlite"]
+    )
+    parser.add_argument("--publish-window", type=float, default=0.05)
+    parser.add_argument("--max-rows", type=int, default=0)
+    parser.add_argument(
+        "--hackmd-latency",
+        type=float,
+        default=0.0,
+        help="seconds the mock waits per call",
+    )
+    parser.add_argument(
+        "--tracemalloc", action="store_true", help="measure peak python memory (slower)"
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the bot's log on stderr"
+    )
+    parser.add_argument("--out", help="write the results to this json file")
+    parser.add_argument("--compare", help="results json of an earlier run")
+    args = parser.parse_args()
+
+    # the bot logs every command with print, keep that out of the results
+    with contextlib.redirect_stdout(
+        sys.stderr if args.verbose else open(os.devnull, "w")
+    ):
+        results = asyncio.run(run(args))
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
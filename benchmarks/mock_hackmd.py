@@ -0,0 +1,76 @@
+"""
+local stand-in for the hackmd notes api, so benchmarks neither need a token nor eat the monthly quota.
+the tests use it as well (tests/conftest.py puts this directory on the path)
+"""
+
+from aiohttp import web
+from collections import Counter
+
+import asyncio
+
+
+class MockHackMD:
+    """
+    answers like hackmd does, counts calls and can add latency to every answer.
+    faults are consumed one per request, in order: "500", "429", "503" (answered with Retry-After: 0),
+    "slow" (answers 504 after a second, the client gives up long before) or "reset" (drops the connection)
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.faults = []
+        self.notes = {}
+        self.calls = Counter()
+        # (method, Authorization header) of every answered request
+        self.requests = []
+        self.bytes = 0
+        app = web.Application(client_max_size=64 * 1024**2)
+        app.router.add_post("/v1/notes/", self.create)
+        app.router.add_patch("/v1/notes/{note_id}", self.update)
+        self.runner = web.AppRunner(app)
+
+    async def start(self) -> str:
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        port = self.runner.addresses[0][1]
+        return f"http://127.0.0.1:{port}/v1/notes/"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def fault(self, request: web.Request) -> web.Response | None:
+        fault = self.faults.pop(0) if self.faults else None
+        if fault == "slow":
+            await asyncio.sleep(1)
+            return web.Response(status=504)
+        elif fault == "reset":
+            request.transport.close()
+            return web.Response(status=500)
+        elif fault is not None:
+            return web.Response(status=int(fault), headers={"Retry-After": "0"})
+
+    async def create(self, request: web.Request) -> web.Response:
+        if (response := await self.fault(request)) is not None:
+            return response
+        payload = await request.json()
+        await asyncio.sleep(self.latency)
+        self.calls["create"] += 1
+        self.requests.append(("POST", request.headers.get("Authorization")))
+        self.bytes += len(payload["content"])
+        note_id = f"note{len(self.notes)}"
+        self.notes[note_id] = payload["content"]
+        return web.json_response({"id": note_id})
+
+    async def update(self, request: web.Request) -> web.Response:
+        if (response := await self.fault(request)) is not None:
+            return response
+        payload = await request.json()
+        await asyncio.sleep(self.latency)
+        self.calls["update"] += 1
+        self.requests.append(("PATCH", request.headers.get("Authorization")))
+        self.bytes += len(payload["content"])
+        note_id = request.match_info["note_id"]
+        if note_id not in self.notes:
+            return web.Response(status=404)
+        self.notes[note_id] = payload["content"]
+        return web.Response(status=202)
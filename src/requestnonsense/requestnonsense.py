@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 """
 so, requests are NamedTuples.
-like so (waiting: bool, non_prio: bool, timestamp: float, song: str, requestee: str)
+like so (waiting: bool, non_prio: bool, timestamp: float, song_id: int, requestee: str)
 waiting is opposite of current, non_prio <-> prio
+song_id is the id from the songlist, the name is only looked up when rendering
 we put them in a glorified list. why?
-we can use .sort() and get it nicely ordered
+tuples sort nicely, so the queue is always ordered by (waiting, non_prio, timestamp).
+the "list" is an indexable skiplist plus a dict by user, so nothing has to scan or re-sort
 we put a class around it, so we can sneak sqlite in
 
 what else?
@@ -15,66 +17,671 @@ if you send another, you keep your place in the queue, song is changed though
 the list of available songs as well as the current queue are pushed to hackmd-notes
 """
 
+from aiohttp import web
 from twitchio.ext import commands
-from typing import NamedTuple
+from collections import Counter, defaultdict, deque
+from collections.abc import Mapping, Sequence
+from typing import Awaitable, BinaryIO, Callable, Iterable, Iterator, NamedTuple
 
+import aiohttp
+import array
+import asyncio
+import bisect
+import calendar
+import codecs
+import contextlib
 import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import html
+import itertools
+import json
+import math
+import mmap
 import pickle
 import random
-import requests
+import re
+import sqlite3
+import struct
+import sys
+import threading
 import time
 import tomllib
 import os
+import unicodedata
 
 
-class HackMDNote:
-    note_id: str
-    content: str
+def write_atomic(path: str, content: bytes):
+    """
+    write to a temp file, fsync, rename over the old one. readers never see half a file.
+    the temp file is per process and thread, several bots may write the same catalog at once
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, mode="wb") as fh:
+            fh.write(content)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+class Metrics:
+    """
+    counters, gauges and latency histograms, kept in plain dicts and rendered in the prometheus text format.
+    histograms have fixed buckets, so observing is one bisect and a few additions.
+    gauges can be callables, those are only evaluated when somebody looks
+    """
+
+    BUCKETS = (
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+    )
+
+    counters: dict[tuple[str, tuple], float]
+    gauges: dict[tuple[str, tuple], float | Callable[[], float]]
+    histograms: dict[tuple[str, tuple], list]
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float | Callable[[], float], **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if (histogram := self.histograms.get(key)) is None:
+            # bucket counts (the last one is +Inf), sum, count
+            histogram = self.histograms[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def total(self, name: str) -> float:
+        """counter over all labels, or the number of observations of a histogram"""
+        if any(key[0] == name for key in self.histograms):
+            return sum(h[2] for key, h in self.histograms.items() if key[0] == name)
+        return sum(value for key, value in self.counters.items() if key[0] == name)
+
+    def quantile(self, name: str, q: float) -> float | None:
+        """upper bound of the bucket the q-quantile falls in, over all labels"""
+        counts = [0] * (len(self.BUCKETS) + 1)
+        for key, histogram in self.histograms.items():
+            if key[0] == name:
+                counts = [a + b for a, b in zip(counts, histogram[0])]
+        if not (total := sum(counts)):
+            return None
+        seen = 0
+        for bound, count in zip(self.BUCKETS + (float("inf"),), counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+
+    @staticmethod
+    def labels(labels: tuple) -> str:
+        if not labels:
+            return ""
+        return (
+            "{"
+            + ",".join(
+                f"{key}={json.dumps(str(value), ensure_ascii=False)}"
+                for key, value in labels
+            )
+            + "}"
+        )
+
+    def render(self) -> str:
+        lines = []
+        for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+            typed = set()
+            for (name, labels), value in sorted(
+                series.items(), key=lambda item: item[0]
+            ):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} {kind}")
+                if callable(value):
+                    value = value()
+                lines.append(f"{name}{self.labels(labels)} {value}")
+        typed = set()
+        for (name, labels), (counts, total, count) in sorted(
+            self.histograms.items(), key=lambda item: item[0]
+        ):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket in zip(self.BUCKETS + ("+Inf",), counts):
+                cumulative += bucket
+                lines.append(
+                    f"{name}_bucket{self.labels(labels + (('le', bound),))} {cumulative}"
+                )
+            lines.append(f"{name}_sum{self.labels(labels)} {total}")
+            lines.append(f"{name}_count{self.labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+# one registry per process, everything that wants to be measured writes here
+metrics = Metrics()
+
+
+class ApiBudget:
+    """
+    hackmd free tier comes with a monthly api quota. we count every call in a small json file,
+    so restarts don't reset the counter, and tell the publisher how long to wait between updates.
+    the file is only rewritten every SAVE_INTERVAL seconds and on close, a crash loses at most that much
+    """
+
+    SAVE_INTERVAL = 60.0
+
+    path: str
+    monthly_limit: int
+    month: str
+    calls: int
+    _saved_at: float
+    _unsaved: bool
+
+    def __init__(self, path: str, monthly_limit: int = 1000):
+        self.path = path
+        self.monthly_limit = monthly_limit
+        self.month = self.current_month()
+        self.calls = 0
+        self._saved_at = time.monotonic()
+        self._unsaved = False
+        if os.path.exists(self.path):
+            with open(self.path) as fh:
+                stored = json.load(fh)
+            if stored.get("month") == self.month:
+                self.calls = stored.get("calls", 0)
+
+    @staticmethod
+    def current_month() -> str:
+        return time.strftime("%Y-%m", time.gmtime())
+
+    @staticmethod
+    def month_bounds() -> tuple[float, float]:
+        now = time.gmtime()
+        year, month = (
+            (now.tm_year + 1, 1) if now.tm_mon == 12 else (now.tm_year, now.tm_mon + 1)
+        )
+        return calendar.timegm((now.tm_year, now.tm_mon, 1, 0, 0, 0)), calendar.timegm(
+            (year, month, 1, 0, 0, 0)
+        )
+
+    @classmethod
+    def seconds_left_in_month(cls) -> float:
+        return cls.month_bounds()[1] - time.time()
+
+    def spend(self, calls: int = 1):
+        if (month := self.current_month()) != self.month:
+            self.month = month
+            self.calls = 0
+        self.calls += calls
+        self._unsaved = True
+        if time.monotonic() - self._saved_at >= self.SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        if not self._unsaved:
+            return
+        write_atomic(
+            self.path,
+            json.dumps({"month": self.month, "calls": self.calls}).encode("utf-8"),
+        )
+        self._saved_at = time.monotonic()
+        self._unsaved = False
+
+    @property
+    def remaining(self) -> int:
+        if self.current_month() != self.month:
+            return self.monthly_limit
+        return max(self.monthly_limit - self.calls, 0)
+
+    def pace(self) -> float:
+        """calls we'd still have if they were used evenly over the month"""
+        start, end = self.month_bounds()
+        return self.monthly_limit * (end - time.time()) / (end - start)
+
+    def min_interval(self) -> float:
+        """
+        nothing while we are within the month's pace. once we're behind,
+        spread the remaining calls evenly over the rest of the month
+        """
+        if (remaining := self.remaining) >= self.pace():
+            return 0.0
+        return self.seconds_left_in_month() / max(remaining, 1)
+
+
+class HackMDUnavailable(Exception):
+    """hackmd could not be reached, even after retrying, or the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    after `threshold` failed calls in a row we stop calling for `cooldown` seconds,
+    doubled every time it is still down, up to max_cooldown.
+    then a single call goes through as a probe, if it works everything is back to normal
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    state: str
+    failures: int
+    open_until: float
+
+    def __init__(
+        self,
+        threshold: int = 5,
+        cooldown: float = 10.0,
+        max_cooldown: float = 300.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN and self.clock() >= self.open_until:
+            self.state = self.HALF_OPEN
+            return True
+        return self.state == self.CLOSED
+
+    def success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+        elif self.failures < self.threshold:
+            return
+        if self.state != self.OPEN:
+            print(f"HackMD antwortet nicht, Pause für {self.cooldown:g}s")
+        self.state = self.OPEN
+        self.open_until = self.clock() + self.cooldown
+
+    def retry_in(self) -> float:
+        if self.state == self.CLOSED:
+            return 0.0
+        return max(self.open_until - self.clock(), 0.0)
+
+
+class HackMDClient:
+    """
+    one aiohttp session per bot, so all notes share a keep-alive connection pool.
+    the session is created lazily, aiohttp wants a running event loop for that.
+    timeouts, connection errors, 429 and 5xx are retried with exponential backoff and full jitter,
+    a circuit breaker stops us from hammering hackmd while it is down. notes that could not be
+    published wait in `buffered` (the note itself only keeps the latest content) and go out again
+    once hackmd answers
+    """
+
+    api_token: str
     endpoint: str
-    request_headers: dict
+    timeout: aiohttp.ClientTimeout
+    pool_size: int
+    budget: ApiBudget | None
+    retries: int
+    backoff: float
+    max_backoff: float
+    breaker: CircuitBreaker
+    buffered: set["HackMDNote"]
+    _session: aiohttp.ClientSession | None
+    _recovery: asyncio.Task | None
 
     def __init__(
         self,
-        initial_content: str,
         api_token: str,
         endpoint: str = "https://api.hackmd.io/v1/notes/",
+        timeout: float = 10.0,
+        pool_size: int = 4,
+        budget: ApiBudget | None = None,
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        breaker: CircuitBreaker | None = None,
     ):
-        self.content = initial_content
-        self.request_headers = {"Authorization": f"Bearer {api_token}"}
+        self.api_token = api_token
         self.endpoint = endpoint
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.pool_size = pool_size
+        self.budget = budget
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.buffered = set()
+        self._session = None
+        self._recovery = None
+        metrics.set(
+            "requestnonsense_hackmd_circuit_open",
+            lambda: int(self.breaker.state != CircuitBreaker.CLOSED),
+        )
+        metrics.set("requestnonsense_hackmd_buffered_notes", lambda: len(self.buffered))
 
-        payload = {
-            "content": initial_content,
-            "readPermission": "guest",
-            "writePermission": "owner",
-            "commentPermission": "disabled",
-        }
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_size, keepalive_timeout=60
+                ),
+                headers={"Authorization": f"Bearer {self.api_token}"},
+                timeout=self.timeout,
+            )
+        return self._session
+
+    def backoff_delay(self, attempt: int, retry_after: float | None = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.backoff * 2**attempt, self.max_backoff))
+
+    async def request(
+        self, call: str, method: str, url: str, payload: dict
+    ) -> tuple[int, dict | None]:
+        """
+        status and (for successful POSTs) the json answer. anything but 429 and 5xx counts as an answer,
+        raises HackMDUnavailable when retries are used up or the breaker is open
+        """
+        retry_after = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                metrics.inc("requestnonsense_hackmd_retries_total", call=call)
+                await asyncio.sleep(self.backoff_delay(attempt - 1, retry_after))
+                retry_after = None
+            if not self.breaker.allow():
+                raise HackMDUnavailable(f"Pause noch {self.breaker.retry_in():.0f}s")
+            if self.budget is not None:
+                self.budget.spend()
+            try:
+                with metrics.timer("requestnonsense_hackmd_seconds", call=call):
+                    async with self.session.request(
+                        method, url, json=payload
+                    ) as response:
+                        status = response.status
+                        metrics.inc(
+                            "requestnonsense_hackmd_calls_total",
+                            call=call,
+                            status=status,
+                        )
+                        if status == 429 or status >= 500:
+                            if (
+                                header := response.headers.get("Retry-After", "")
+                            ).isdigit():
+                                retry_after = float(header)
+                            error = f"HTTP {status}"
+                        else:
+                            data = (
+                                await response.json()
+                                if method == "POST" and status < 300
+                                else None
+                            )
+                            self.breaker.success()
+                            return status, data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+            except BaseException:
+                # cancelled, or an answer that is no json. a probe has to settle the breaker either way,
+                # half-open it would never let another call through
+                if self.breaker.state == CircuitBreaker.HALF_OPEN:
+                    self.breaker.failure()
+                raise
+            metrics.inc("requestnonsense_hackmd_errors_total", call=call)
+            print(f"HackMD: {call} fehlgeschlagen ({error})")
+            self.breaker.failure()
+        raise HackMDUnavailable(error)
+
+    async def create_note(self, payload: dict) -> str | None:
+        """id of the new note, None if hackmd refused it"""
+        status, data = await self.request("create", "POST", self.endpoint, payload)
+        if status >= 300:
+            print(f"HackMD: Note anlegen fehlgeschlagen ({status})")
+            return None
+        return data.get("id")
 
-        response = requests.post(
-            self.endpoint, headers=self.request_headers, json=payload
+    async def update_note(self, note_id: str, payload: dict) -> int:
+        """http status of the PATCH"""
+        status, _ = await self.request(
+            "update", "PATCH", f"{self.endpoint}{note_id}", payload
         )
-        self.id = response.json().get("id")
+        return status
 
-    def update(self, content: str) -> bool:
-        self.content = content
-        payload = {
+    def buffer(self, note: "HackMDNote"):
+        self.buffered.add(note)
+        if self._recovery is None or self._recovery.done():
+            self._recovery = asyncio.get_running_loop().create_task(self.recover())
+
+    async def recover(self):
+        while self.buffered:
+            await asyncio.sleep(max(self.breaker.retry_in(), self.max_backoff))
+            for note in list(self.buffered):
+                self.buffered.discard(note)
+                # the note keeps only the latest content, that is what goes out
+                if not await note.update(note.content) and note in self.buffered:
+                    break
+
+    async def close(self):
+        if self._recovery is not None:
+            self._recovery.cancel()
+        if self._session is not None:
+            await self._session.close()
+        if self.budget is not None:
+            self.budget.save()
+
+
+class NoteRegistry:
+    """
+    remembers note ids and the hash of their last published content in a json file.
+    after a restart we update the notes we already have, so bookmarked links keep working
+    """
+
+    path: str
+    notes: dict[str, dict]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.notes = {}
+        if os.path.exists(self.path):
+            with open(self.path) as fh:
+                self.notes = json.load(fh)
+
+    def get(self, name: str) -> tuple[str | None, str | None]:
+        entry = self.notes.get(name, {})
+        return entry.get("id"), entry.get("hash")
+
+    def set(self, name: str, note_id: str, content_hash: str):
+        self.notes[name] = {"id": note_id, "hash": content_hash}
+        write_atomic(self.path, json.dumps(self.notes, indent=2).encode())
+
+
+class HackMDNote:
+    """
+    a note is published with `await note.create()` and changed with `await note.update(...)`.
+    updates to one note are serialized, so an older PATCH can never land after a newer one.
+    content that hashes like the last published version is not sent again.
+    with a registry, the note id survives restarts
+    """
+
+    id: str | None
+    name: str | None
+    content: str
+    published_hash: str | None
+    client: HackMDClient
+    registry: NoteRegistry | None
+    _lock: asyncio.Lock
+
+    def __init__(
+        self,
+        initial_content: str,
+        client: HackMDClient,
+        name: str | None = None,
+        registry: NoteRegistry | None = None,
+    ):
+        self.id = None
+        self.name = name
+        self.published_hash = None
+        self.content = initial_content
+        self.client = client
+        self.registry = registry
+        if registry is not None and name is not None:
+            self.id, self.published_hash = registry.get(name)
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def payload(content: str) -> dict:
+        return {
             "content": content,
             "readPermission": "guest",
             "writePermission": "owner",
             "commentPermission": "disabled",
         }
 
-        response = requests.patch(
-            f"{self.endpoint}{self.id}", headers=self.request_headers, json=payload
-        )
+    @staticmethod
+    def content_hash(content: str) -> str:
+        return hashlib.sha1(content.encode()).hexdigest()
 
-        return response.status_code == 302
+    async def create(self) -> bool:
+        """make sure the note exists online with the current content"""
+        return await self.update(self.content)
+
+    async def update(self, content: str) -> bool:
+        self.content = content
+        async with self._lock:
+            if content is not self.content:
+                # a newer update came in while we were waiting, that one wins
+                return True
+            digest = self.content_hash(content)
+            try:
+                if self.id is not None:
+                    if digest == self.published_hash:
+                        return True
+                    status = await self.client.update_note(
+                        self.id, self.payload(content)
+                    )
+                    if 400 <= status and status != 404:
+                        return False
+                    if status < 400:
+                        self.published(digest)
+                        return True
+                    print(f"HackMD: Note {self.id} gibts nicht mehr, lege eine neue an")
+                note_id = await self.client.create_note(self.payload(content))
+            except HackMDUnavailable:
+                # keep the content, the client sends it once hackmd is back
+                self.client.buffer(self)
+                return False
+            if note_id is None:
+                return False
+            self.id = note_id
+            self.published(digest)
+            return True
+
+    def published(self, digest: str):
+        self.published_hash = digest
+        if self.registry is not None and self.name is not None:
+            self.registry.set(self.name, self.id, digest)
 
     @property
     def url(self):
         return f"https://hackmd.io/{self.id}"
 
 
+class NotePublisher:
+    """
+    collects changes for a note and sends them as one update per window.
+    the content is rendered when the window closes, so only the latest state goes out,
+    and nothing goes out at all if it hashes the same as the last published one (see HackMDNote)
+    """
+
+    note: HackMDNote
+    render: Callable[[], str]
+    window: float
+    budget: ApiBudget | None
+    _dirty: bool
+    _flushed_at: float
+    _task: asyncio.Task | None
+
+    def __init__(
+        self,
+        note: HackMDNote,
+        render: Callable[[], str],
+        window: float = 5.0,
+        budget: ApiBudget | None = None,
+    ):
+        self.note = note
+        self.render = render
+        self.window = window
+        self.budget = budget
+        self._dirty = False
+        self._flushed_at = -math.inf
+        self._task = None
+
+    def current_window(self) -> float:
+        """the configured window, wider only when the api budget runs behind its pace"""
+        if self.budget is None:
+            return self.window
+        return max(self.window, self.budget.min_interval())
+
+    def schedule(self):
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        # the first change after a quiet period goes out right away, the window only applies between flushes
+        while self._dirty:
+            if (
+                wait := self._flushed_at + self.current_window() - time.monotonic()
+            ) > 0:
+                await asyncio.sleep(wait)
+            await self.flush()
+
+    async def flush(self) -> bool:
+        # if this fails the note stays buffered in the client, no need to retry here
+        self._dirty = False
+        self._flushed_at = time.monotonic()
+        return await self.note.update(self.render())
+
+
 # request-tuples
 class RequestTuple(NamedTuple):
     """Requests are handled in tuples. Fields within requests can be accessed by name, too"""
@@ -82,256 +689,3108 @@ class RequestTuple(NamedTuple):
     waiting: bool
     non_prio: bool
     timestamp: float
-    song: str
+    song_id: int
     requestee: str
 
     def __str__(self):
-        return f"{self.song} requested von {self.requestee}"
+        return f"#{self.song_id} requested von {self.requestee}"
 
     def __repr__(self):
-        return f"<RequestTuple({self.waiting}, {self.non_prio}, {self.timestamp}, {self.song}, {self.requestee})>"
+        return (
+            f"<RequestTuple({self.waiting}, {self.non_prio}, {self.timestamp}, "
+            f"{self.song_id}, {self.requestee})>"
+        )
 
 
-class RequestQueue:
-    """wir machen jetzt alberne Tricks, um die Queue irgendwann in sqlite zu haben. yay"""
+class _End:
+    """sentinel behind the last skiplist node, bigger than every request"""
 
-    data: list[RequestTuple]
-    note: HackMDNote
-    hackmd_tags: str
-    queue_path: str
-    queue_title: str
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return False
+
+
+class _Node:
+    __slots__ = ("value", "next", "width")
+
+    def __init__(self, value, next: list, width: list):
+        self.value = value
+        self.next = next
+        self.width = width
+
+
+class RequestIndex:
+    """
+    the queue itself: requests ordered by (waiting, non_prio, timestamp) in an indexable skiplist
+    (every link knows how many entries it jumps over), plus requestee -> request.
+    lookup by user is a dict hit, insert, remove, rank and position lookups are O(log n).
+    behaves like the sorted list it replaces: len(), iteration, `in` and [idx] work
+    """
+
+    MAX_LEVELS = 24
+
+    by_user: dict[str, RequestTuple]
+    active: int
+    size: int
+    _head: _Node
+
+    def __init__(self, requests=()):
+        self._end = _Node(_End(), [], [])
+        self._head = _Node(None, [self._end] * self.MAX_LEVELS, [1] * self.MAX_LEVELS)
+        self.by_user = {}
+        self.active = 0
+        self.size = 0
+        for request in requests:
+            self.add(request)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self):
+        node = self._head.next[0]
+        while node is not self._end:
+            yield node.value
+            node = node.next[0]
+
+    def __contains__(self, request) -> bool:
+        return (
+            isinstance(request, RequestTuple)
+            and self.by_user.get(request.requestee) == request
+        )
+
+    def __getitem__(self, idx: int) -> RequestTuple:
+        if idx < 0:
+            idx += self.size
+        if not 0 <= idx < self.size:
+            raise IndexError("request index out of range")
+        node = self._head
+        idx += 1
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.width[level] <= idx:
+                idx -= node.width[level]
+                node = node.next[level]
+        return node.value
+
+    def add(self, request: RequestTuple):
+        """insert in order. a user only has one request, an older one is replaced"""
+        if (old := self.by_user.get(request.requestee)) is not None:
+            self.discard(old)
+        chain = [self._head] * self.MAX_LEVELS
+        steps_at_level = [0] * self.MAX_LEVELS
+        node = self._head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].value <= request:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        height = 1
+        while height < self.MAX_LEVELS and random.random() < 0.5:
+            height += 1
+        new_node = _Node(request, [None] * height, [0] * height)
+        steps = 0
+        for level in range(height):
+            previous = chain[level]
+            new_node.next[level] = previous.next[level]
+            previous.next[level] = new_node
+            new_node.width[level] = previous.width[level] - steps
+            previous.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(height, self.MAX_LEVELS):
+            chain[level].width[level] += 1
+
+        self.by_user[request.requestee] = request
+        self.active += not request.waiting
+        self.size += 1
+
+    def discard(self, request: RequestTuple) -> bool:
+        if request not in self:
+            return False
+        chain = [self._head] * self.MAX_LEVELS
+        node = self._head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].value < request:
+                node = node.next[level]
+            chain[level] = node
+
+        removed = chain[0].next[0]
+        for level in range(len(removed.next)):
+            previous = chain[level]
+            previous.width[level] += removed.width[level] - 1
+            previous.next[level] = removed.next[level]
+        for level in range(len(removed.next), self.MAX_LEVELS):
+            chain[level].width[level] -= 1
+
+        del self.by_user[request.requestee]
+        self.active -= not request.waiting
+        self.size -= 1
+        return True
+
+    def rank(self, request: RequestTuple) -> int | None:
+        """0-based position of request, None if it is not queued"""
+        if request not in self:
+            return None
+        position = 0
+        node = self._head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].value < request:
+                position += node.width[level]
+                node = node.next[level]
+        return position
+
+    def first_waiting(self) -> RequestTuple | None:
+        # active requests sort before waiting ones
+        if self.active < self.size:
+            return self[self.active]
+        return None
+
+
+class _LegacyRequest(tuple):
+    """what an old pickled RequestTuple unpickles to: (waiting, non_prio, timestamp, song name, requestee)"""
+
+    def __new__(cls, *fields):
+        return tuple.__new__(cls, fields)
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """queue files from before the binary format. only RequestTuples get through, nothing else is called"""
+
+    def find_class(self, module: str, name: str):
+        if name == "RequestTuple":
+            return _LegacyRequest
+        raise pickle.UnpicklingError(
+            f"{module}.{name} hat in einer Queue-Datei nichts verloren"
+        )
+
+
+def read_legacy_queue(path: str, song_id: Callable[[str], int]) -> list[RequestTuple]:
+    with open(path, mode="rb") as fh:
+        return [
+            upgrade_request(fields, song_id) for fields in _LegacyUnpickler(fh).load()
+        ]
+
+
+def upgrade_request(fields: Iterable, song_id: Callable[[str], int]) -> RequestTuple:
+    """request fields from any storage version, old ones carry the song name instead of its id"""
+    waiting, non_prio, timestamp, song, requestee = fields
+    if isinstance(song, str):
+        song = song_id(song)
+    return RequestTuple(
+        bool(waiting), bool(non_prio), timestamp, song, sys.intern(requestee)
+    )
+
+
+class BinaryStorage:
+    """
+    the whole queue as one small binary file, rewritten on every commit.
+    header: magic, format version, number of requests, number of titles, since version 2 the
+    lowest synthetic song id handed out so far.
+    then the titles of songs that are not in the songlist (left over from a migration or a reload),
+    then per request flags, timestamp, song id and the length-prefixed user name.
+    an old pickle file at the same path is converted on the first load
+    """
+
+    MAGIC = b"RQNQ"
+    VERSION = 2
+    HEADER = struct.Struct("<4sHII")
+    SYNTHETIC = struct.Struct("<i")
+    TITLE = struct.Struct("<iH")
+    REQUEST = struct.Struct("<BdiH")
+
+    path: str
+    titles: dict[int, str]
+    synthetic_id: int
+
+    def __init__(self, path: str, titles: dict[int, str] | None = None):
+        self.path = path
+        self.titles = titles if titles is not None else {}
+        self.synthetic_id = 0
+
+    @classmethod
+    def pack(
+        cls, requests: list[RequestTuple], titles: dict[int, str], synthetic_id: int = 0
+    ) -> bytes:
+        parts = [
+            cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(requests), len(titles)),
+            cls.SYNTHETIC.pack(synthetic_id),
+        ]
+        for song_id, title in titles.items():
+            encoded = title.encode()
+            parts.append(cls.TITLE.pack(song_id, len(encoded)))
+            parts.append(encoded)
+        for request in requests:
+            user = request.requestee.encode()
+            flags = request.waiting | request.non_prio << 1
+            parts.append(
+                cls.REQUEST.pack(flags, request.timestamp, request.song_id, len(user))
+            )
+            parts.append(user)
+        return b"".join(parts)
+
+    @classmethod
+    def unpack(cls, blob: bytes) -> tuple[list[RequestTuple], dict[int, str], int]:
+        magic, version, count, title_count = cls.HEADER.unpack_from(blob)
+        if magic != cls.MAGIC or version > cls.VERSION:
+            raise ValueError(f"unbekanntes Queue-Format {magic!r} v{version}")
+        offset = cls.HEADER.size
+        synthetic_id = 0
+        if version >= 2:
+            (synthetic_id,) = cls.SYNTHETIC.unpack_from(blob, offset)
+            offset += cls.SYNTHETIC.size
+        titles = {}
+        for _ in range(title_count):
+            song_id, length = cls.TITLE.unpack_from(blob, offset)
+            offset += cls.TITLE.size
+            end = offset + length
+            titles[song_id] = blob[offset:end].decode()
+            offset = end
+        requests = []
+        for _ in range(count):
+            flags, timestamp, song_id, length = cls.REQUEST.unpack_from(blob, offset)
+            offset += cls.REQUEST.size
+            end = offset + length
+            user = sys.intern(blob[offset:end].decode())
+            offset = end
+            requests.append(
+                RequestTuple(bool(flags & 1), bool(flags & 2), timestamp, song_id, user)
+            )
+        # version 1 had no counter, its synthetic ids are all in titles
+        return requests, titles, min(synthetic_id, min(titles, default=0))
+
+    @classmethod
+    def probe(cls, path: str) -> bool:
+        with open(path, mode="rb") as fh:
+            return fh.read(len(cls.MAGIC)) == cls.MAGIC
+
+    def load(self, song_id: Callable[[str], int]) -> list[RequestTuple]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, mode="rb") as fh:
+            blob = fh.read()
+        if not blob.startswith(self.MAGIC):
+            requests = read_legacy_queue(self.path, song_id)
+            # the old file stays around, just in case
+            os.replace(self.path, f"{self.path}.pickle")
+            self.commit([], requests)
+            print(f"{self.path}: {len(requests)} Requests ins neue Format übernommen")
+            return requests
+        requests, titles, synthetic_id = self.unpack(blob)
+        self.titles.update(titles)
+        self.synthetic_id = min(self.synthetic_id, synthetic_id)
+        return requests
+
+    def commit(self, ops: list[tuple[str, RequestTuple]], data: Iterable[RequestTuple]):
+        write_atomic(self.path, self.pack(list(data), self.titles, self.synthetic_id))
+
+    def close(self):
+        pass
+
+
+class JournalStorage:
+    """
+    write-ahead log for the queue. every commit appends one json line with its ops
+    ("add" or "remove" a request) and fsyncs, so a chat command costs O(changes) on disk.
+    once the log grows past compact_bytes, the current state is written as a snapshot
+    in a worker thread and the log starts over. startup = snapshot + replay of the log.
+
+    records carry a sequence number, the snapshot knows the last one it contains,
+    so a crash halfway through compaction replays nothing twice.
+    a "title" op keeps the name of a queued song that left the songlist.
+    snapshots and log records from before song ids carry song names, those are converted on load
+    """
+
+    VERSION = 1
+
+    path: str
+    snapshot_path: str
+    log_path: str
+    compact_bytes: int
+    titles: dict[int, str]
+    synthetic_id: int
+    seq: int
+    _log: BinaryIO | None
+    _compaction: asyncio.Future | None
 
     def __init__(
         self,
         path: str,
-        hackmd_token: str,
-        hackmd_tags: str = "requestnonsense",
-        hackmd_queue_title: str = "Queue",
-        hackmd_endpoint: str = "https://api.hackmd.io/v1/notes/",
+        compact_bytes: int = 64 * 1024,
+        titles: dict[int, str] | None = None,
     ):
-        self.hackmd_tags = hackmd_tags
-        self.queue_title = hackmd_queue_title
+        self.path = path
+        self.snapshot_path = f"{path}.snapshot"
+        self.log_path = f"{path}.log"
+        self.compact_bytes = compact_bytes
+        self.titles = titles if titles is not None else {}
+        self.synthetic_id = 0
+        self.seq = 0
+        self._log = None
+        self._compaction = None
 
-        self.queue_path = path
-        if os.path.exists(self.queue_path):
-            with open(self.queue_path, mode="rb") as fh:
-                self.data = pickle.load(fh)
+    @staticmethod
+    def encode(op: str, request: RequestTuple) -> list:
+        return [op, list(request)]
+
+    def load(self, song_id: Callable[[str], int]) -> list[RequestTuple]:
+        data = RequestIndex()
+        snapshot_seq = 0
+        migrated = False
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, mode="rb") as fh:
+                snapshot = json.load(fh)
+            snapshot_seq = snapshot["seq"]
+            self.titles.update(
+                (int(key), title) for key, title in snapshot.get("titles", {}).items()
+            )
+            self.synthetic_id = min(
+                snapshot.get("synthetic_id", 0), min(self.titles, default=0)
+            )
+            migrated = snapshot.get("version", 0) < self.VERSION
+            for fields in snapshot["requests"]:
+                data.add(upgrade_request(fields, song_id))
+        elif os.path.exists(self.path):
+            # first start after switching from the single file storage
+            if BinaryStorage.probe(self.path):
+                legacy = BinaryStorage(self.path, self.titles)
+                requests = legacy.load(song_id)
+                self.synthetic_id = min(self.synthetic_id, legacy.synthetic_id)
+            else:
+                requests = read_legacy_queue(self.path, song_id)
+            for request in requests:
+                data.add(request)
+            migrated = True
+        self.seq = snapshot_seq
+
+        leftover = f"{self.log_path}.old"
+        for log_path in (leftover, self.log_path):
+            if not os.path.exists(log_path):
+                continue
+            with open(log_path, mode="rb") as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn write from a crash, everything before it is fine
+                        break
+                    if record["seq"] <= snapshot_seq:
+                        continue
+                    self.seq = record["seq"]
+                    for op, fields in record["ops"]:
+                        if op == "add":
+                            data.add(upgrade_request(fields, song_id))
+                        elif op == "title":
+                            self.titles[fields[0]] = fields[1]
+                        else:
+                            data.discard(upgrade_request(fields, song_id))
+
+        if migrated or os.path.exists(leftover) or self.seq != snapshot_seq:
+            self.write_snapshot(list(data), self.seq, self.titles, self.synthetic_id)
+            for log_path in (leftover, self.log_path):
+                if os.path.exists(log_path):
+                    os.remove(log_path)
+        return list(data)
+
+    def write_snapshot(
+        self,
+        requests: list[RequestTuple],
+        seq: int,
+        titles: dict[int, str],
+        synthetic_id: int = 0,
+    ):
+        snapshot = {
+            "version": self.VERSION,
+            "seq": seq,
+            "titles": titles,
+            "synthetic_id": synthetic_id,
+            "requests": [list(request) for request in requests],
+        }
+        write_atomic(self.snapshot_path, json.dumps(snapshot).encode())
+
+    def commit(self, ops: list[tuple[str, RequestTuple]], data: RequestIndex):
+        if not ops:
+            return
+        self.seq += 1
+        record = {"seq": self.seq, "ops": [self.encode(*op) for op in ops]}
+        if self._log is None:
+            self._log = open(self.log_path, mode="ab")
+        self._log.write(json.dumps(record).encode() + b"\n")
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+        if self._log.tell() > self.compact_bytes and (
+            self._compaction is None or self._compaction.done()
+        ):
+            self.compact(data)
+
+    def compact(self, data: RequestIndex):
+        # new commits go to a fresh log while the snapshot is written
+        self._log.close()
+        self._log = None
+        old_path = f"{self.log_path}.old"
+        if os.path.exists(old_path):
+            # the last compaction failed and its records are not in a snapshot, keep them
+            with open(self.log_path, mode="rb") as log, open(
+                old_path, mode="ab"
+            ) as old:
+                old.write(log.read())
+                old.flush()
+                os.fsync(old.fileno())
+            os.remove(self.log_path)
         else:
-            self.data = list()
-        self.note = HackMDNote(
-            self.generate_requests_markdown(),
-            api_token=hackmd_token,
-            endpoint=hackmd_endpoint,
+            os.replace(self.log_path, old_path)
+        requests, seq, titles = list(data), self.seq, dict(self.titles)
+        synthetic_id = self.synthetic_id
+
+        def work():
+            self.write_snapshot(requests, seq, titles, synthetic_id)
+            os.remove(old_path)
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            try:
+                work()
+            except OSError as error:
+                self.compaction_failed(error)
+        else:
+            self._compaction = loop.run_in_executor(None, work)
+            self._compaction.add_done_callback(self.compaction_done)
+
+    def compaction_done(self, compaction: asyncio.Future):
+        if not compaction.cancelled() and compaction.exception() is not None:
+            self.compaction_failed(compaction.exception())
+
+    def compaction_failed(self, error: BaseException):
+        # the .old log stays, the next compaction appends to it and tries again
+        metrics.inc("requestnonsense_journal_compaction_failures_total")
+        print(
+            f"{self.snapshot_path}: Snapshot fehlgeschlagen, nächster Versuch später: {error!r}"
         )
 
-    def append(self, item: RequestTuple):
-        self.data.append(item)
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+class SqliteStorage:
+    """
+    requests in an sqlite table, WAL mode, so a dashboard can read while the bot writes.
+    every commit is one transaction, multi-step changes like advance_queue land completely or not at all.
+
+    the bot answers chat from its in-memory RequestIndex, the queries below are the same
+    lookups as index-backed sql for everyone else reading the database.
+    PRAGMA user_version is the schema version, version 0 had song names instead of ids.
+    meta holds the lowest synthetic song id handed out so far
+    """
+
+    VERSION = 1
+    SORT_KEY = "waiting, non_prio, timestamp, song_id, requestee"
+
+    path: str
+    legacy_path: str
+    titles: dict[int, str]
+    synthetic_id: int
+    db: sqlite3.Connection
+
+    def __init__(
+        self, path: str, readonly: bool = False, titles: dict[int, str] | None = None
+    ):
+        self.legacy_path = path
+        self.path = f"{path}.sqlite"
+        self.titles = titles if titles is not None else {}
+        self.synthetic_id = 0
+        if readonly:
+            self.db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            return
+        # transactions are handled by hand, see commit.
+        # the bot opens it in a worker thread at startup and only uses it from the loop after that
+        self.db = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        if not self.outdated():
+            self.create_schema()
+
+    def outdated(self) -> bool:
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(requests)")}
+        return "song" in columns
+
+    def create_schema(self):
+        self.db.execute("""CREATE TABLE IF NOT EXISTS requests (
+                requestee TEXT PRIMARY KEY,
+                waiting INTEGER NOT NULL,
+                non_prio INTEGER NOT NULL,
+                timestamp REAL NOT NULL,
+                song_id INTEGER NOT NULL
+            )""")
+        self.db.execute(
+            f"CREATE INDEX IF NOT EXISTS requests_order ON requests ({self.SORT_KEY})"
+        )
+        self.db.execute("""CREATE TABLE IF NOT EXISTS titles (
+                song_id INTEGER PRIMARY KEY,
+                title TEXT NOT NULL
+            )""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value
+            )""")
+        self.db.execute(f"PRAGMA user_version = {self.VERSION}")
+
+    def migrate(self, song_id: Callable[[str], int]):
+        """version 0 -> 1: song names become song ids, unknown names end up in titles"""
+        rows = self.db.execute(
+            "SELECT waiting, non_prio, timestamp, song, requestee FROM requests"
+        ).fetchall()
+        requests = [upgrade_request(row, song_id) for row in rows]
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute("DROP INDEX IF EXISTS requests_order")
+            self.db.execute("DROP TABLE requests")
+            self.create_schema()
+            self.insert(requests)
+            self.save_titles()
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        print(f"{self.path}: {len(requests)} Requests ins neue Format übernommen")
+
+    def insert(self, requests: Iterable[RequestTuple]):
+        for request in requests:
+            self.db.execute(
+                f"INSERT OR REPLACE INTO requests ({self.SORT_KEY}) VALUES (?, ?, ?, ?, ?)",
+                tuple(request),
+            )
+
+    def save_titles(self):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO titles (song_id, title) VALUES (?, ?)",
+            self.titles.items(),
+        )
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('synthetic_id', ?)",
+            (self.synthetic_id,),
+        )
+
+    @staticmethod
+    def request(row: tuple) -> RequestTuple:
+        waiting, non_prio, timestamp, song_id, requestee = row
+        return RequestTuple(
+            bool(waiting), bool(non_prio), timestamp, song_id, requestee
+        )
+
+    def load(self, song_id: Callable[[str], int]) -> list[RequestTuple]:
+        if self.outdated():
+            self.migrate(song_id)
+        self.titles.update(self.db.execute("SELECT song_id, title FROM titles"))
+        stored = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'synthetic_id'"
+        ).fetchone()
+        self.synthetic_id = min(stored[0] if stored else 0, min(self.titles, default=0))
+        rows = self.db.execute(
+            f"SELECT {self.SORT_KEY} FROM requests ORDER BY {self.SORT_KEY}"
+        ).fetchall()
+        if not rows and os.path.exists(self.legacy_path):
+            # first start after switching from the single file storage
+            if BinaryStorage.probe(self.legacy_path):
+                legacy = BinaryStorage(self.legacy_path, self.titles)
+                requests = legacy.load(song_id)
+                self.synthetic_id = min(self.synthetic_id, legacy.synthetic_id)
+            else:
+                requests = read_legacy_queue(self.legacy_path, song_id)
+            self.commit([("add", request) for request in requests], None)
+            self.save_titles()
+            # moved out of the way, otherwise an emptied queue would import it again on the next start
+            os.replace(self.legacy_path, f"{self.legacy_path}.imported")
+            print(
+                f"{self.legacy_path}: {len(requests)} Requests nach {self.path} übernommen"
+            )
+            return sorted(requests)
+        return [self.request(row) for row in rows]
+
+    def commit(self, ops: list[tuple[str, RequestTuple]], data: RequestIndex | None):
+        if not ops:
+            return
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            for op, request in ops:
+                if op == "add":
+                    self.insert([request])
+                elif op == "title":
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO titles (song_id, title) VALUES (?, ?)",
+                        request,
+                    )
+                else:
+                    self.db.execute(
+                        "DELETE FROM requests WHERE requestee = ?",
+                        (request.requestee,),
+                    )
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def lookup(self, user: str) -> RequestTuple | None:
+        row = self.db.execute(
+            f"SELECT {self.SORT_KEY} FROM requests WHERE requestee = ?", (user,)
+        ).fetchone()
+        return self.request(row) if row is not None else None
+
+    def position(self, user: str) -> int | None:
+        """1-based, like RequestQueue.get_index_for_user"""
+        if (request := self.lookup(user)) is None:
+            return None
+        (before,) = self.db.execute(
+            f"SELECT COUNT(*) FROM requests WHERE ({self.SORT_KEY}) < (?, ?, ?, ?, ?)",
+            tuple(request),
+        ).fetchone()
+        return before + 1
+
+    def next_waiting(self) -> RequestTuple | None:
+        row = self.db.execute(
+            f"SELECT {self.SORT_KEY} FROM requests WHERE waiting = 1 "
+            f"ORDER BY {self.SORT_KEY} LIMIT 1"
+        ).fetchone()
+        return self.request(row) if row is not None else None
+
+    def close(self):
+        self.db.close()
+
+
+class PlayHistory:
+    """
+    every request and every played song, appended to an sqlite table. what chat asks about
+    (?top, ?lastplayed, the song cooldown) is kept in small aggregate tables, updated in the same
+    transaction, and mirrored in memory, so nothing ever reads through the whole history again.
+    events wait in pending until the queue commits, a rolled back queue transaction drops them
+    """
+
+    VERSION = 1
+    RECENT = 5
+
+    path: str
+    db: sqlite3.Connection
+    month: str
+    last_played: dict[int, float]
+    month_requests: Counter
+    month_plays: Counter
+    user_requests: Counter
+    user_plays: Counter
+    recent: deque
+    pending: list[tuple[float, str, int, str]]
+
+    def __init__(self, path: str):
+        self.path = path
+        # opened in a worker thread at startup, like SqliteStorage
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.create_schema()
+        self.pending = []
+        self.month = self.month_of(time.time())
+        self.last_played = dict(
+            self.db.execute(
+                "SELECT song_id, last_played FROM song_stats WHERE plays > 0"
+            )
+        )
+        self.month_requests = Counter()
+        self.month_plays = Counter()
+        for song_id, requests, plays in self.db.execute(
+            "SELECT song_id, requests, plays FROM month_stats WHERE month = ?",
+            (self.month,),
+        ):
+            self.month_requests[song_id] = requests
+            self.month_plays[song_id] = plays
+        self.user_requests = Counter()
+        self.user_plays = Counter()
+        for user, requests, plays in self.db.execute(
+            "SELECT user, requests, plays FROM user_stats"
+        ):
+            self.user_requests[user] = requests
+            self.user_plays[user] = plays
+        self.recent = deque(
+            reversed(
+                self.db.execute(
+                    "SELECT at, song_id, user FROM events WHERE kind = 'play' "
+                    "ORDER BY rowid DESC LIMIT ?",
+                    (self.RECENT,),
+                ).fetchall()
+            ),
+            maxlen=self.RECENT,
+        )
+
+    def create_schema(self):
+        self.db.execute("""CREATE TABLE IF NOT EXISTS events (
+                at REAL NOT NULL,
+                kind TEXT NOT NULL,
+                song_id INTEGER NOT NULL,
+                user TEXT NOT NULL
+            )""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS song_stats (
+                song_id INTEGER PRIMARY KEY,
+                requests INTEGER NOT NULL,
+                plays INTEGER NOT NULL,
+                last_played REAL NOT NULL
+            )""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS user_stats (
+                user TEXT PRIMARY KEY,
+                requests INTEGER NOT NULL,
+                plays INTEGER NOT NULL,
+                last_played REAL NOT NULL
+            )""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS month_stats (
+                month TEXT NOT NULL,
+                song_id INTEGER NOT NULL,
+                requests INTEGER NOT NULL,
+                plays INTEGER NOT NULL,
+                PRIMARY KEY (month, song_id)
+            )""")
+        self.db.execute(f"PRAGMA user_version = {self.VERSION}")
+
+    @staticmethod
+    def month_of(at: float) -> str:
+        # same months as ApiBudget
+        return time.strftime("%Y-%m", time.gmtime(at))
+
+    def record(self, kind: str, song_id: int, user: str, at: float | None = None):
+        """kind is "request" or "play" """
+        self.pending.append((time.time() if at is None else at, kind, song_id, user))
+
+    def commit(self):
+        if not self.pending:
+            return
+        events, self.pending = self.pending, []
+        try:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.write(events)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+        except sqlite3.Error as error:
+            # the queue itself is already saved, losing a few history rows is the lesser evil
+            metrics.inc("requestnonsense_history_errors_total")
+            print(
+                f"History {self.path}: {len(events)} Einträge nicht gespeichert: {error}"
+            )
+            return
+        for event in events:
+            self.apply(*event)
+
+    def write(self, events: list[tuple[float, str, int, str]]):
+        self.db.executemany(
+            "INSERT INTO events (at, kind, song_id, user) VALUES (?, ?, ?, ?)", events
+        )
+        for at, kind, song_id, user in events:
+            requests, plays = (1, 0) if kind == "request" else (0, 1)
+            played = at if plays else 0.0
+            for table, key in (("song_stats", "song_id"), ("user_stats", "user")):
+                self.db.execute(
+                    f"INSERT INTO {table} ({key}, requests, plays, last_played) "
+                    f"VALUES (?, ?, ?, ?) ON CONFLICT ({key}) DO UPDATE SET "
+                    "requests = requests + excluded.requests, plays = plays + excluded.plays, "
+                    "last_played = max(last_played, excluded.last_played)",
+                    (song_id if key == "song_id" else user, requests, plays, played),
+                )
+            self.db.execute(
+                "INSERT INTO month_stats (month, song_id, requests, plays) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (month, song_id) DO UPDATE SET "
+                "requests = requests + excluded.requests, plays = plays + excluded.plays",
+                (self.month_of(at), song_id, requests, plays),
+            )
+
+    def apply(self, at: float, kind: str, song_id: int, user: str):
+        if (month := self.month_of(at)) != self.month:
+            self.month = month
+            self.month_requests.clear()
+            self.month_plays.clear()
+        if kind == "request":
+            self.month_requests[song_id] += 1
+            self.user_requests[user] += 1
+        else:
+            self.month_plays[song_id] += 1
+            self.user_plays[user] += 1
+            self.last_played[song_id] = max(at, self.last_played.get(song_id, 0.0))
+            self.recent.append((at, song_id, user))
+
+    def top(self, count: int = 5) -> list[tuple[int, int]]:
+        """most requested songs this month, (song id, requests)"""
+        return self.month_requests.most_common(count)
+
+    @staticmethod
+    def ago(seconds: float) -> str:
+        if seconds < 90:
+            return "gerade eben"
+        if seconds < 90 * 60:
+            return f"vor {round(seconds / 60)} Minuten"
+        if seconds < 36 * 3600:
+            return f"vor {round(seconds / 3600)} Stunden"
+        return f"vor {round(seconds / 86400)} Tagen"
+
+    def close(self):
+        self.db.close()
+
+
+class FenwickTree:
+    """prefix sums over slots 0..n-1, add and prefix are O(log n). tree[i] holds the sum of a block ending at i"""
+
+    values: list[float]
+    tree: list[float]
+
+    def __init__(self, size: int = 0):
+        self.values = []
+        self.tree = [0.0]
+        self.grow(size)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def grow(self, size: int):
+        """room for size slots, rebuilt in O(n)"""
+        if size <= len(self.values):
+            return
+        self.values.extend([0.0] * (size - len(self.values)))
+        self.tree = [0.0] + self.values
+        for i in range(1, len(self.tree)):
+            if (parent := i + (i & -i)) < len(self.tree):
+                self.tree[parent] += self.tree[i]
+
+    def add(self, slot: int, delta: float):
+        self.values[slot] += delta
+        i = slot + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, count: int) -> float:
+        total = 0.0
+        while count:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+
+class SchedulingPolicy:
+    """
+    which waiting request ?randomize picks. this one: every waiting request is equally likely,
+    the active song (waiting=False) is never picked again.
+    every waiting request has a slot in fenwick trees over its weight, so adding, removing and
+    picking stay O(log n) however long the queue is. subclasses change what a slot weighs
+    """
+
+    name = "uniform"
+
+    requests: list[RequestTuple | None]
+    slots: dict[RequestTuple, int]
+    free: list[int]
+    counts: FenwickTree
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self.requests = []
+        self.slots = {}
+        self.free = []
+        self.counts = FenwickTree()
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def trees(self) -> list[FenwickTree]:
+        return [self.counts]
+
+    def add(self, request: RequestTuple):
+        if not request.waiting or request in self.slots:
+            return
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = len(self.requests)
+            self.requests.append(None)
+            if slot >= len(self.counts):
+                for tree in self.trees():
+                    tree.grow(max(2 * slot, 64))
+        self.requests[slot] = request
+        self.slots[request] = slot
+        self.place(slot, request, 1)
+
+    def discard(self, request: RequestTuple):
+        if (slot := self.slots.pop(request, None)) is None:
+            return
+        self.place(slot, request, -1)
+        self.requests[slot] = None
+        self.free.append(slot)
+
+    def place(self, slot: int, request: RequestTuple, sign: int):
+        self.counts.add(slot, sign)
+
+    def played(self, request: RequestTuple):
+        """request just became the active song"""
+
+    def node_weight(self, node: int, now: float) -> float:
+        return self.counts.tree[node]
+
+    def pick(self) -> RequestTuple | None:
+        if not self.slots:
+            return None
+        now = self.clock()
+        size = len(self.counts)
+        total = 0.0
+        node = size
+        while node:
+            total += self.node_weight(node, now)
+            node -= node & -node
+        target = random.random() * total
+        # walk down the implicit tree: biggest prefix that still weighs <= target
+        slot = 0
+        step = 1 << (size.bit_length() - 1)
+        while step:
+            if (node := slot + step) <= size and (
+                weight := self.node_weight(node, now)
+            ) <= target:
+                slot = node
+                target -= weight
+            step >>= 1
+        if slot < len(self.requests) and self.requests[slot] is not None:
+            return self.requests[slot]
+        # rounding put us on an empty slot at the very end
+        return next(request for request in reversed(self.requests) if request)
+
+
+class WaitTimePolicy(SchedulingPolicy):
+    """
+    the longer a request waits, the likelier it gets picked: weight now - timestamp.
+    that changes all the time, but summed over a block it is now * count - sum(timestamps),
+    so a count tree and a timestamp tree are enough
+    """
+
+    name = "wait"
+
+    stamps: FenwickTree
+    origin: float
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        super().__init__(clock)
+        self.stamps = FenwickTree()
+        # timestamps are stored relative to this, sums of epoch seconds lose precision
+        self.origin = clock()
+
+    def trees(self) -> list[FenwickTree]:
+        return [self.counts, self.stamps]
+
+    def stamp(self, request: RequestTuple) -> float:
+        return request.timestamp
+
+    def place(self, slot: int, request: RequestTuple, sign: int):
+        self.counts.add(slot, sign)
+        if sign > 0:
+            self.stamps.add(slot, self.stamp(request) - self.origin)
+        else:
+            # take out exactly what went in, the user's stamp may have moved since
+            self.stamps.add(slot, -self.stamps.values[slot])
+
+    def node_weight(self, node: int, now: float) -> float:
+        return max(
+            (now - self.origin) * self.counts.tree[node] - self.stamps.tree[node], 0.0
+        )
+
+
+class FairSharePolicy(WaitTimePolicy):
+    """
+    users who haven't had a song played in a while come first: weight is the time since the
+    user's last played song. users without one count as played HORIZON seconds before their request
+    """
+
+    name = "fair"
+    HORIZON = 3600.0
+
+    last_played: dict[str, float]
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        super().__init__(clock)
+        self.last_played = {}
+
+    def stamp(self, request: RequestTuple) -> float:
+        return self.last_played.get(request.requestee, request.timestamp - self.HORIZON)
+
+    def played(self, request: RequestTuple):
+        # a user has one request at a time, the next one is placed with this
+        self.last_played[request.requestee] = self.clock()
+
+
+class TieredPolicy(SchedulingPolicy):
+    """prio requests first, uniform within the tier"""
+
+    name = "tiers"
+
+    tiers: dict[bool, SchedulingPolicy]
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        super().__init__(clock)
+        # keyed by non_prio, False sorts first
+        self.tiers = {False: SchedulingPolicy(clock), True: SchedulingPolicy(clock)}
+
+    def __len__(self) -> int:
+        return sum(len(tier) for tier in self.tiers.values())
+
+    def add(self, request: RequestTuple):
+        self.tiers[request.non_prio].add(request)
+
+    def discard(self, request: RequestTuple):
+        self.tiers[request.non_prio].discard(request)
+
+    def pick(self) -> RequestTuple | None:
+        for tier in sorted(self.tiers):
+            if (request := self.tiers[tier].pick()) is not None:
+                return request
+        return None
+
+
+POLICIES = {
+    policy.name: policy
+    for policy in (SchedulingPolicy, WaitTimePolicy, FairSharePolicy, TieredPolicy)
+}
+
+
+class QueueRenderer:
+    """
+    the queue markdown, built from cached rows.
+    every request is rendered to its "song | user" cells once, when it enters the queue.
+    rows mirrors the queue order and gets spliced on add/remove, the position column
+    is the only thing put together per render. with max_rows only the top of the queue
+    plus a summary line ends up in the note, long queues don't mean huge PATCH bodies
+    """
+
+    header: str
+    empty: str
+    song_name: Callable[[int], str]
+    max_rows: int
+    rows: list[str]
+    _document: str | None
+
+    def __init__(
+        self,
+        header: str,
+        empty: str,
+        song_name: Callable[[int], str] = str,
+        max_rows: int = 0,
+    ):
+        self.header = header
+        self.empty = empty
+        self.song_name = song_name
+        self.max_rows = max_rows
+        self.rows = []
+        self._document = None
+
+    def cells(self, request: RequestTuple) -> str:
+        return f"| {self.song_name(request.song_id)} | {request.requestee} |"
+
+    def insert(self, position: int, request: RequestTuple):
+        self.rows.insert(position, self.cells(request))
+        self._document = None
+
+    def delete(self, position: int):
+        del self.rows[position]
+        self._document = None
+
+    def render(self) -> str:
+        if self._document is not None:
+            return self._document
+        if not self.rows:
+            self._document = self.empty
+            return self._document
+
+        shown = self.rows[: self.max_rows] if self.max_rows else self.rows
+        lines = [self.header]
+        lines.extend(f"| {idx} {row}" for idx, row in enumerate(shown, start=1))
+        if hidden := len(self.rows) - len(shown):
+            lines.append(f"| ... | und {hidden} weitere Requests | |")
+        self._document = "\n".join(lines)
+        return self._document
+
+
+class QueueStopped(Exception):
+    """the queue task ended before it got to an operation, or was cancelled while running it"""
+
+
+class RequestQueue:
+    """wir machen jetzt alberne Tricks, um die Queue irgendwann in sqlite zu haben. yay"""
+
+    data: RequestIndex
+    songs: dict[int, str]
+    titles: dict[int, str]
+    _song_ids: dict[str, int] | None
+    storage: BinaryStorage | JournalStorage | SqliteStorage
+    note: HackMDNote
+    publisher: NotePublisher
+    renderer: QueueRenderer
+    policy: SchedulingPolicy
+    history: PlayHistory | None
+    cooldown: float
+    listeners: list[Callable[[list[tuple]], None]]
+    mirror: bool
+    _pending: list[tuple[str, RequestTuple | tuple[int, str]]]
+    _diffs: list[tuple[str, int, RequestTuple]]
+    _batch: int
+    _mailbox: asyncio.Queue | None
+    _actor: asyncio.Task | None
+    hackmd_tags: str
+    queue_path: str
+    queue_title: str
+
+    def __init__(
+        self,
+        path: str,
+        hackmd_token: str,
+        hackmd_tags: str = "requestnonsense",
+        hackmd_queue_title: str = "Queue",
+        hackmd_endpoint: str = "https://api.hackmd.io/v1/notes/",
+        hackmd_client: HackMDClient | None = None,
+        publish_window: float = 5.0,
+        storage: str = "binary",
+        journal_compact_bytes: int = 64 * 1024,
+        note_registry: NoteRegistry | None = None,
+        max_rows: int = 0,
+        mirror: bool = True,
+        note_name: str = "queue",
+        songs: dict[int, str] | None = None,
+        policy: str = "uniform",
+        history_path: str = "",
+        cooldown: float = 0,
+    ):
+        """
+        songs: the catalog the song ids point into. names of songs that are not (or no longer) in it
+        are kept in titles, with negative ids.
+        policy: how get_random picks, one of POLICIES.
+        history_path: sqlite file for the PlayHistory, none without it.
+        cooldown: seconds after a song was played before it can be requested again, needs the history
+        """
+        if policy not in POLICIES:
+            raise ValueError(
+                f"unknown policy {policy!r}, pick one of {', '.join(POLICIES)}"
+            )
+        self.songs = songs if songs is not None else {}
+        self.titles = {}
+        self._song_ids = None
+        self.hackmd_tags = hackmd_tags
+        self.queue_title = hackmd_queue_title
+        self.renderer = QueueRenderer(
+            "\n".join(
+                [
+                    f"---\ntags: {self.hackmd_tags}\n---# {self.queue_title}",
+                    "",
+                    "| Pos | Song | User |",
+                    "| --- | --- | --- |",
+                ]
+            ),
+            f"---\ntags: {self.hackmd_tags}\n---# {self.queue_title}\n Beeindruckend leer hier",
+            song_name=self.song_name,
+            max_rows=max_rows,
+        )
+
+        self.queue_path = path
+        if storage == "journal":
+            self.storage = JournalStorage(
+                path, compact_bytes=journal_compact_bytes, titles=self.titles
+            )
+        elif storage == "sqlite":
+            self.storage = SqliteStorage(path, titles=self.titles)
+        else:
+            # "pickle" is what the single file storage used to be called
+            self.storage = BinaryStorage(path, titles=self.titles)
+        self.data = RequestIndex(self.storage.load(self.song_id_for))
+        self.renderer.rows = [self.renderer.cells(request) for request in self.data]
+        self.policy = POLICIES[policy]()
+        for request in self.data:
+            self.policy.add(request)
+        self.history = PlayHistory(history_path) if history_path else None
+        self.cooldown = cooldown
+        self._pending = []
+        self._diffs = []
+        self._batch = 0
+        self._mailbox = None
+        self._actor = None
+        self.listeners = []
+        self.mirror = mirror
+        if hackmd_client is None:
+            hackmd_client = HackMDClient(hackmd_token, endpoint=hackmd_endpoint)
+        self.note = HackMDNote(
+            self.generate_requests_markdown(),
+            hackmd_client,
+            name=note_name,
+            registry=note_registry,
+        )
+        self.publisher = NotePublisher(
+            self.note,
+            self.generate_requests_markdown,
+            window=publish_window,
+            budget=hackmd_client.budget,
+        )
+
+    def append(self, item: RequestTuple):
+        if (old := self.data.by_user.get(item.requestee)) is not None:
+            self.remove(old)
+        self.data.add(item)
+        self.policy.add(item)
+        position = self.data.rank(item)
+        self.renderer.insert(position, item)
+        self._pending.append(("add", item))
+        self._diffs.append(("add", position, item))
+
+    def insert(self, position: int, item: RequestTuple):
+        # position is decided by the sort key, kept for compatibility
+        self.append(item)
+
+    def remove(self, item: RequestTuple):
+        if (position := self.data.rank(item)) is None:
+            raise ValueError(f"{item!r} not in queue")
+        self.data.discard(item)
+        self.policy.discard(item)
+        self.renderer.delete(position)
+        self._pending.append(("remove", item))
+        self._diffs.append(("remove", position, item))
+
+    def replace(self, old: RequestTuple, new: RequestTuple):
+        self.remove(old)
+        self.append(new)
+
+    def song_name(self, song_id: int) -> str:
+        if (name := self.songs.get(song_id)) is not None:
+            return name
+        return self.titles.get(song_id, f"Song #{song_id}")
+
+    def song_id_for(self, name: str) -> int:
+        """id for a song name from an old queue file"""
+        if self._song_ids is None:
+            self._song_ids = {song: song_id for song_id, song in self.songs.items()}
+            self._song_ids.update(
+                (title, song_id) for song_id, title in self.titles.items()
+            )
+        if (song_id := self._song_ids.get(name)) is None:
+            # negative and counted down by the storage, never one the songlist could hand out
+            self.storage.synthetic_id -= 1
+            song_id = self._song_ids[name] = self.storage.synthetic_id
+            self.titles[song_id] = name
+        return song_id
+
+    def set_songs(self, songs: dict[int, str]):
+        """a reloaded catalog. queued songs that are gone from it keep their name in titles"""
+        for request in self.data:
+            if request.song_id not in songs and request.song_id in self.songs:
+                title = self.titles[request.song_id] = self.songs[request.song_id]
+                self._pending.append(("title", (request.song_id, title)))
+        self.songs = songs
+        self._song_ids = None
+        if not self._batch and self._pending:
+            # written right away, after a restart the old songlist is gone
+            ops, self._pending = self._pending, []
+            self.commit(ops)
+
+    def cooldown_left(self, song_id: int, now: float | None = None) -> float:
+        if not self.cooldown or self.history is None:
+            return 0.0
+        if (played := self.history.last_played.get(song_id)) is None:
+            return 0.0
+        return played + self.cooldown - (time.time() if now is None else now)
+
+    def get_first(self) -> RequestTuple:
+        return self.get_element(0)
+
+    def get_element(self, idx: int) -> RequestTuple:
+        return self.data[idx]
+
+    def get_random(self) -> RequestTuple | None:
+        """a waiting request, picked by the scheduling policy"""
+        return self.policy.pick()
+
+    def get_first_waiting(self) -> RequestTuple | None:
+        return self.data.first_waiting()
+
+    def sort(self):
+        # the index is always sorted
+        pass
+
+    def len(self) -> int:
+        return len(self.data)
+
+    def get_index_for_user(self, user: str) -> int | None:
+        if (request := self.data.by_user.get(user)) is not None:
+            return self.data.rank(request) + 1
+        return None
+
+    def get_request_for_user(self, user: str) -> RequestTuple | None:
+        return self.data.by_user.get(user)
+
+    async def safe_queue(self):
+        if self._batch:
+            # a transaction is open, it writes and publishes once at its end
+            return
+        ops, self._pending = self._pending, []
+        self.commit(ops)
+        self.notify()
+
+    def commit(self, ops: list[tuple[str, RequestTuple]]):
+        with metrics.timer(
+            "requestnonsense_storage_commit_seconds",
+            storage=type(self.storage).__name__,
+        ):
+            self.storage.commit(ops, self.data)
+        if self.history is not None:
+            self.history.commit()
+
+    def notify(self):
+        diffs, self._diffs = self._diffs, []
+        for listener in self.listeners:
+            listener(diffs)
+        if self.mirror:
+            self.publisher.schedule()
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """
+        async with queue.transaction(): several changes (process_*, advance_queue, append, remove)
+        with one storage write, one listener call and one note publish at the end.
+        if the block raises, or the storage write fails, the queue goes back to how it was.
+        transactions nest, only the outermost one commits
+        """
+        pending, diffs = len(self._pending), len(self._diffs)
+        events = len(self.history.pending) if self.history is not None else 0
+        self._batch += 1
+        try:
+            yield self
+        except BaseException:
+            self._batch -= 1
+            self.rollback(pending, diffs, events)
+            raise
+        self._batch -= 1
+        if self._batch or not (self._pending or self._diffs):
+            return
+        try:
+            self.commit(self._pending)
+        except BaseException:
+            self.rollback(pending, diffs, events)
+            raise
+        self._pending = []
+        self.notify()
+
+    async def submit(self, operation: Callable[[], Awaitable]):
+        """
+        runs operation (a coroutine function that reads and changes the queue) in the queue's own task
+        and returns its result once it is written to storage. operations never interleave, so
+        picking a request and changing it is one step. everything that arrives while a batch
+        runs goes into the next one, and each batch is one storage write and one publish.
+        reads don't need this, between batches the index is always consistent
+        """
+        if self._actor is None or self._actor.done():
+            self._mailbox = asyncio.Queue()
+            self._actor = asyncio.create_task(self.serve())
+        result = asyncio.get_running_loop().create_future()
+        self._mailbox.put_nowait((operation, result))
+        return await result
+
+    async def serve(self):
+        batch = []
+        try:
+            while True:
+                batch = [await self._mailbox.get()]
+                while not self._mailbox.empty():
+                    batch.append(self._mailbox.get_nowait())
+                stopping = None in batch
+                batch = [item for item in batch if item is not None]
+                outcomes = []
+                try:
+                    async with self.transaction():
+                        for operation, _ in batch:
+                            try:
+                                # one failing operation only takes back its own changes
+                                async with self.transaction():
+                                    outcomes.append((await operation(), None))
+                            except Exception as error:
+                                outcomes.append((None, error))
+                except Exception as error:
+                    outcomes = [(None, error)] * len(batch)
+                if batch:
+                    metrics.inc("requestnonsense_queue_commands_total", len(batch))
+                    metrics.inc("requestnonsense_queue_batches_total")
+                for (_, result), (value, error) in zip(batch, outcomes):
+                    if result.done():
+                        continue
+                    if error is not None:
+                        result.set_exception(error)
+                    else:
+                        result.set_result(value)
+                batch = []
+                if stopping:
+                    return
+        finally:
+            # cancelled or worse: nobody waiting in submit() may wait forever
+            while not self._mailbox.empty():
+                batch.append(self._mailbox.get_nowait())
+            for item in batch:
+                if item is not None and not item[1].done():
+                    item[1].set_exception(QueueStopped("Queue-Task beendet"))
+
+    async def stop(self):
+        """lets the queue task finish what is in its mailbox"""
+        if self._actor is not None and not self._actor.done():
+            self._mailbox.put_nowait(None)
+            await self._actor
+
+    def rollback(self, pending: int, diffs: int, events: int = 0):
+        """
+        undoes everything recorded after the first pending ops, diffs and history events.
+        titles stay, they only describe songs and are written with the next commit
+        """
+        titles = [op for op in self._pending[pending:] if op[0] == "title"]
+        for op, item in reversed(self._pending[pending:]):
+            if op == "title":
+                continue
+            elif op == "add":
+                self.renderer.delete(self.data.rank(item))
+                self.data.discard(item)
+                self.policy.discard(item)
+            else:
+                self.data.add(item)
+                self.policy.add(item)
+                self.renderer.insert(self.data.rank(item), item)
+        del self._pending[pending:]
+        self._pending.extend(titles)
+        del self._diffs[diffs:]
+        if self.history is not None:
+            del self.history.pending[events:]
+
+    def generate_requests_markdown(self) -> str:
+        with metrics.timer("requestnonsense_markdown_seconds", note="queue"):
+            return self.renderer.render()
+
+    async def process_request(self, song_id: int, requestee: str) -> str:
+        waiting = True
+        non_prio = True
+        moment = time.time()
+        requestee = sys.intern(requestee)
+        song = self.song_name(song_id)
+        if (left := self.cooldown_left(song_id, moment)) > 0:
+            return (
+                f"@{requestee}: {song} lief gerade erst, "
+                f"wieder requestbar in {math.ceil(left / 60)} Minuten"
+            )
+
+        if (request := self.get_request_for_user(requestee)) is not None:
+            request_tuple = RequestTuple(
+                request.waiting,
+                request.non_prio,
+                request.timestamp,
+                song_id,
+                requestee,
+            )
+            self.replace(request, request_tuple)
+            message = f"@{requestee}: Dein Request wurde aktualisiert zu {song}"
+        else:
+            request_tuple = RequestTuple(waiting, non_prio, moment, song_id, requestee)
+            self.append(request_tuple)
+            message = f"@{requestee}: Dein Request für {song} ist eingetragen."
+        if self.history is not None:
+            self.history.record("request", song_id, requestee, moment)
+
+        await self.safe_queue()
+        return message
+
+    async def process_upgrade(self, requestee: str, author: str) -> str:
+        if (request := self.get_request_for_user(requestee)) is not None:
+            self.replace(
+                request,
+                RequestTuple(
+                    request.waiting,
+                    False,
+                    request.timestamp,
+                    request.song_id,
+                    request.requestee,
+                ),
+            )
+            await self.safe_queue()
+            print(f"Der Request von {request.requestee} hat jetzt prio")
+            message = f"@{author}: Der Request von {request.requestee} hat jetzt prio"
+        else:
+            print(f"{requestee} hat keine Request in der Warteschlange")
+            message = f"@{author}: {requestee} hat keine Request in der Warteschlange"
+        return message
+
+    async def process_remove(self, requestee: str, author: str) -> str:
+        if (request := self.get_request_for_user(requestee)) is not None:
+            self.remove(request)
+            await self.safe_queue()
+            print(f"Der Request von {request.requestee} ist raus")
+            message = f"@{author}: Der Request von {request.requestee} ist raus"
+        else:
+            print(f"{requestee} hat keine Request in der Warteschlange")
+            message = f"@{author}: {requestee} hat keine Request in der Warteschlange"
+        return message
+
+    async def advance_queue(self, next_song: RequestTuple | None) -> str:
+        if len(self.data) > 0:
+            top_song = self.get_first()
+            if not top_song.waiting:
+                # [0] is waiting -> not waiting -> song was active
+                self.remove(top_song)
+                if len(self.data) == 0:
+                    # no more songs left, säd
+                    message = "Queue leer, säd"
+                    print(message)
+                    await self.safe_queue()
+                    return message
+            if next_song is None:
+                message = "Kein wartender Song mehr in der Queue"
+                print(message)
+                await self.safe_queue()
+                return message
+            if next_song not in self.data:
+                message = f"{self.song_name(next_song.song_id)} is nicht (mehr) in der Queue. Upsi."
+                print(message)
+                if not top_song.waiting:
+                    await self.safe_queue()
+                return message
+
+            self.replace(
+                next_song,
+                RequestTuple(
+                    False,
+                    next_song.non_prio,
+                    next_song.timestamp,
+                    next_song.song_id,
+                    next_song.requestee,
+                ),
+            )
+            self.policy.played(next_song)
+            if self.history is not None:
+                self.history.record("play", next_song.song_id, next_song.requestee)
+            song = self.song_name(next_song.song_id)
+            message = f"Nächster Song: {song} requestet von {next_song.requestee}"
+            await self.safe_queue()
+        else:
+            message = "Queue leer, säd"
+        print(message)
+
+        return message
+
+
+ARRANGEMENT_SPLIT = re.compile(r"[^A-Za-z]+")
+SEARCH_TOKEN = re.compile(r"[^\W_]+")
+
+
+class SongIndex:
+    """
+    search over artist and title, so chat can `?request hysteria` instead of looking up ids.
+    text is normalized (no accents, lower case, only letters and digits) and split in tokens.
+    token -> song ids is the inverted index, the sorted vocabulary gives prefix matches,
+    trigram -> tokens finds the right word for typos.
+    every query token has to match something, rare tokens are looked at first,
+    so common words like "the" only ever get checked against a handful of candidates.
+    a SongCatalog carries the same tables compiled, see from_tables
+    """
+
+    PREFIX_LIMIT = 50
+    FUZZY_LIMIT = 5
+    FUZZY_MIN_SIMILARITY = 0.4
+    FUZZY_TRIGRAM_LIMIT = 1000
+    # a query of only very common words ("the love") ranks at most this many of its matches
+    CANDIDATE_LIMIT = 500
+
+    postings: Mapping[str, Iterable[int]]
+    vocabulary: Sequence[str]
+    trigrams: Mapping[str, Iterable[str]]
+    lengths: Mapping[int, int]
+
+    def __init__(self, songs: Iterable[tuple[int, str]] = ()):
+        self.postings = defaultdict(set)
+        self.lengths = {}
+        for song_id, song in songs:
+            tokens = self.tokenize(song)
+            self.lengths[song_id] = len(tokens)
+            for token in tokens:
+                self.postings[token].add(song_id)
+        self.postings = dict(self.postings)
+        self.vocabulary = sorted(self.postings)
+        self.trigrams = defaultdict(set)
+        for token in self.vocabulary:
+            for trigram in self.token_trigrams(token):
+                self.trigrams[trigram].add(token)
+        self.trigrams = dict(self.trigrams)
+
+    @classmethod
+    def from_tables(
+        cls,
+        postings: Mapping[str, Iterable[int]],
+        vocabulary: Sequence[str],
+        trigrams: Mapping[str, Iterable[str]],
+        lengths: Mapping[int, int],
+    ) -> "SongIndex":
+        """an index over tables that are already built, nothing is copied"""
+        index = cls.__new__(cls)
+        index.postings = postings
+        index.vocabulary = vocabulary
+        index.trigrams = trigrams
+        index.lengths = lengths
+        return index
+
+    @staticmethod
+    def tokenize(text: str) -> list[str]:
+        text = unicodedata.normalize("NFKD", text.casefold())
+        text = "".join(char for char in text if not unicodedata.combining(char))
+        return SEARCH_TOKEN.findall(text)
+
+    @staticmethod
+    def token_trigrams(token: str) -> set[str]:
+        padded = f"  {token} "
+        return {"".join(chars) for chars in zip(padded, padded[1:], padded[2:])}
+
+    def matches(self, token: str) -> list[tuple[str, float]]:
+        """vocabulary tokens that could be meant by token, with a weight"""
+        if token in self.postings:
+            found = [(token, 1.0)]
+        else:
+            found = []
+        if len(token) < 3:
+            # "a" or "of" as prefix would match half the catalog
+            return found
+        start = bisect.bisect_left(self.vocabulary, token)
+        end = min(start + self.PREFIX_LIMIT, len(self.vocabulary))
+        for position in range(start, end):
+            if not (candidate := self.vocabulary[position]).startswith(token):
+                break
+            if candidate != token:
+                found.append((candidate, 0.5 + 0.4 * len(token) / len(candidate)))
+        if found:
+            return found
+
+        query_trigrams = self.token_trigrams(token)
+        shared = Counter()
+        # trigrams like "  s" are in thousands of words, counting those costs more than it tells.
+        # rarest first, the common ones only while nothing else was found
+        for tokens in sorted(
+            (self.trigrams.get(trigram, ()) for trigram in query_trigrams), key=len
+        ):
+            if shared and len(tokens) > self.FUZZY_TRIGRAM_LIMIT:
+                break
+            shared.update(tokens)
+        # the counts above may be partial, the similarity is taken from the whole trigram sets
+        for candidate, _ in shared.most_common(self.FUZZY_TRIGRAM_LIMIT):
+            candidate_trigrams = self.token_trigrams(candidate)
+            similarity = len(query_trigrams & candidate_trigrams) / len(
+                query_trigrams | candidate_trigrams
+            )
+            if similarity >= self.FUZZY_MIN_SIMILARITY:
+                found.append((candidate, 0.8 * similarity))
+        found.sort(key=lambda match: (-match[1], match[0]))
+        return found[: self.FUZZY_LIMIT]
+
+    @staticmethod
+    def common(candidates: set[int], ids: Iterable[int]) -> set[int]:
+        """the candidates that are in ids, without walking a long compiled posting list for a few candidates"""
+        if isinstance(ids, (set, frozenset)):
+            return candidates & ids
+        # a binary search from python costs about as much as walking a hundred ids in C
+        if 128 * len(candidates) < len(ids):
+            return {song_id for song_id in candidates if song_id in ids}
+        return candidates.intersection(ids)
+
+    def search(self, query: str, limit: int = 5) -> list[tuple[int, float]]:
+        """(song id, score) pairs, best first"""
+        alternatives = []
+        for token in self.tokenize(query):
+            # postings are looked up once per query, in a compiled index every lookup is a binary search
+            found = [
+                (self.postings[match], weight) for match, weight in self.matches(token)
+            ]
+            if found:
+                alternatives.append(found)
+        if not alternatives:
+            return []
+        alternatives.sort(key=lambda found: sum(len(ids) for ids, _ in found))
+
+        # rarest word first, every other one only narrows its songs down
+        first = alternatives[0]
+        if len(alternatives) == 1:
+            candidates = itertools.chain.from_iterable(ids for ids, _ in first)
+        elif len(first) == 1 and isinstance(first[0][0], (set, frozenset)):
+            # not changed in place below, no need to copy it
+            candidates = first[0][0]
+        else:
+            candidates = set().union(*(ids for ids, _ in first))
+        for found in alternatives[1:]:
+            candidates = set().union(
+                *(self.common(candidates, ids) for ids, _ in found)
+            )
+            if not candidates:
+                return []
+        # only very common words would rank half the catalog, a sample of their matches has to do
+        candidates = set(itertools.islice(candidates, self.CANDIDATE_LIMIT))
+
+        # a word with one match adds its weight to every candidate,
+        # otherwise each candidate gets the best weight of the matches it contains
+        base = 0.0
+        scores = dict.fromkeys(candidates, 0.0)
+        for found in alternatives:
+            if len(found) == 1:
+                base += found[0][1]
+                continue
+            best = {}
+            for ids, weight in sorted(found, key=lambda match: match[1]):
+                best.update(dict.fromkeys(self.common(candidates, ids), weight))
+            for song_id, weight in best.items():
+                scores[song_id] += weight
+
+        # same score: fewer words in artist + title means a closer match
+        return [
+            (song_id, base + score)
+            for song_id, score in heapq.nlargest(
+                limit,
+                scores.items(),
+                key=lambda item: (item[1], -self.lengths[item[0]], -item[0]),
+            )
+        ]
+
+
+class SongIds:
+    """
+    (artist, title) -> song id, kept in a json file so a posted `?request 123` keeps meaning the same
+    song across restarts and songlist changes. known songs keep their id, new songs get the next
+    free one, ids of removed songs are never handed out again.
+    the first run numbers the sorted songlist from 1, like the bot always did.
+    the file is only read when ids are handed out, a start from a cache doesn't need it
+    """
+
+    path: str
+    _ids: dict[tuple[str, str], int] | None
+    next: int
+
+    def __init__(self, path: str = ""):
+        self.path = path
+        self._ids = None
+        self.next = 1
+
+    @property
+    def ids(self) -> dict[tuple[str, str], int]:
+        if self._ids is None:
+            self._ids = {}
+            if self.path and os.path.exists(self.path):
+                with open(self.path, encoding="utf-8") as fh:
+                    stored = json.load(fh)
+                self._ids = {
+                    (artist, title): idx for artist, title, idx in stored["songs"]
+                }
+                self.next = stored["next"]
+        return self._ids
+
+    def assign(self, songs: Iterable[tuple[str, str]]) -> list[tuple[int, str, str]]:
+        """(id, artist, title) for songs, sorted by artist and title"""
+        result = []
+        known = len(self.ids)
+        for song in sorted(songs):
+            if (idx := self.ids.get(song)) is None:
+                idx = self.ids[song] = self.next
+                self.next += 1
+            result.append((idx, *song))
+        self.save(len(self.ids) != known)
+        return result
+
+    def adopt(self, songs: list):
+        """ids from a catalog cache, in case the id file went missing"""
+        known = len(self.ids)
+        for idx, artist, title in songs:
+            if (artist, title) not in self.ids:
+                self.ids[(artist, title)] = idx
+                self.next = max(self.next, idx + 1)
+        self.save(len(self.ids) != known)
+
+    def save(self, changed: bool = True):
+        if not self.path or not changed and os.path.exists(self.path):
+            return
+        data = {
+            "next": self.next,
+            "songs": [
+                [artist, title, idx] for (artist, title), idx in self.ids.items()
+            ],
+        }
+        write_atomic(self.path, json.dumps(data, ensure_ascii=False).encode())
+
+
+class _StringTable(Sequence):
+    """sorted utf-8 strings in a SongCatalog, each one only decoded when looked at"""
+
+    offsets: memoryview
+    blob: memoryview
+
+    def __init__(self, offsets: memoryview, blob: memoryview):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[number] for number in range(*idx.indices(len(self)))]
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return str(self.blob[start:end], "utf-8")
+
+    def find(self, text: str) -> int:
+        """position of text, -1 if it is not in the table"""
+        idx = bisect.bisect_left(self, text)
+        return idx if idx < len(self) and self[idx] == text else -1
+
+
+class _SortedInts(Sequence):
+    """a sorted int table in a SongCatalog, `in` is a binary search"""
+
+    values: memoryview
+
+    def __init__(self, values: memoryview):
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __getitem__(self, idx):
+        return self.values[idx]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.values)
+
+    def __contains__(self, value) -> bool:
+        idx = bisect.bisect_left(self.values, value)
+        return idx < len(self.values) and self.values[idx] == value
+
+
+class _Tokens(Sequence):
+    """token numbers from a SongCatalog, decoded one at a time"""
+
+    numbers: memoryview
+    vocabulary: _StringTable
+
+    def __init__(self, numbers: memoryview, vocabulary: _StringTable):
+        self.numbers = numbers
+        self.vocabulary = vocabulary
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def __getitem__(self, idx) -> str:
+        return self.vocabulary[self.numbers[idx]]
+
+
+class _Groups(Mapping):
+    """key -> its run of a flat table, like token -> song ids. keys are a _StringTable"""
+
+    keys: _StringTable
+    offsets: memoryview
+    values: memoryview
+    wrap: Callable
+
+    def __init__(
+        self,
+        keys: _StringTable,
+        offsets: memoryview,
+        values: memoryview,
+        wrap: Callable,
+    ):
+        self.keys = keys
+        self.offsets = offsets
+        self.values = values
+        self.wrap = wrap
+
+    def __getitem__(self, key: str):
+        if (idx := self.keys.find(key)) < 0:
+            raise KeyError(key)
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.wrap(self.values[start:end])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+
+class _CatalogColumn(Mapping):
+    """song id -> its entry in a per-song table of a SongCatalog, optionally looked up in choices"""
+
+    catalog: "SongCatalog"
+    column: memoryview
+    choices: list | None
+
+    def __init__(
+        self, catalog: "SongCatalog", column: memoryview, choices: list | None = None
+    ):
+        self.catalog = catalog
+        self.column = column
+        self.choices = choices
+
+    def __getitem__(self, song_id: int):
+        if (position := self.catalog.position(song_id)) < 0:
+            raise KeyError(song_id)
+        value = self.column[position]
+        return self.choices[value] if self.choices is not None else value
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.catalog)
+
+    def __len__(self) -> int:
+        return len(self.catalog)
+
+
+class SongCatalog(Mapping):
+    """
+    a compiled songlist: one read-only file that every bot process mmaps, so N processes share one
+    copy in the page cache and a start is opening a file instead of parsing the csv.
+    song id -> "Artist - Title" is looked up in the offset tables and only the one name is decoded,
+    nothing is turned into python strings up front. the search index (see SongIndex) and the
+    shard of every song are compiled in as well, searching reads them straight from the map.
+
+    layout after the header: the element count of every section, then the SECTIONS in order,
+    each padded to 8 bytes. tables are in native byte order (it is part of the key),
+    the file is meant for this machine
+    """
+
+    MAGIC = b"RQNC"
+    VERSION = 2
+    # magic, version, key digest
+    HEADER = struct.Struct("<4sH2x20s")
+    SECTIONS = (
+        # ids in catalog order, position by id (-1 for none)
+        ("ids", "i"),
+        ("positions", "i"),
+        # name offsets (count + 1), artist byte lengths, the utf-8 names, the pages as json
+        ("offsets", "I"),
+        ("artist_lengths", "H"),
+        ("names", "B"),
+        ("pages", "B"),
+        # the search index: sorted tokens, song ids per token,
+        # sorted trigrams, token numbers per trigram, tokens per song
+        ("token_offsets", "I"),
+        ("tokens", "B"),
+        ("posting_offsets", "I"),
+        ("postings", "i"),
+        ("trigram_offsets", "I"),
+        ("trigrams", "B"),
+        ("trigram_token_offsets", "I"),
+        ("trigram_tokens", "i"),
+        ("token_counts", "H"),
+        # shard keys as json, shard number per song
+        ("shard_keys", "B"),
+        ("shard_numbers", "H"),
+    )
+    COUNTS = struct.Struct(f"<{len(SECTIONS)}I")
+
+    mapped: mmap.mmap
+    tables: dict[str, memoryview]
+    ids: memoryview
+    positions: memoryview
+    offsets: memoryview
+    artist_lengths: memoryview
+    names: memoryview
+    pages_blob: memoryview
+
+    def __init__(self, mapped: mmap.mmap):
+        self.mapped = mapped
+        view = memoryview(mapped)
+        counts = self.COUNTS.unpack_from(mapped, self.HEADER.size)
+        start = self.HEADER.size + self.COUNTS.size
+        self.tables = {}
+        for (name, fmt), count in zip(self.SECTIONS, counts):
+            end = start + struct.calcsize(fmt) * count
+            self.tables[name] = view[start:end].cast(fmt)
+            start = -(-end // 8) * 8
+        self.ids = self.tables["ids"]
+        self.positions = self.tables["positions"]
+        self.offsets = self.tables["offsets"]
+        self.artist_lengths = self.tables["artist_lengths"]
+        self.names = self.tables["names"]
+        self.pages_blob = self.tables["pages"]
+
+    @staticmethod
+    def digest(key: list) -> bytes:
+        return hashlib.sha1(json.dumps([sys.byteorder, key]).encode()).digest()
+
+    @classmethod
+    def open(cls, path: str, key: list) -> "SongCatalog | None":
+        """None if there is no compiled file for this key"""
+        try:
+            fh = open(path, mode="rb")
+        except FileNotFoundError:
+            return None
+        with fh:
+            if os.fstat(fh.fileno()).st_size < cls.HEADER.size + cls.COUNTS.size:
+                return None
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, digest = cls.HEADER.unpack_from(mapped)
+        if magic != cls.MAGIC or version != cls.VERSION or digest != cls.digest(key):
+            mapped.close()
+            return None
+        return cls(mapped)
+
+    @staticmethod
+    def string_table(strings: Iterable[str]) -> tuple[array.array, bytes]:
+        offsets = array.array("I", [0])
+        blob = bytearray()
+        for text in strings:
+            blob += text.encode()
+            offsets.append(len(blob))
+        return offsets, bytes(blob)
+
+    @staticmethod
+    def group_table(groups: Iterable[Iterable[int]]) -> tuple[array.array, array.array]:
+        offsets = array.array("I", [0])
+        values = array.array("i")
+        for group in groups:
+            values.extend(sorted(group))
+            offsets.append(len(values))
+        return offsets, values
+
+    @classmethod
+    def compile(
+        cls,
+        path: str,
+        key: list,
+        songs: list,
+        pages: dict[str, str],
+        shard_of: dict[int, str] | None = None,
+    ):
+        """
+        songs: (id, artist, title) in catalog order, shard_of: song id -> shard key.
+        written atomically, running bots keep their old map
+        """
+        ids = array.array("i", (idx for idx, _, _ in songs))
+        positions = array.array("i", [-1]) * (max(ids, default=0) + 1)
+        for position, idx in enumerate(ids):
+            positions[idx] = position
+        offsets = array.array("I", [0])
+        artist_lengths = array.array("H")
+        names = bytearray()
+        for _, artist, title in songs:
+            encoded = artist.encode()
+            names += encoded + b" - " + title.encode()
+            artist_lengths.append(len(encoded))
+            offsets.append(len(names))
+
+        index = SongIndex((idx, f"{artist} - {title}") for idx, artist, title in songs)
+        token_numbers = {token: number for number, token in enumerate(index.vocabulary)}
+        trigram_keys = sorted(index.trigrams)
+        token_offsets, tokens = cls.string_table(index.vocabulary)
+        posting_offsets, postings = cls.group_table(
+            index.postings[token] for token in index.vocabulary
+        )
+        trigram_offsets, trigrams = cls.string_table(trigram_keys)
+        trigram_token_offsets, trigram_tokens = cls.group_table(
+            (token_numbers[token] for token in index.trigrams[trigram])
+            for trigram in trigram_keys
+        )
+        token_counts = array.array(
+            "H", (min(index.lengths[idx], 0xFFFF) for idx in ids)
+        )
+
+        shard_of = shard_of or {}
+        shard_keys = sorted(set(shard_of.values()) | {""})
+        shard_number = {shard: number for number, shard in enumerate(shard_keys)}
+        shard_numbers = array.array(
+            "H", (shard_number[shard_of.get(idx, "")] for idx in ids)
+        )
+
+        sections = [
+            ids,
+            positions,
+            offsets,
+            artist_lengths,
+            bytes(names),
+            json.dumps(pages).encode(),
+            token_offsets,
+            tokens,
+            posting_offsets,
+            postings,
+            trigram_offsets,
+            trigrams,
+            trigram_token_offsets,
+            trigram_tokens,
+            token_counts,
+            json.dumps(shard_keys).encode(),
+            shard_numbers,
+        ]
+        parts = [
+            cls.HEADER.pack(cls.MAGIC, cls.VERSION, cls.digest(key)),
+            cls.COUNTS.pack(*(len(section) for section in sections)),
+        ]
+        for section in sections:
+            blob = section.tobytes() if isinstance(section, array.array) else section
+            parts.append(blob + bytes(-len(blob) % 8))
+        write_atomic(path, b"".join(parts))
+
+    def position(self, song_id) -> int:
+        if isinstance(song_id, int) and 0 <= song_id < len(self.positions):
+            return self.positions[song_id]
+        return -1
+
+    def __getitem__(self, song_id: int) -> str:
+        if (position := self.position(song_id)) < 0:
+            raise KeyError(song_id)
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return str(self.names[start:end], "utf-8")
+
+    def __contains__(self, song_id) -> bool:
+        return self.position(song_id) >= 0
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def entries(self) -> Iterator[tuple[int, str, str]]:
+        """(id, artist, title) in catalog order"""
+        for position, idx in enumerate(self.ids):
+            start, end = self.offsets[position], self.offsets[position + 1]
+            split = start + self.artist_lengths[position]
+            # the names are "artist - title"
+            title = split + 3
+            yield idx, str(self.names[start:split], "utf-8"), str(
+                self.names[title:end], "utf-8"
+            )
+
+    def pages(self) -> dict[str, str]:
+        return json.loads(str(self.pages_blob, "utf-8"))
+
+    def index(self) -> "SongIndex":
+        """the compiled search index, reading from the map"""
+        tables = self.tables
+        vocabulary = _StringTable(tables["token_offsets"], tables["tokens"])
+        return SongIndex.from_tables(
+            postings=_Groups(
+                vocabulary, tables["posting_offsets"], tables["postings"], _SortedInts
+            ),
+            vocabulary=vocabulary,
+            trigrams=_Groups(
+                _StringTable(tables["trigram_offsets"], tables["trigrams"]),
+                tables["trigram_token_offsets"],
+                tables["trigram_tokens"],
+                functools.partial(_Tokens, vocabulary=vocabulary),
+            ),
+            lengths=_CatalogColumn(self, tables["token_counts"]),
+        )
+
+    def shard_of(self) -> Mapping[int, str]:
+        """song id -> shard key"""
+        shard_keys = json.loads(str(self.tables["shard_keys"], "utf-8"))
+        return _CatalogColumn(self, self.tables["shard_numbers"], shard_keys)
+
+
+class Songs(Mapping):
+    """
+    song id -> "Artist - Title", read from the songlist csv.
+    parsing and building the markdown is cached in cache_path, keyed by the csv path, size and mtime
+    (plus everything else that ends up in the markdown), so a restart with an unchanged csv is one json load.
+    with catalog_path the songs are compiled into a SongCatalog file instead and mmap'd, names are
+    only decoded when asked for, the search index and shard lookup are read from the same map.
+
+    big catalogs can be split over several notes: shards="letter" makes one note per first letter
+    of the artist, shards="page" one per page_size songs. a small index note links them all.
+    every note only goes out when its content hash changed
+    """
+
+    CACHE_VERSION = 3
+
+    names: dict[int, str] | SongCatalog
+    note: HackMDNote | None
+    shard_notes: dict[str, HackMDNote]
+    pages: dict[str, str]
+    csvpath: str
+    markdown_start: list
+    list_title: str
+    shards: str
+    page_size: int
+    ids: SongIds
+    shard_of: Mapping[int, str]
+    index: SongIndex
+
+    def __init__(
+        self,
+        csv_path: str,
+        hackmd_client: HackMDClient,
+        bot_prefix: str,
+        cfsm: bool = False,
+        delimiter: str = ";",
+        hackmd_tags: str = "requestnonsense",
+        list_title: str = "List",
+        instruments: list[str] = [],
+        cache_path: str = "",
+        note_registry: NoteRegistry | None = None,
+        shards: str = "",
+        page_size: int = 500,
+        note_name: str = "songlist",
+        ids_path: str = "",
+        catalog_path: str = "",
+        ids: SongIds | None = None,
+    ):
+        """
+        ids_path: json file with the song ids (see SongIds), without it ids hold across reloads
+        but not across restarts.
+        catalog_path: compiled catalog file (see SongCatalog), shared by every process using it.
+        ids: the SongIds of the previous load of this songlist, see carried_ids
+        """
+        self.list_title = list_title
+        self.ids = ids if ids is not None else SongIds(ids_path)
+        self.shards = shards
+        self.page_size = page_size
+        self.markdown_start = self.markdown_head(hackmd_tags, list_title)
+
+        self.csvpath = csv_path
+        self.names = {}
+        self.note = None
+        self.shard_notes = {}
+        self.shard_of = {}
+        self.pages = {}
+        self.index = SongIndex()
+        if os.path.exists(self.csvpath):
+            stat = os.stat(self.csvpath)
+            cache_key = [
+                self.CACHE_VERSION,
+                os.path.abspath(self.csvpath),
+                stat.st_size,
+                stat.st_mtime_ns,
+                cfsm,
+                delimiter,
+                instruments,
+                bot_prefix,
+                self.markdown_start,
+                shards,
+                page_size,
+            ]
+            catalog = (
+                SongCatalog.open(catalog_path, cache_key) if catalog_path else None
+            )
+            if catalog is not None:
+                self.pages = catalog.pages()
+                if ids_path and not os.path.exists(ids_path):
+                    self.ids.adopt(list(catalog.entries()))
+            elif (cached := self.load_cache(cache_path, cache_key)) is not None:
+                songs, self.pages = cached
+                self.ids.adopt(songs)
+            else:
+                songs = self.read_csv(cfsm, delimiter, instruments)
+                self.pages = self.build_pages(songs, bot_prefix, hackmd_tags)
+                if cache_path:
+                    cache = {"key": cache_key, "songs": songs, "pages": self.pages}
+                    write_atomic(cache_path, json.dumps(cache).encode())
+
+            if catalog_path and catalog is None:
+                SongCatalog.compile(
+                    catalog_path, cache_key, songs, self.pages, self.shard_keys(songs)
+                )
+                if (catalog := SongCatalog.open(catalog_path, cache_key)) is None:
+                    # another process put a catalog for a different csv there in the meantime
+                    print(
+                        f"{catalog_path}: Katalog überschrieben, Songliste bleibt im Speicher"
+                    )
+            if catalog is not None:
+                self.names = catalog
+                self.shard_of = catalog.shard_of()
+                self.index = catalog.index()
+            else:
+                self.names = {
+                    idx: f"{artist} - {title}" for idx, artist, title in songs
+                }
+                self.shard_of = self.shard_keys(songs)
+                self.index = SongIndex(self.items())
+            for key, page in self.pages.items():
+                if key:
+                    self.shard_notes[key] = HackMDNote(
+                        page,
+                        hackmd_client,
+                        name=f"{note_name}:{key}",
+                        registry=note_registry,
+                    )
+            self.note = HackMDNote(
+                self.pages.get("", ""),
+                hackmd_client,
+                name=note_name,
+                registry=note_registry,
+            )
+
+    def __getitem__(self, song_id: int) -> str:
+        return self.names[song_id]
+
+    def __contains__(self, song_id) -> bool:
+        return song_id in self.names
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def get(self, song_id: int, default=None):
+        return self.names.get(song_id, default)
+
+    def carried_ids(self) -> SongIds:
+        """the ids for reloading this songlist, known songs keep their id even without an id file"""
+        if isinstance(self.names, SongCatalog) and not self.ids.ids:
+            # opened straight from the catalog, nothing went through the ids yet
+            self.ids.adopt(list(self.names.entries()))
+        return self.ids
+
+    def shard_keys(self, songs: list) -> dict[int, str]:
+        """song id -> shard key ("" without shards)"""
+        if not self.shards:
+            return dict.fromkeys((idx for idx, _, _ in songs), "")
+        return {
+            idx: key
+            for key, members in self.split(songs).items()
+            for idx, _, _ in members
+        }
+
+    @staticmethod
+    def markdown_head(hackmd_tags: str, title: str) -> list[str]:
+        return [
+            f"---\ntags: {hackmd_tags}\n---",
+            "\n {% hackmd theme-dark %} \n",
+            f"""# {title}
+
+Such dir einen Song raus, kopier das Request-Command und fügs im Chat ein.
+
+
+
+| Artist | Title | Command&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp; |
+| --- | --- | --- |""",
+        ]
+
+    @staticmethod
+    def letter(artist: str) -> str:
+        tokens = SongIndex.tokenize(artist)
+        first = tokens[0][0].upper() if tokens else "#"
+        return first if "A" <= first <= "Z" else "#"
+
+    def split(self, songs: list) -> dict[str, list]:
+        """shard key -> songs, songs come sorted by artist and title"""
+        split = defaultdict(list)
+        for position, song in enumerate(songs):
+            if self.shards == "letter":
+                split[self.letter(song[1])].append(song)
+            else:
+                split[str(position // self.page_size + 1)].append(song)
+        return dict(split)
+
+    def build_pages(self, songs: list, bot_prefix: str, hackmd_tags: str) -> dict:
+        if not self.shards:
+            parts = {"": (self.markdown_start, songs)}
+        else:
+            parts = {
+                key: (
+                    self.markdown_head(
+                        hackmd_tags, f"{self.list_title} - {self.shard_label(key)}"
+                    ),
+                    members,
+                )
+                for key, members in self.split(songs).items()
+            }
+            # the index note is rendered on publish, it needs the shard urls
+            parts[""] = (self.markdown_start[:2], [])
+
+        pages = {}
+        with metrics.timer("requestnonsense_markdown_seconds", note="songlist"):
+            for key, (head, members) in parts.items():
+                markdown = head[:]
+                for idx, artist, title in members:
+                    markdown.append(
+                        f"| {artist} | {title} | {bot_prefix}request {idx} |"
+                    )
+                pages[key] = "\n".join(markdown)
+        return pages
+
+    def shard_label(self, key: str) -> str:
+        return f"Seite {key}" if self.shards == "page" else key
+
+    def index_markdown(self) -> str:
+        markdown = [
+            self.pages[""],
+            f"# {self.list_title}",
+            "",
+            "Die Liste ist aufgeteilt, such dir den passenden Teil raus.",
+            "",
+            "| Teil | Songs |",
+            "| --- | --- |",
+        ]
+        sizes = Counter(self.shard_of.values())
+        for key in sorted(self.shard_notes, key=lambda key: (len(key), key)):
+            note = self.shard_notes[key]
+            markdown.append(f"| [{self.shard_label(key)}]({note.url}) | {sizes[key]} |")
+        return "\n".join(markdown)
+
+    async def publish(self):
+        """push all notes whose content changed, shards first, the index links them"""
+        if self.note is None:
+            return
+        await asyncio.gather(*(note.create() for note in self.shard_notes.values()))
+        if self.shard_notes:
+            await self.note.update(self.index_markdown())
+        else:
+            await self.note.create()
+
+    def url_for(self, query: str) -> str:
+        """the note a viewer should look at for query, the index if we can't tell"""
+        query = query.strip()
+        if self.shards == "letter" and len(query) == 1:
+            key = self.letter(query)
+        elif self.shards and (found := self.search(query, limit=1)):
+            key = self.shard_of[found[0][0]]
+        else:
+            key = ""
+        if (note := self.shard_notes.get(key)) is not None:
+            return note.url
+        return self.url
+
+    @staticmethod
+    def load_cache(cache_path: str, cache_key: list) -> tuple[list, dict] | None:
+        if not cache_path or not os.path.exists(cache_path):
+            return None
+        try:
+            with open(cache_path, mode="rb") as fh:
+                cache = json.load(fh)
+        except ValueError:
+            return None
+        if cache.get("key") != cache_key:
+            return None
+        return cache["songs"], cache["pages"]
+
+    @staticmethod
+    def detect_encoding(path: str) -> str:
+        """CFSM likes to export UTF-16, the BOM tells us"""
+        with open(path, mode="rb") as fh:
+            head = fh.read(4)
+        if head.startswith(codecs.BOM_UTF8):
+            return "utf-8-sig"
+        if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            return "utf-16"
+        return "utf-8"
+
+    def iter_songs(
+        self, cfsm: bool, delimiter: str, instruments: list[str]
+    ) -> Iterator[tuple[str, str]]:
+        """stream (artist, title) rows from the csv, without holding the file in memory"""
+        wanted = set(instruments)
+        encoding = self.detect_encoding(self.csvpath)
+        with open(self.csvpath, encoding=encoding, errors="replace", newline="") as fh:
+            first_line = fh.readline()
+            if first_line.startswith("sep="):
+                # CFSM puts the delimiter in the first line
+                delimiter = first_line[4:].strip("\r\n") or delimiter
+                lines = fh
+            elif cfsm:
+                lines = fh
+            else:
+                lines = itertools.chain([first_line], fh)
+
+            reader = csv.reader(lines, delimiter=delimiter)
+            header = next(reader, [])
+            artist_col = header.index("Artist")
+            title_col = header.index("Title")
+            arrangements_col = header.index("Arrangements") if wanted else None
+            for row in reader:
+                if len(row) < len(header):
+                    continue
+                if wanted and wanted.isdisjoint(
+                    ARRANGEMENT_SPLIT.split(row[arrangements_col])
+                ):
+                    continue
+                yield row[artist_col], row[title_col]
+
+    def read_csv(self, cfsm: bool, delimiter: str, instruments: list[str]) -> list:
+        """(id, artist, title) for every song, sorted by artist and title"""
+        # use set to ensure uniqueness and prevent nonsense
+        song_set = set(self.iter_songs(cfsm, delimiter, instruments))
+        return self.ids.assign(song_set)
+
+    def search(self, query: str, limit: int = 5) -> list[tuple[int, float]]:
+        return self.index.search(query, limit)
+
+    @property
+    def url(self):
+        return self.note.url
+
+
+LIVE_PAGE = """<!doctype html>
+<html lang="de">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; background: #1e1e1e; color: #eee; }}
+table {{ border-collapse: collapse; }}
+td, th {{ padding: 0.2em 0.8em; border-bottom: 1px solid #444; text-align: left; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+<table>
+<thead><tr>{head}</tr></thead>
+<tbody id="rows">{rows}</tbody>
+</table>
+{script}
+</body>
+</html>
+"""
+
+LIVE_SCRIPT = """<script>
+const rows = document.getElementById("rows");
+function row(song, user) {
+  const tr = document.createElement("tr");
+  for (const text of ["", song, user]) {
+    const td = document.createElement("td");
+    td.textContent = text;
+    tr.appendChild(td);
+  }
+  return tr;
+}
+function renumber() {
+  [...rows.children].forEach((tr, idx) => { tr.firstChild.textContent = idx + 1; });
+}
+const events = new EventSource("events");
+events.addEventListener("snapshot", (event) => {
+  rows.replaceChildren(...JSON.parse(event.data).map(([song, user]) => row(song, user)));
+  renumber();
+});
+events.addEventListener("diff", (event) => {
+  for (const [op, pos, song, user] of JSON.parse(event.data)) {
+    if (op === "add") rows.insertBefore(row(song, user), rows.children[pos] || null);
+    else rows.children[pos].remove();
+  }
+  renumber();
+});
+</script>"""
+
+
+class _Bucket:
+    """token bucket, refilled lazily whenever somebody asks"""
+
+    __slots__ = ("tokens", "stamp", "text", "text_stamp")
+
+    def __init__(self, tokens: float, stamp: float):
+        self.tokens = tokens
+        self.stamp = stamp
+        self.text = ""
+        self.text_stamp = 0.0
+
+    def refill(self, rate: float, burst: float, now: float):
+        self.tokens = min(burst, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+
+    def take(self, rate: float, burst: float, now: float) -> bool:
+        self.refill(rate, burst, now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter:
+    """
+    sits in front of the chat commands so a raid or a few spammers can't starve everyone else.
+    every user has a bucket, every command has one per channel, mods skip all of it.
+    the same message from the same user within dedup_window is dropped without a word,
+    the first one gets answered anyway. users idle for longer than it takes to refill
+    their bucket are forgotten, so memory only grows with the users currently chatting
+    """
+
+    OK = "ok"
+    DUPLICATE = "duplicate"
+    SHED = "shed"
+
+    user_rate: float
+    user_burst: float
+    command_rate: float
+    command_burst: float
+    dedup_window: float
+    idle: float
+    users: dict[str, _Bucket]
+    commands: dict[tuple[str, str], _Bucket]
+
+    def __init__(
+        self,
+        user_rate: float = 0.2,
+        user_burst: float = 3,
+        command_rate: float = 2.0,
+        command_burst: float = 10,
+        dedup_window: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.command_rate = command_rate
+        self.command_burst = command_burst
+        self.dedup_window = dedup_window
+        self.idle = max(dedup_window, user_burst / user_rate)
+        self.clock = clock
+        # insertion order is last-seen order, the idle users are always in front
+        self.users = {}
+        self.commands = {}
+
+    def expire(self, now: float):
+        # a few per call is enough to keep up, and keeps every check O(1)
+        for user, bucket in list(itertools.islice(self.users.items(), 64)):
+            if now - bucket.stamp < self.idle:
+                break
+            del self.users[user]
+
+    def check(
+        self, channel: str, user: str, command: str, text: str, is_mod: bool = False
+    ) -> str:
+        if is_mod:
+            return self.OK
+        now = self.clock()
+        self.expire(now)
+        bucket = self.users.pop(user, None)
+        if bucket is None:
+            bucket = _Bucket(self.user_burst, now)
+        self.users[user] = bucket
+
+        text = " ".join(text.lower().split())
+        if text == bucket.text and now - bucket.text_stamp < self.dedup_window:
+            bucket.refill(self.user_rate, self.user_burst, now)
+            return self.DUPLICATE
+        if not bucket.take(self.user_rate, self.user_burst, now):
+            return self.SHED
+        bucket.text, bucket.text_stamp = text, now
+
+        key = (channel, command)
+        if (shared := self.commands.get(key)) is None:
+            shared = self.commands[key] = _Bucket(self.command_burst, now)
+        if not shared.take(self.command_rate, self.command_burst, now):
+            return self.SHED
+        return self.OK
+
+
+class ChatSender:
+    """
+    every reply for one channel goes through here. twitch drops messages above 20 per 30 seconds
+    (100 if the bot is a mod there), so we keep the send times of the last window and wait for a slot.
+    when more than merge_backlog replies are waiting, as many as fit go out as one message,
+    "@a, @b: ... | @c: ...". replies never overtake each other, so every user reads them in order
+    """
+
+    MENTION = re.compile(r"@(\w+): (.*)", re.DOTALL)
+    MAX_LENGTH = 500
+
+    pending: deque[str]
+    sent: deque[float]
+    _task: asyncio.Task | None
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable],
+        is_mod: Callable[[], bool] = lambda: False,
+        limit: int = 20,
+        mod_limit: int = 100,
+        window: float = 30.0,
+        merge_backlog: int = 2,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._send = send
+        self.is_mod = is_mod
+        self.limit = limit
+        self.mod_limit = mod_limit
+        self.window = window
+        self.merge_backlog = merge_backlog
+        self.clock = clock
+        self.pending = deque()
+        self.sent = deque()
+        self._task = None
+
+    @property
+    def backlog(self) -> int:
+        return len(self.pending)
+
+    def send(self, message: str):
+        self.pending.append(message)
+        if self.backlog == self.limit + 1:
+            print(f"Chat hängt hinterher: {self.backlog} Antworten warten")
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while self.pending:
+            with metrics.timer("requestnonsense_chat_wait_seconds"):
+                await self.wait_for_slot()
+            message = self.next_message()
+            self.sent.append(self.clock())
+            try:
+                await self._send(message)
+                metrics.inc("requestnonsense_chat_messages_total")
+            except Exception as e:
+                metrics.inc("requestnonsense_chat_errors_total")
+                print(f"Nachricht nicht gesendet: {e}")
+
+    async def wait_for_slot(self):
+        limit = self.mod_limit if self.is_mod() else self.limit
+        while True:
+            now = self.clock()
+            while self.sent and now - self.sent[0] >= self.window:
+                self.sent.popleft()
+            if len(self.sent) < limit:
+                return
+            await asyncio.sleep(self.sent[0] + self.window - now)
+
+    def next_message(self) -> str:
+        if self.backlog <= self.merge_backlog:
+            return self.pending.popleft()
+        # (body, users), neighbouring replies with the same text share one mention list
+        pieces: list[tuple[str, list[str]]] = []
+        while self.pending:
+            user, body = None, self.pending[0]
+            if match := self.MENTION.fullmatch(body):
+                user, body = match.groups()
+            if pieces and pieces[-1][0] == body:
+                users = pieces[-1][1]
+                candidate = pieces[:-1] + [
+                    (body, users + [user] if user and user not in users else users)
+                ]
+            else:
+                candidate = pieces + [(body, [user] if user else [])]
+            if pieces and len(self.join(candidate)) > self.MAX_LENGTH:
+                break
+            self.pending.popleft()
+            pieces = candidate
+        return self.join(pieces)
+
+    @classmethod
+    def join(cls, pieces: list[tuple[str, list[str]]]) -> str:
+        return " | ".join(cls.render(body, users) for body, users in pieces)
+
+    @staticmethod
+    def render(body: str, users: list[str]) -> str:
+        if not users:
+            return body
+        return ", ".join(f"@{user}" for user in users) + f": {body}"
+
+
+class RequestChannel:
+    """one twitch channel: its queue and its songlist, which it may share with other channels"""
+
+    name: str
+    queue: RequestQueue | None
+    songs: Songs | None
+    ready: asyncio.Event
+
+    def __init__(
+        self, name: str, queue: RequestQueue | None = None, songs: Songs | None = None
+    ):
+        self.name = name
+        self.queue = queue
+        self.songs = songs
+        # set once queue and songs are loaded, see Bot.prepare
+        self.ready = asyncio.Event()
+        if queue is not None:
+            self.ready.set()
 
-    def insert(self, position: int, item: RequestTuple):
-        self.data.insert(position, item)
 
-    def remove(self, item: RequestTuple):
-        self.data.remove(item)
+class LiveServer:
+    """
+    queue and songlist as web pages, served from the bot's own event loop.
+    browsers (and OBS browser sources) get the queue once and then row diffs via server-sent events,
+    so a queue change costs no hackmd call at all. pages are rendered once per version and
+    served with ETag and gzip, hundreds of viewers mostly get a 304.
+    the main channel lives at /, every other channel at /<channel>/
+    """
 
-    def get_first(self) -> RequestTuple:
-        return self.get_element(0)
+    CLIENT_BACKLOG = 100
+    KEEPALIVE = 15.0
 
-    def get_element(self, idx: int) -> RequestTuple:
-        return self.data[idx]
+    channels: dict[str, RequestChannel]
+    main: str
+    command_prefix: str
+    host: str
+    port: int
+    versions: dict[str, int]
+    clients: dict[str, set[asyncio.Queue]]
+    _pages: dict[tuple[str, str], tuple[int, str, bytes, bytes]]
+    _runner: web.AppRunner | None
 
-    def get_random(self) -> RequestTuple:
-        return random.choice(self.data)
+    def __init__(
+        self,
+        channels: dict[str, RequestChannel],
+        main: str,
+        command_prefix: str = "?",
+        host: str = "127.0.0.1",
+        port: int = 8080,
+    ):
+        self.channels = channels
+        self.main = main
+        self.command_prefix = command_prefix
+        self.host = host
+        self.port = port
+        self.versions = {}
+        self.clients = {}
+        self._pages = {}
+        self._runner = None
+        self.app = web.Application()
+        for prefix in ("", "/{channel}"):
+            self.app.router.add_get(f"{prefix}/", self.queue_page)
+            self.app.router.add_get(f"{prefix}/songs", self.songs_page)
+            self.app.router.add_get(f"{prefix}/queue.json", self.queue_json)
+            self.app.router.add_get(f"{prefix}/events", self.events)
+        for name, channel in channels.items():
+            self.versions[name] = 0
+            self.clients[name] = set()
+            if channel.queue is not None:
+                self.watch(name)
 
-    def sort(self):
-        self.data.sort()
+    def watch(self, name: str):
+        """channels that are still loading get hooked up once their queue is there"""
+        self.channels[name].queue.listeners.append(
+            lambda diffs: self.queue_changed(name, diffs)
+        )
 
-    def len(self) -> int:
-        return len(self.data)
+    async def start(self):
+        if self._runner is not None:
+            return
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        # port 0 means "any free port"
+        self.port = self._runner.addresses[0][1]
+        print(f"Live-Queue unter http://{self.host}:{self.port}/")
 
-    def get_index_for_user(self, user: str) -> int | None:
-        for idx, entry in enumerate(self.data, start=1):
-            if entry.requestee == user:
-                return idx
-        return None
+    async def stop(self):
+        for clients in self.clients.values():
+            for client in list(clients):
+                self.disconnect(clients, client)
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
 
-    def get_request_for_user(self, user: str) -> RequestTuple | None:
-        for entry in self.data:
-            if entry.requestee == user:
-                return entry
-        return None
+    def path(self, name: str) -> str:
+        return "/" if name == self.main else f"/{name}/"
 
-    def safe_queue(self):
-        with open(self.queue_path, mode="wb") as fh:
-            pickle.dump(self.data, fh)
-        self.note.update(self.generate_requests_markdown())
+    def channel(self, request: web.Request) -> str:
+        name = request.match_info.get("channel", self.main).lower()
+        if name not in self.channels:
+            raise web.HTTPNotFound()
+        if not self.channels[name].ready.is_set():
+            raise web.HTTPServiceUnavailable(headers={"Retry-After": "2"})
+        return name
 
-    def generate_requests_markdown(self) -> str:
-        if len(self.data) == 0:
-            return f"---\ntags: {self.hackmd_tags}\n---# {self.queue_title}\n Beeindruckend leer hier"
-        requests_markdown = [
-            f"---\ntags: {self.hackmd_tags}\n---# {self.queue_title}",
-            "",
-            "| Pos | Song | User |",
-            "| --- | --- | --- |",
+    def queue_rows(self, name: str) -> list[tuple[str, str]]:
+        queue = self.channels[name].queue
+        return [
+            (queue.song_name(request.song_id), request.requestee)
+            for request in queue.data
         ]
-        for idx, request in enumerate(self.data, start=1):
-            requests_markdown.append(
-                f"| {idx} | {request.song} | {request.requestee} |"
-            )
 
-        return "\n".join(requests_markdown)
+    def queue_changed(self, name: str, diffs: list[tuple]):
+        self.versions[name] += 1
+        if not diffs:
+            return
+        song_name = self.channels[name].queue.song_name
+        message = self.sse(
+            "diff",
+            [
+                (op, position, song_name(request.song_id), request.requestee)
+                for op, position, request in diffs
+            ],
+        )
+        clients = self.clients[name]
+        for client in list(clients):
+            try:
+                client.put_nowait(message)
+            except asyncio.QueueFull:
+                # way behind, drop it. the browser reconnects and gets a fresh snapshot
+                self.disconnect(clients, client)
 
-    def process_request(self, song: str, requestee: str) -> str:
-        waiting = True
-        non_prio = True
-        moment = time.time()
+    @staticmethod
+    def disconnect(clients: set[asyncio.Queue], client: asyncio.Queue):
+        clients.discard(client)
+        while not client.empty():
+            client.get_nowait()
+        client.put_nowait(None)
 
-        if (request := self.get_request_for_user(requestee)) is not None:
-            request_tuple = RequestTuple(
-                request.waiting,
-                request.non_prio,
-                request.timestamp,
-                song,
-                requestee,
-            )
-            self.append(request_tuple)
-            self.remove(request)
-            self.sort()
-            message = f"@{requestee}: Dein Request wurde aktualisiert zu {song}"
-        else:
-            request_tuple = RequestTuple(waiting, non_prio, moment, song, requestee)
-            self.append(request_tuple)
-            message = f"@{requestee}: Dein Request für {song} ist eingetragen."
+    @staticmethod
+    def sse(event: str, data) -> bytes:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
 
-        self.safe_queue()
-        return message
+    def cached(
+        self, name: str, page_name: str, version: int, build: Callable[[], str]
+    ) -> tuple[str, bytes, bytes]:
+        if (page := self._pages.get((name, page_name))) is None or page[0] != version:
+            body = build().encode()
+            etag = f'"{page_name}-{hashlib.sha1(body).hexdigest()[:16]}"'
+            page = (version, etag, body, gzip.compress(body))
+            self._pages[(name, page_name)] = page
+        return page[1:]
 
-    def process_upgrade(self, requestee: str, author: str) -> str:
-        if (request := self.get_request_for_user(requestee)) is not None:
-            self.remove(request)
-            self.append(
-                RequestTuple(
-                    request.waiting,
-                    False,
-                    request.timestamp,
-                    request.song,
-                    request.requestee,
-                )
-            )
-            self.sort()
-            self.safe_queue()
-            print(f"Der Request von {request.requestee} hat jetzt prio")
-            message = f"@{author}: Der Request von {request.requestee} hat jetzt prio"
-        else:
-            print(f"{requestee} hat keine Request in der Warteschlange")
-            message = f"@{author}: {requestee} hat keine Request in der Warteschlange"
-        return message
+    @staticmethod
+    def respond(
+        request: web.Request, page: tuple[str, bytes, bytes], content_type: str
+    ) -> web.Response:
+        etag, body, zipped = page
+        # the body depends on Accept-Encoding, caches have to keep both variants apart
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers=headers)
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            body = zipped
+        return web.Response(body=body, headers=headers, content_type=content_type)
 
-    def advance_queue(self, next_song: RequestTuple) -> str:
-        if len(self.data) > 0:
-            top_song = self.get_first()
-            if not top_song.waiting:
-                # [0] is waiting -> not waiting -> song was active
-                self.remove(top_song)
-                if len(self.data) == 0:
-                    # no more songs left, säd
-                    message = "Queue leer, säd"
-                    print(message)
-                    self.safe_queue()
-                    return message
-            if next_song not in self.data:
-                message = f"{next_song.song} is nicht (mehr) in der Queue. Upsi."
-                print(message)
-                self.safe_queue()
-                return message
+    def render_queue(self, name: str) -> str:
+        rows = "".join(
+            f"<tr><td>{idx}</td><td>{html.escape(song)}</td>"
+            f"<td>{html.escape(user)}</td></tr>"
+            for idx, (song, user) in enumerate(self.queue_rows(name), start=1)
+        )
+        return LIVE_PAGE.format(
+            title=html.escape(self.channels[name].queue.queue_title),
+            head="<th>Pos</th><th>Song</th><th>User</th>",
+            rows=rows,
+            script=LIVE_SCRIPT,
+        )
 
-            self.remove(next_song)
-            self.append(
-                RequestTuple(
-                    False,
-                    next_song.non_prio,
-                    next_song.timestamp,
-                    next_song.song,
-                    next_song.requestee,
-                )
-            )
-            self.sort()
-            message = (
-                f"Nächster Song: {next_song.song} requestet von {next_song.requestee}"
-            )
-            self.safe_queue()
-        else:
-            message = "Queue leer, säd"
-        print(message)
+    def render_songs(self, name: str) -> str:
+        songs = self.channels[name].songs
+        rows = "".join(
+            f"<tr><td>{html.escape(song)}</td>"
+            f"<td>{html.escape(self.command_prefix)}request {song_id}</td></tr>"
+            for song_id, song in songs.items()
+        )
+        return LIVE_PAGE.format(
+            title=html.escape(songs.list_title),
+            head="<th>Song</th><th>Command</th>",
+            rows=rows,
+            script="",
+        )
 
-        return message
+    def songs_changed(self):
+        for key in [key for key in self._pages if key[1] == "songs"]:
+            del self._pages[key]
 
+    async def queue_page(self, request: web.Request) -> web.Response:
+        name = self.channel(request)
+        page = self.cached(
+            name, "queue", self.versions[name], lambda: self.render_queue(name)
+        )
+        return self.respond(request, page, "text/html")
 
-class Songs(dict):
-    note: HackMDNote
-    csvpath: str
-    markdown_start: list
+    async def songs_page(self, request: web.Request) -> web.Response:
+        name = self.channel(request)
+        page = self.cached(name, "songs", 0, lambda: self.render_songs(name))
+        return self.respond(request, page, "text/html")
 
-    def __init__(
-        self,
-        csv_path: str,
-        hackmd_token: str,
-        bot_prefix: str,
-        cfsm: bool = False,
-        delimiter: str = ";",
-        hackmd_tags: str = "requestnonsense",
-        list_title: str = "List",
-        instruments: list[str] = [],
-    ):
-        self.markdown_start = [
-            f"---\ntags: {hackmd_tags}\n---",
-            "\n {% hackmd theme-dark %} \n",
-            f"""# {list_title}
+    async def queue_json(self, request: web.Request) -> web.Response:
+        name = self.channel(request)
+        page = self.cached(
+            name,
+            "json",
+            self.versions[name],
+            lambda: json.dumps(self.queue_rows(name)),
+        )
+        return self.respond(request, page, "application/json")
 
-Such dir einen Song raus, kopier das Request-Command und fügs im Chat ein.
+    async def events(self, request: web.Request) -> web.StreamResponse:
+        name = self.channel(request)
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+        )
+        await response.prepare(request)
+        clients = self.clients[name]
+        client = asyncio.Queue(maxsize=self.CLIENT_BACKLOG)
+        clients.add(client)
+        try:
+            await response.write(self.sse("snapshot", self.queue_rows(name)))
+            while True:
+                try:
+                    message = await asyncio.wait_for(client.get(), self.KEEPALIVE)
+                except asyncio.TimeoutError:
+                    message = b": keepalive\n\n"
+                if message is None:
+                    break
+                await response.write(message)
+        except ConnectionResetError:
+            pass
+        finally:
+            clients.discard(client)
+        return response
 
 
+class MetricsServer:
+    """
+    /metrics in the prometheus text format. this gets its own port on localhost,
+    the live pages may well be reachable from the internet
+    """
 
-| Artist | Title | Command&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp; |
-| --- | --- | --- |""",
-        ]
+    metrics: Metrics
+    host: str
+    port: int
+    _runner: web.AppRunner | None
 
-        self.csvpath = csv_path
-        if os.path.exists(self.csvpath):
-            with open(self.csvpath) as fh:
-                start = 1 if cfsm else 0
-                csv_lines = fh.readlines()[start:]
-            reader = csv.DictReader(csv_lines, delimiter=delimiter)
-
-            # use set to ensure uniqueness and prevent nonsense
-            song_set = set()
-            for line in reader:
-                if len(instruments) != 0:
-                    for instrument in instruments:
-                        if instrument in line["Arrangements"]:
-                            song_set.add((line.get("Artist"), line.get("Title")))
-                else:
-                    song_set.add((line.get("Artist"), line.get("Title")))
+    def __init__(self, metrics: Metrics, host: str = "127.0.0.1", port: int = 9464):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._runner = None
+        self.app = web.Application()
+        self.app.router.add_get("/metrics", self.handle)
 
-            markdown = self.markdown_start[:]
-            for idx, song in enumerate(sorted(song_set), start=1):
-                self[idx] = f"{song[0]} - {song[1]}"
-                markdown.append(
-                    f"| {song[0]} | {song[1]} | {bot_prefix}request {idx} |"
-                )
+    async def start(self):
+        if self._runner is not None:
+            return
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.port = self._runner.addresses[0][1]
+        print(f"Metriken unter http://{self.host}:{self.port}/metrics")
 
-            self.note = HackMDNote("\n".join(markdown), api_token=hackmd_token)
-            print(f"Songlist ready, see {self.note.url}")
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
 
-    @property
-    def url(self):
-        return self.note.url
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.metrics.render(), content_type="text/plain")
 
 
 class Bot(commands.Bot):
+    """
+    one bot process can serve several channels. each channel has its own queue (file and note),
+    channels with the same songlist csv and instruments share one Songs catalog,
+    all notes go through one HackMDClient connection pool
+    """
+
+    SHED_DELAY = 3.0
+    STARTUP_WAIT = 5.0
+    # commands that don't touch queue or songlist, they work while the bot is still loading
+    WITHOUT_QUEUE = ("meow", "rules")
+
     message_prefix: str
-    queue: RequestQueue
-    songs: Songs
+    command_prefix: str
+    hackmd: HackMDClient
+    hackmd_enabled: bool
+    channels: dict[str, RequestChannel]
+    main_channel: str
+    catalogs: list[Songs]
+    live: LiveServer | None
+    metrics_server: MetricsServer | None
+    public_url: str
+    limiter: RateLimiter
+    shed: dict[str, dict[str, None]]
+    senders: dict[str, ChatSender]
+    songlist_reload: float
+    watchers: list[asyncio.Task]
+    notes_ready: asyncio.Event
+    startup: asyncio.Task | None
+    started: float
+    timings: dict[str, float]
+    _catalog_builders: dict[tuple, Callable[[], Songs]]
+    _queue_builders: dict[str, tuple[tuple, Callable[..., RequestQueue]]]
 
     def __init__(
         self,
@@ -348,43 +3807,455 @@ class Bot(commands.Bot):
         queue_title: str = "Queue",
         message_prefix: str = "",
         instruments: list[str] = [],
+        usage_path: str = "./hackmd_usage.json",
+        monthly_budget: int = 1000,
+        publish_window: float = 5.0,
+        queue_storage: str = "binary",
+        journal_compact_bytes: int = 64 * 1024,
+        catalog_cache: str = "",
+        notes_path: str = "./hackmd_notes.json",
+        queue_max_rows: int = 0,
+        songlist_shards: str = "",
+        songlist_page_size: int = 500,
+        hackmd_enabled: bool = True,
+        web_enabled: bool = False,
+        web_host: str = "127.0.0.1",
+        web_port: int = 8080,
+        public_url: str = "",
+        extra_channels: list[dict] = [],
+        user_rate: float = 0.2,
+        user_burst: float = 3,
+        command_rate: float = 2.0,
+        command_burst: float = 10,
+        dedup_window: float = 5.0,
+        metrics_host: str = "127.0.0.1",
+        metrics_port: int = 0,
+        randomize_policy: str = "uniform",
+        play_history: bool = True,
+        song_cooldown: float = 0,
+        song_ids: str = "",
+        songlist_reload: float = 0,
+        catalog_file: str = "",
     ):
+        """
+        extra_channels: one dict per additional channel with "channel" and "queue_path",
+        optionally "csv_path", "instruments", "list_title" and "queue_title".
+        missing values are taken from the main channel.
+        songlist_reload: every so many seconds the songlist csv is checked for changes, 0 is off
+        """
+        specs = [
+            {
+                "channel": channel,
+                "csv_path": csv_path,
+                "queue_path": queue_path,
+                "instruments": instruments,
+                "list_title": list_title,
+                "queue_title": queue_title,
+            }
+        ]
+        specs.extend({**specs[0], **extra} for extra in extra_channels)
         super().__init__(
             token=twitch_token,
             prefix=bot_prefix,
-            initial_channels=[channel],
+            initial_channels=[spec["channel"] for spec in specs],
         )
         self.message_prefix = message_prefix
+        self.command_prefix = bot_prefix[0]
+        self.hackmd_enabled = hackmd_enabled
+        self.public_url = public_url.rstrip("/") or f"http://{web_host}:{web_port}"
+        self.hackmd = HackMDClient(
+            hackmd_token, budget=ApiBudget(usage_path, monthly_limit=monthly_budget)
+        )
+        note_registry = NoteRegistry(notes_path)
+
+        self.channels = {}
+        self.main_channel = channel.lower()
+        self.catalogs = []
+        # nothing is loaded here, prepare() builds all of this while twitchio connects
+        self._catalog_builders = {}
+        self._queue_builders = {}
+        for spec in specs:
+            name = spec["channel"].lower()
+            main = name == self.main_channel
+            catalog_key = (
+                os.path.abspath(spec["csv_path"]),
+                tuple(spec["instruments"]),
+            )
+            if catalog_key not in self._catalog_builders:
+                self._catalog_builders[catalog_key] = functools.partial(
+                    Songs,
+                    csv_path=spec["csv_path"],
+                    hackmd_client=self.hackmd,
+                    bot_prefix=bot_prefix[0],
+                    cfsm=cfsm,
+                    delimiter=delimiter,
+                    hackmd_tags=hackmd_tags,
+                    list_title=spec["list_title"],
+                    instruments=spec["instruments"],
+                    cache_path=(
+                        catalog_cache
+                        if main or not catalog_cache
+                        else f"{catalog_cache}.{name}"
+                    ),
+                    note_registry=note_registry,
+                    shards=songlist_shards,
+                    page_size=songlist_page_size,
+                    note_name="songlist" if main else f"songlist:{name}",
+                    ids_path=(
+                        song_ids if main or not song_ids else f"{song_ids}.{name}"
+                    ),
+                    catalog_path=(
+                        catalog_file
+                        if main or not catalog_file
+                        else f"{catalog_file}.{name}"
+                    ),
+                )
+            self._queue_builders[name] = (
+                catalog_key,
+                functools.partial(
+                    RequestQueue,
+                    path=spec["queue_path"],
+                    hackmd_token=hackmd_token,
+                    hackmd_tags=hackmd_tags,
+                    hackmd_queue_title=spec["queue_title"],
+                    hackmd_client=self.hackmd,
+                    publish_window=publish_window,
+                    storage=queue_storage,
+                    journal_compact_bytes=journal_compact_bytes,
+                    note_registry=note_registry,
+                    max_rows=queue_max_rows,
+                    mirror=hackmd_enabled,
+                    note_name="queue" if main else f"queue:{name}",
+                    policy=randomize_policy,
+                    history_path=(
+                        f"{spec['queue_path']}.history.sqlite" if play_history else ""
+                    ),
+                    cooldown=song_cooldown,
+                ),
+            )
+            self.channels[name] = RequestChannel(spec["channel"])
+        self.songlist_reload = songlist_reload
+        self.watchers = []
+        self.notes_ready = asyncio.Event()
+        self.startup = None
+        self.started = time.perf_counter()
+        self.timings = {}
+
+        self.limiter = RateLimiter(
+            user_rate=user_rate,
+            user_burst=user_burst,
+            command_rate=command_rate,
+            command_burst=command_burst,
+            dedup_window=dedup_window,
+        )
+        self.shed = {}
+        self.senders = {}
 
-        self.songs = Songs(
-            csv_path=csv_path,
-            hackmd_token=hackmd_token,
-            bot_prefix=bot_prefix[0],
-            cfsm=cfsm,
-            delimiter=delimiter,
-            hackmd_tags=hackmd_tags,
-            list_title=list_title,
-            instruments=instruments,
+        self.live = None
+        if web_enabled:
+            self.live = LiveServer(
+                self.channels,
+                self.main_channel,
+                command_prefix=self.command_prefix,
+                host=web_host,
+                port=web_port,
+            )
+        self.metrics_server = None
+        if metrics_port:
+            self.metrics_server = MetricsServer(
+                metrics, host=metrics_host, port=metrics_port
+            )
+
+        metrics.set("requestnonsense_chat_backlog", lambda: self.chat_backlog)
+        metrics.set(
+            "requestnonsense_hackmd_budget_used", lambda: self.hackmd.budget.calls
+        )
+        metrics.set(
+            "requestnonsense_hackmd_budget_remaining",
+            lambda: self.hackmd.budget.remaining,
+        )
+
+    @property
+    def queue(self) -> RequestQueue | None:
+        return self.channels[self.main_channel].queue
+
+    @property
+    def songs(self) -> Songs | None:
+        return self.channels[self.main_channel].songs
+
+    def run(self):
+        # twitchio only connects in run(), the loading runs next to that on the same loop
+        self.startup = self.loop.create_task(self.prepare())
+        self.startup.add_done_callback(self.startup_done)
+        super().run()
+
+    def startup_done(self, startup: asyncio.Task):
+        """
+        without songlist or queue every command would wait for a start that never finishes,
+        so a failed prepare() stops the bot. run() closes everything on the way out
+        """
+        if startup.cancelled() or (error := startup.exception()) is None:
+            return
+        print(f"Start fehlgeschlagen, Bot wird beendet: {error!r}")
+        self.loop.stop()
+
+    async def prepare(self):
+        """
+        loads catalogs and queues (csv parsing and storage loading in a thread, the event loop keeps
+        talking to twitch meanwhile), then creates all notes. every channel is usable as soon as its own queue is
+        loaded, the notes come after. each stage's time is logged and exported as a metric
+        """
+        if self.live is not None:
+            await self.live.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        loop = asyncio.get_running_loop()
+        publishing = {}
+
+        async def load_catalog(key: tuple, build: Callable[[], Songs]) -> Songs:
+            begin = time.perf_counter()
+            songs = await loop.run_in_executor(None, build)
+            self.stage_done(f"songlist {os.path.basename(key[0])}", begin)
+            self.catalogs.append(songs)
+            if self.hackmd_enabled:
+                publishing[key] = asyncio.create_task(songs.publish())
+            if self.songlist_reload:
+                self.watchers.append(
+                    asyncio.create_task(self.watch_songlist(key, songs))
+                )
+            return songs
+
+        async def load_queue(name: str, songs: asyncio.Task):
+            key, build = self._queue_builders[name]
+            channel = self.channels[name]
+            channel.songs = await songs
+            begin = time.perf_counter()
+            channel.queue = await loop.run_in_executor(
+                None, functools.partial(build, songs=channel.songs)
+            )
+            self.stage_done(f"queue {name}", begin)
+            metrics.set("requestnonsense_queue_length", channel.queue.len, channel=name)
+            if self.live is not None:
+                self.live.watch(name)
+            channel.ready.set()
+            if self.hackmd_enabled:
+                await channel.queue.note.create()
+
+        loading = {
+            key: asyncio.create_task(load_catalog(key, build))
+            for key, build in self._catalog_builders.items()
+        }
+        await asyncio.gather(
+            *(
+                load_queue(name, loading[key])
+                for name, (key, _) in self._queue_builders.items()
+            )
+        )
+        if self.hackmd_enabled:
+            await asyncio.gather(*publishing.values())
+            self.stage_done("notes", self.started)
+        self.notes_ready.set()
+
+    @staticmethod
+    def file_stamp(path: str) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    async def watch_songlist(self, key: tuple, songs: Songs):
+        """polls the songlist csv, a changed file is loaded once it stopped changing"""
+        path = key[0]
+        loaded = seen = self.file_stamp(path)
+        while True:
+            await asyncio.sleep(self.songlist_reload)
+            if (stamp := self.file_stamp(path)) != seen:
+                # CFSM may still be writing, look again next time
+                seen = stamp
+                continue
+            if stamp is None or stamp == loaded:
+                continue
+            try:
+                songs = await self.reload_songlist(key, songs)
+            except (OSError, ValueError, csv.Error) as error:
+                # loaded stays the same, so the next poll tries again
+                print(f"Songliste {path} nicht neu geladen: {error}")
+            else:
+                loaded = stamp
+
+    async def reload_songlist(self, key: tuple, old: Songs) -> Songs:
+        """
+        reads the csv again in a thread (ids stay the same, see SongIds) and swaps the catalog in
+        one go, chat sees either the old list or the new one. notes only go out where the
+        content changed
+        """
+        begin = time.perf_counter()
+        loop = asyncio.get_running_loop()
+
+        def rebuild() -> Songs:
+            return self._catalog_builders[key](ids=old.carried_ids())
+
+        songs = await loop.run_in_executor(None, rebuild)
+        added = songs.keys() - old.keys()
+        removed = old.keys() - songs.keys()
+        for channel in self.channels.values():
+            if channel.songs is old:
+                channel.songs = songs
+                channel.queue.set_songs(songs)
+        self.catalogs[self.catalogs.index(old)] = songs
+        if self.live is not None:
+            self.live.songs_changed()
+        metrics.inc("requestnonsense_songlist_reloads_total")
+        print(
+            f"Songliste {os.path.basename(key[0])} neu geladen in "
+            f"{time.perf_counter() - begin:.2f}s: {len(added)} neu, {len(removed)} weg"
+        )
+        if self.hackmd_enabled:
+            await songs.publish()
+        return songs
+
+    def stage_done(self, stage: str, begin: float):
+        now = time.perf_counter()
+        self.timings[stage] = now - begin
+        metrics.set("requestnonsense_startup_seconds", now - begin, stage=stage)
+        print(f"Start: {stage} in {now - begin:.2f}s (nach {now - self.started:.2f}s)")
+
+    async def wait_ready(self, ctx: commands.Context, ready: asyncio.Event) -> bool:
+        if ready.is_set():
+            return True
+        try:
+            await asyncio.wait_for(ready.wait(), self.STARTUP_WAIT)
+        except asyncio.TimeoutError:
+            await self.send_message(
+                ctx,
+                f"@{ctx.author.name}: gleich bereit, versuch es in ein paar Sekunden nochmal",
+            )
+            return False
+        return True
+
+    def channel_for(self, ctx: commands.Context) -> RequestChannel:
+        return self.channels[ctx.channel.name.lower()]
+
+    def queue_url(self, channel: RequestChannel) -> str:
+        if self.hackmd_enabled:
+            return channel.queue.note.url
+        return f"{self.public_url}{self.live_path(channel)}"
+
+    def songs_url(self, channel: RequestChannel, query: str = "") -> str:
+        if self.hackmd_enabled:
+            return channel.songs.url_for(query) if query else channel.songs.url
+        return f"{self.public_url}{self.live_path(channel)}songs"
+
+    def live_path(self, channel: RequestChannel) -> str:
+        name = channel.name.lower()
+        return "/" if name == self.main_channel else f"/{name}/"
+
+    async def event_message(self, message):
+        if message.echo:
+            return
+        ctx = await self.get_context(message)
+        if not ctx.prefix or not ctx.is_valid:
+            return
+        channel = ctx.channel.name.lower()
+        user = str(ctx.author.name)
+        verdict = self.limiter.check(
+            channel, user, ctx.command.name, str(message.content), ctx.author.is_mod
         )
-        self.queue = RequestQueue(
-            path=queue_path,
-            hackmd_token=hackmd_token,
-            hackmd_tags=hackmd_tags,
-            hackmd_queue_title=queue_title,
+        if verdict == RateLimiter.OK:
+            if (
+                ctx.command.name not in self.WITHOUT_QUEUE
+                and not await self.wait_ready(ctx, self.channels[channel].ready)
+            ):
+                return
+            with metrics.timer(
+                "requestnonsense_command_seconds", command=ctx.command.name
+            ):
+                await self.invoke(ctx)
+            return
+        metrics.inc("requestnonsense_commands_dropped_total", reason=verdict)
+        print(f"{verdict}: {user} {message.content}")
+        if verdict == RateLimiter.SHED:
+            if channel not in self.shed:
+                self.shed[channel] = {}
+                asyncio.create_task(self.reply_shed(ctx))
+            self.shed[channel][user] = None
+
+    async def event_command_error(self, ctx: commands.Context, error: Exception):
+        metrics.inc("requestnonsense_command_errors_total", command=ctx.command.name)
+        await super().event_command_error(ctx, error)
+
+    async def reply_shed(self, ctx: commands.Context):
+        # everyone who got shed in the next few seconds gets one answer together
+        await asyncio.sleep(self.SHED_DELAY)
+        users = list(self.shed.pop(ctx.channel.name.lower()))
+        names = " ".join(f"@{user}" for user in users[:10])
+        if len(users) > 10:
+            names += f" (+{len(users) - 10})"
+        await self.send_message(
+            ctx, f"{names}: gerade ist zu viel los, versucht es gleich nochmal"
         )
 
     async def send_message(self, ctx: commands.Context, message: str):
+        name = ctx.channel.name.lower()
+        if (sender := self.senders.get(name)) is None:
+            channel = ctx.channel
+            sender = self.senders[name] = ChatSender(
+                lambda text: channel.send(self.prefixed(text)),
+                is_mod=lambda: self.bot_is_mod(channel),
+            )
+        sender.send(message)
+
+    def prefixed(self, message: str) -> str:
         if self.message_prefix:
-            await ctx.send(f"{self.message_prefix}: {message}")
-        else:
-            await ctx.send(message)
+            return f"{self.message_prefix}: {message}"
+        return message
+
+    def bot_is_mod(self, channel) -> bool:
+        chatter = channel.get_chatter(self.nick)
+        return getattr(chatter, "is_mod", False)
+
+    @property
+    def chat_backlog(self) -> int:
+        return sum(sender.backlog for sender in self.senders.values())
+
+    async def close(self):
+        await super().close()
+        if self.startup is not None and not self.startup.done():
+            self.startup.cancel()
+        for watcher in self.watchers:
+            watcher.cancel()
+        if self.live is not None:
+            await self.live.stop()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        queues = [
+            channel.queue
+            for channel in self.channels.values()
+            if channel.queue is not None
+        ]
+        await asyncio.gather(*(queue.stop() for queue in queues))
+        if self.hackmd_enabled:
+            await asyncio.gather(*(queue.publisher.flush() for queue in queues))
+        await self.hackmd.close()
+        for queue in queues:
+            queue.storage.close()
+            if queue.history is not None:
+                queue.history.close()
 
     async def event_ready(self):
+        if "twitch" not in self.timings:
+            self.stage_done("twitch", self.started)
+        if self.startup is None:
+            self.startup = asyncio.create_task(self.prepare())
+        await self.startup
         print(f"Logged in as: {self.nick}")
         print(f"User id: {self.user_id}")
-        print(f"Queue: {self.queue.note.url}")
-        print(f"Songlist: {self.songs.note.url}")
-        await self.connected_channels[0].send("Requestnonsense bereit")
+        for channel in self.channels.values():
+            print(f"{channel.name} Queue: {self.queue_url(channel)}")
+            print(f"{channel.name} Songlist: {self.songs_url(channel)}")
+        for connected in self.connected_channels:
+            await connected.send("Requestnonsense bereit")
 
     @commands.command()
     async def meow(self, ctx: commands.Context):
@@ -397,56 +4268,132 @@ class Bot(commands.Bot):
         request command: add song as non prio, non current request to the end of queue OR
         change song data in the request for a given user
         """
+        channel = self.channel_for(ctx)
         print("request awaited")
         cmd_message = str(ctx.message.content)
-        cmd_arg = cmd_message.split(" ", maxsplit=1)[1]
-        song = self.songs.get(int(cmd_arg))
+        cmd_arg = cmd_message.split(" ", maxsplit=1)[1].strip()
         requestee = str(ctx.author.name)
         message: str
-        if song:
-            message = self.queue.process_request(song, requestee)
+        song_id: int | None
+        if cmd_arg.isdigit():
+            song_id = int(cmd_arg) if int(cmd_arg) in channel.songs else None
+        elif len(found := channel.songs.search(cmd_arg, limit=3)) == 1 or (
+            len(found) > 1 and found[0][1] > found[1][1]
+        ):
+            song_id = found[0][0]
+        elif found:
+            options = ", ".join(
+                f"{self.command_prefix}request {song_id} ({channel.songs[song_id]})"
+                for song_id, _ in found
+            )
+            await self.send_message(ctx, f"@{requestee}: Meinst du {options}?")
+            return
+        else:
+            song_id = None
+
+        if song_id is not None:
+            message = await channel.queue.submit(
+                lambda: channel.queue.process_request(song_id, requestee)
+            )
         else:
-            print(f"song {song} not found")
-            message = f"@{ctx.author.name} konnte keinen Song für {ctx.message} finden"
+            print(f"song {cmd_arg} not found")
+            message = f"@{ctx.author.name} konnte keinen Song für {cmd_arg} finden"
         print(message)
         await self.send_message(ctx, message)
 
+    @staticmethod
+    def mentioned(ctx: commands.Context) -> list[str]:
+        """the users after the command, with or without @"""
+        return [
+            name.removeprefix("@")
+            for name in str(ctx.message.content).split()[1:]
+            if name.removeprefix("@")
+        ]
+
     @commands.command()
     async def upgrade_request(self, ctx: commands.Context):
+        channel = self.channel_for(ctx)
         message: str
         if ctx.author.is_mod:
             print("upgrade awaited")
-            command = str(ctx.message.content)
             author = str(ctx.author.name)
-            requestee = command.split(" ", maxsplit=1)[1]
-            if requestee.startswith("@"):
-                requestee = requestee[1:]
-            message = self.queue.process_upgrade(requestee, author)
+            requestees = self.mentioned(ctx)
+
+            async def upgrade() -> str:
+                return " | ".join(
+                    [
+                        await channel.queue.process_upgrade(requestee, author)
+                        for requestee in requestees
+                    ]
+                )
+
+            message = await channel.queue.submit(upgrade)
         else:
             message = f"@{ctx.author.name}: Das ist ein Mod-Only-Befehl"
-        await self.send_message(ctx, message)
+        if message:
+            await self.send_message(ctx, message)
+
+    @commands.command()
+    async def remove(self, ctx: commands.Context):
+        channel = self.channel_for(ctx)
+        message: str
+        if ctx.author.is_mod:
+            author = str(ctx.author.name)
+            requestees = self.mentioned(ctx)
+
+            async def remove() -> str:
+                return " | ".join(
+                    [
+                        await channel.queue.process_remove(requestee, author)
+                        for requestee in requestees
+                    ]
+                )
+
+            message = await channel.queue.submit(remove)
+        else:
+            message = f"@{ctx.author.name}: Das ist ein Mod-Only-Befehl"
+        if message:
+            await self.send_message(ctx, message)
 
     @commands.command()
     async def position(self, ctx: commands.Context):
+        channel = self.channel_for(ctx)
         if (
-            idx := self.queue.get_index_for_user(str(ctx.message.author.name))
+            idx := channel.queue.get_index_for_user(str(ctx.message.author.name))
         ) is not None:
-            message = f"Dein Request {self.queue.get_element(idx-1).song} ist aktuell auf Platz {idx} in der Warteschlange"
+            song = channel.queue.song_name(channel.queue.get_element(idx - 1).song_id)
+            message = (
+                f"Dein Request {song} ist aktuell auf Platz {idx} in der Warteschlange"
+            )
         else:
             message = "Du hast anscheinend gar keinen Song in der Warteschlange"
         await self.send_message(ctx, f"@{ctx.message.author.name}: {message}")
 
     @commands.command()
     async def next(self, ctx: commands.Context):
+        """?next 3 skips two songs and starts the third"""
+        channel = self.channel_for(ctx)
         message: str
-        next_song: RequestTuple = self.queue.get_first()
-        for request in self.queue.data:
-            if request.waiting:
-                next_song = request
-                break
+        cmd_arg = str(ctx.message.content).split(" ", maxsplit=1)[1:]
+        if cmd_arg and not cmd_arg[0].strip().isdigit():
+            await self.send_message(ctx, f"{cmd_arg[0]} ist anscheinend keine Zahl")
+            return
+        count = max(int(cmd_arg[0]) if cmd_arg else 1, 1)
 
         if ctx.author.is_mod:
-            message = self.queue.advance_queue(next_song)
+            queue = channel.queue
+
+            async def advance() -> str:
+                # picking the song happens in the queue task, nothing can move it in between
+                for done in range(1, count + 1):
+                    message = await queue.advance_queue(queue.get_first_waiting())
+                    if queue.get_first_waiting() is None:
+                        break
+                if done > 1:
+                    message = f"{done - 1} übersprungen. {message}"
+                return message
+
+            message = await queue.submit(advance)
         else:
             message = f"@{ctx.author.name}: Das ist ein Mod-Only-Befehl"
 
@@ -455,15 +4402,19 @@ class Bot(commands.Bot):
 
     @commands.command()
     async def randomize(self, ctx: commands.Context):
+        channel = self.channel_for(ctx)
         message: str
         if ctx.author.is_mod:
-            length = self.queue.len()
-            if length == 0:
-                return
+            queue = channel.queue
 
-            new_top = self.queue.get_random()
-            message = self.queue.advance_queue(new_top)
+            async def advance() -> str:
+                if queue.len() == 0:
+                    return ""
+                return await queue.advance_queue(queue.get_random())
 
+            message = await queue.submit(advance)
+            if not message:
+                return
         else:
             message = f"@{ctx.author.name}: Das ist ein Mod-Only-Befehl"
 
@@ -472,6 +4423,7 @@ class Bot(commands.Bot):
 
     @commands.command()
     async def scam(self, ctx: commands.Context):
+        channel = self.channel_for(ctx)
         print("Scam awaited")
         cmd_message = str(ctx.message.content)
         cmd_arg = cmd_message.split(" ", maxsplit=1)[1]
@@ -483,16 +4435,21 @@ class Bot(commands.Bot):
             await self.send_message(ctx, f"{cmd_arg} ist anscheinend keine Zahl")
             return
 
-        length = self.queue.len()
-        if idx >= length:
-            await self.send_message(
-                ctx, f"@{ctx.author.name}: So lang ist Queue nicht. Upsi"
-            )
+        queue = channel.queue
+        too_short = f"@{ctx.author.name}: So lang ist Queue nicht. Upsi"
+        if idx >= queue.len():
+            await self.send_message(ctx, too_short)
             return
-        new_top = self.queue.get_element(idx - 1)
 
         if ctx.author.is_mod:
-            message = self.queue.advance_queue(new_top)
+
+            async def advance() -> str:
+                # checked again, the queue may have gotten shorter in the meantime
+                if idx >= queue.len():
+                    return too_short
+                return await queue.advance_queue(queue.get_element(idx - 1))
+
+            message = await queue.submit(advance)
         else:
             message = f"@{ctx.author.name}: Das ist ein Mod-Only-Befehl"
 
@@ -500,13 +4457,100 @@ class Bot(commands.Bot):
 
     @commands.command()
     async def help(self, ctx: commands.Context):
+        channel = self.channel_for(ctx)
+        # ?help <artist or song> links the part of the songlist it is in
+        query = str(ctx.message.content).split(" ", maxsplit=1)[1:]
+        if self.hackmd_enabled and not await self.wait_ready(ctx, self.notes_ready):
+            return
+        url = self.songs_url(channel, query[0] if query else "")
         await self.send_message(
             ctx,
-            f"1: Song unter {self.songs.url} finden. "
+            f"1: Song unter {url} finden. "
             "2: Request-Befehl kopieren. "
             "3: Request-Befehl im Chat einfügen.",
         )
 
+    @commands.command()
+    async def stats(self, ctx: commands.Context):
+        if not ctx.author.is_mod:
+            await self.send_message(
+                ctx, f"@{ctx.author.name}: Das ist ein Mod-Only-Befehl"
+            )
+            return
+        channel = self.channel_for(ctx)
+
+        def ms(name: str) -> str:
+            seconds = metrics.quantile(name, 0.95)
+            return "-" if seconds is None else f"<{seconds * 1000:g}ms"
+
+        budget = self.hackmd.budget
+        await self.send_message(
+            ctx,
+            f"Queue: {channel.queue.len()} | "
+            f"Befehle: {metrics.total('requestnonsense_command_seconds'):g}, "
+            f"p95 {ms('requestnonsense_command_seconds')}, "
+            f"{metrics.total('requestnonsense_commands_dropped_total'):g} verworfen | "
+            f"Speichern p95 {ms('requestnonsense_storage_commit_seconds')} | "
+            f"HackMD: {budget.calls}/{budget.monthly_limit} Calls, "
+            f"{metrics.total('requestnonsense_hackmd_errors_total'):g} Fehler, "
+            f"p95 {ms('requestnonsense_hackmd_seconds')} | "
+            f"Chat: {self.chat_backlog} warten",
+        )
+
+    @commands.command()
+    async def top(self, ctx: commands.Context):
+        channel = self.channel_for(ctx)
+        if (history := channel.queue.history) is None:
+            await self.send_message(ctx, "Hier wird keine History geführt")
+            return
+        if not (top := history.top()):
+            await self.send_message(ctx, "Diesen Monat wurde noch nichts requestet")
+            return
+        songs = ", ".join(
+            f"{place}. {channel.queue.song_name(song_id)} ({count}x)"
+            for place, (song_id, count) in enumerate(top, start=1)
+        )
+        await self.send_message(ctx, f"Meistgewünscht diesen Monat: {songs}")
+
+    @commands.command()
+    async def lastplayed(self, ctx: commands.Context):
+        """?lastplayed: the last few songs, ?lastplayed <song>: when that one ran"""
+        channel = self.channel_for(ctx)
+        if (history := channel.queue.history) is None:
+            await self.send_message(ctx, "Hier wird keine History geführt")
+            return
+        now = time.time()
+        query = str(ctx.message.content).split(" ", maxsplit=1)[1:]
+        if not query:
+            if not history.recent:
+                await self.send_message(ctx, "Es lief noch gar nichts")
+                return
+            played = ", ".join(
+                f"{channel.queue.song_name(song_id)} ({history.ago(now - at)})"
+                for at, song_id, _ in reversed(history.recent)
+            )
+            await self.send_message(ctx, f"Zuletzt gespielt: {played}")
+            return
+
+        query = query[0].strip()
+        if query.isdigit():
+            song_id = int(query)
+        elif found := channel.songs.search(query, limit=1):
+            song_id = found[0][0]
+        else:
+            await self.send_message(
+                ctx, f"@{ctx.author.name} konnte keinen Song für {query} finden"
+            )
+            return
+        song = channel.queue.song_name(song_id)
+        if (at := history.last_played.get(song_id)) is None:
+            message = f"{song} lief noch nie"
+        else:
+            message = f"{song} lief zuletzt {history.ago(now - at)}"
+            if (left := channel.queue.cooldown_left(song_id, now)) > 0:
+                message += f", wieder requestbar in {math.ceil(left / 60)} Minuten"
+        await self.send_message(ctx, message)
+
     @commands.command()
     async def rules(self, ctx: commands.Context):
         await self.send_message(
@@ -517,9 +4561,10 @@ class Bot(commands.Bot):
 
     @commands.command()
     async def allrequests(self, ctx: commands.Context):
-        await self.send_message(
-            ctx, f"die gesamte Warteschlange gibts unter {self.queue.note.url}"
-        )
+        if self.hackmd_enabled and not await self.wait_ready(ctx, self.notes_ready):
+            return
+        url = self.queue_url(self.channel_for(ctx))
+        await self.send_message(ctx, f"die gesamte Warteschlange gibts unter {url}")
 
 
 if __name__ == "__main__":
@@ -540,5 +4585,48 @@ if __name__ == "__main__":
         list_title=config["HACKMD"]["LISTTITLE"],
         queue_title=config["HACKMD"]["QUEUETITLE"],
         message_prefix=config["Twitch"]["MESSAGE_PREFIX"],
+        usage_path=config["HACKMD"].get("USAGE_FILE", "./hackmd_usage.json"),
+        monthly_budget=config["HACKMD"].get("MONTHLY_BUDGET", 1000),
+        publish_window=config["HACKMD"].get("PUBLISH_WINDOW", 5.0),
+        queue_storage=config["Local"].get("QUEUE_STORAGE", "binary"),
+        journal_compact_bytes=config["Local"].get("JOURNAL_COMPACT_BYTES", 64 * 1024),
+        catalog_cache=config["Local"].get("CATALOG_CACHE", ""),
+        notes_path=config["HACKMD"].get("NOTES_FILE", "./hackmd_notes.json"),
+        queue_max_rows=config["HACKMD"].get("QUEUE_MAX_ROWS", 0),
+        songlist_shards=config["HACKMD"].get("LIST_SHARDS", ""),
+        songlist_page_size=config["HACKMD"].get("LIST_PAGE_SIZE", 500),
+        hackmd_enabled=config["HACKMD"].get("ENABLED", True),
+        web_enabled=config.get("Web", {}).get("ENABLED", False),
+        web_host=config.get("Web", {}).get("HOST", "127.0.0.1"),
+        web_port=config.get("Web", {}).get("PORT", 8080),
+        public_url=config.get("Web", {}).get("PUBLIC_URL", ""),
+        extra_channels=[
+            {
+                key: extra[option]
+                for key, option in (
+                    ("channel", "CHANNEL"),
+                    ("queue_path", "QUEUE_FILE"),
+                    ("csv_path", "SONGLIST"),
+                    ("instruments", "INSTRUMENTS"),
+                    ("queue_title", "QUEUETITLE"),
+                    ("list_title", "LISTTITLE"),
+                )
+                if option in extra
+            }
+            for extra in config.get("Channels", [])
+        ],
+        user_rate=config["Twitch"].get("USER_RATE", 0.2),
+        user_burst=config["Twitch"].get("USER_BURST", 3),
+        command_rate=config["Twitch"].get("COMMAND_RATE", 2.0),
+        command_burst=config["Twitch"].get("COMMAND_BURST", 10),
+        dedup_window=config["Twitch"].get("DEDUP_WINDOW", 5.0),
+        metrics_host=config.get("Metrics", {}).get("HOST", "127.0.0.1"),
+        metrics_port=config.get("Metrics", {}).get("PORT", 0),
+        randomize_policy=config["Local"].get("RANDOMIZE_POLICY", "uniform"),
+        play_history=config["Local"].get("PLAY_HISTORY", True),
+        song_cooldown=config["Local"].get("SONG_COOLDOWN", 0),
+        song_ids=config["Local"].get("SONG_IDS", "./song_ids.json"),
+        songlist_reload=config["Local"].get("SONGLIST_RELOAD", 0),
+        catalog_file=config["Local"].get("CATALOG_FILE", ""),
     )
     bot.run()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the hackmd stand-in is shared with the benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "benchmarks"))
@@ -0,0 +1,278 @@
+import asyncio
+import os
+
+from requestnonsense.requestnonsense import Bot, ChatSender, RateLimiter
+
+CSV = """Artist;Title;Arrangements
+Muse;Hysteria;Lead, Bass
+Tool;Schism;Bass
+"""
+
+
+def make_bot(tmp_path, **kwargs) -> Bot:
+    path = tmp_path / "songs.csv"
+    path.write_text(CSV)
+    return Bot(
+        csv_path=str(path),
+        hackmd_token="abc",
+        hackmd_tags="requestnonsense",
+        queue_path=str(tmp_path / "queue.bin"),
+        twitch_token="oauth:abc",
+        bot_prefix=["?"],
+        channel="Main",
+        cfsm=False,
+        usage_path=str(tmp_path / "usage.json"),
+        notes_path=str(tmp_path / "notes.json"),
+        hackmd_enabled=False,
+        **kwargs,
+    )
+
+
+def test_channels_share_catalog(tmp_path):
+    bot = make_bot(
+        tmp_path,
+        extra_channels=[
+            {"channel": "Other", "queue_path": str(tmp_path / "other.bin")},
+            {
+                "channel": "third",
+                "queue_path": str(tmp_path / "third.bin"),
+                "instruments": ["Lead"],
+            },
+        ],
+    )
+    assert bot.queue is None
+    asyncio.run(bot.prepare())
+    main, other, third = (
+        bot.channels["main"],
+        bot.channels["other"],
+        bot.channels["third"],
+    )
+    assert bot.queue is main.queue
+    assert main.songs is other.songs
+    assert third.songs is not main.songs
+    assert main.queue is not other.queue
+    assert other.queue.note.name == "queue:other"
+    assert third.songs.note.name == "songlist:third"
+    assert set(bot.timings) == {
+        "songlist songs.csv",
+        "queue main",
+        "queue other",
+        "queue third",
+    }
+
+
+class FakeChannel:
+    def __init__(self, name: str):
+        self.name = name
+        self.sent = []
+
+    async def send(self, content: str):
+        self.sent.append(content)
+
+    def get_chatter(self, name: str):
+        return None
+
+
+class FakeAuthor:
+    def __init__(self, name: str):
+        self.name = name
+        self.is_mod = False
+        self._ws = None
+
+
+class FakeMessage:
+    def __init__(self, channel: FakeChannel, content: str):
+        self.channel = channel
+        self.author = FakeAuthor("viewer")
+        self.content = content
+        self.echo = False
+        self.tags = {}
+
+
+def test_commands_wait_for_startup(tmp_path):
+    async def scenario():
+        bot = make_bot(tmp_path)
+        bot.STARTUP_WAIT = 0.05
+        channel = FakeChannel("main")
+        # nothing loaded and nobody loading: the viewer gets told to come back
+        await bot.event_message(FakeMessage(channel, "?position"))
+        await bot.event_message(FakeMessage(channel, "?meow"))
+        # a command that arrives while loading waits for it
+        waiting = asyncio.create_task(
+            bot.event_message(FakeMessage(channel, "?request hysteria"))
+        )
+        await asyncio.sleep(0.01)
+        await bot.prepare()
+        await waiting
+        while bot.chat_backlog:
+            await asyncio.sleep(0.01)
+        await bot.senders["main"]._task
+        bot.queue.storage.close()
+        return channel.sent
+
+    sent = asyncio.run(scenario())
+    assert sent[0].startswith("@viewer: gleich bereit")
+    assert sent[1] == "meow!"
+    assert "Muse - Hysteria" in sent[2]
+
+
+def test_failed_startup_stops_the_bot(tmp_path):
+    stopped = []
+
+    class Loop:
+        def stop(self):
+            stopped.append(True)
+
+    async def scenario():
+        bot = make_bot(tmp_path)
+        # no Artist column
+        (tmp_path / "songs.csv").write_text("Title;Arrangements\nHysteria;Lead\n")
+        bot.loop = Loop()
+        startup = asyncio.create_task(bot.prepare())
+        startup.add_done_callback(bot.startup_done)
+        await asyncio.wait([startup])
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert stopped == [True]
+
+
+class Clock:
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limiter():
+    clock = Clock()
+    limiter = RateLimiter(
+        user_rate=1.0, user_burst=2, command_burst=3, dedup_window=5.0, clock=clock
+    )
+    check = limiter.check
+    assert check("chan", "a", "request", "?request 1") == RateLimiter.OK
+    assert check("chan", "a", "request", "?request  1") == RateLimiter.DUPLICATE
+    assert check("chan", "a", "request", "?request 2") == RateLimiter.OK
+    assert check("chan", "a", "request", "?request 3") == RateLimiter.SHED
+    assert check("chan", "a", "request", "?request 3", is_mod=True) == RateLimiter.OK
+    assert check("chan", "b", "request", "?request 4") == RateLimiter.OK
+    # the command bucket is empty now, for everyone
+    assert check("chan", "c", "request", "?request 5") == RateLimiter.SHED
+    assert check("chan", "c", "position", "?position") == RateLimiter.OK
+    assert check("other", "d", "request", "?request 5") == RateLimiter.OK
+
+    clock.now = 100.0
+    assert check("chan", "e", "position", "?position") == RateLimiter.OK
+    assert list(limiter.users) == ["e"]
+
+
+def test_chat_sender_merges_backlog():
+    async def scenario():
+        sent = []
+
+        async def send(text):
+            sent.append(text)
+
+        sender = ChatSender(send, limit=2, window=0.05)
+        sender.send("@a: Dein Request für Muse - Hysteria ist eingetragen.")
+        await asyncio.sleep(0)
+        for user in "bcd":
+            sender.send(f"@{user}: Das ist ein Mod-Only-Befehl")
+        sender.send("@b: Dein Request für Tool - Schism ist eingetragen.")
+        sender.send("x" * 480)
+        assert sender.backlog == 5
+        while sender.backlog:
+            await asyncio.sleep(0.01)
+        await sender._task
+        return sent
+
+    assert asyncio.run(scenario()) == [
+        "@a: Dein Request für Muse - Hysteria ist eingetragen.",
+        "@b, @c, @d: Das ist ein Mod-Only-Befehl"
+        " | @b: Dein Request für Tool - Schism ist eingetragen.",
+        "x" * 480,
+    ]
+
+
+def test_bulk_commands(tmp_path):
+    async def scenario():
+        bot = make_bot(tmp_path)
+        await bot.prepare()
+        channel = FakeChannel("main")
+        for user in "abcde":
+            message = FakeMessage(channel, "?request hysteria")
+            message.author = FakeAuthor(user)
+            await bot.invoke(await bot.get_context(message))
+        mod = FakeAuthor("mod")
+        mod.is_mod = True
+        for content in ("?remove @b c nobody", "?upgrade_request @e", "?next 2"):
+            message = FakeMessage(channel, content)
+            message.author = mod
+            await bot.invoke(await bot.get_context(message))
+        while bot.chat_backlog:
+            await asyncio.sleep(0.01)
+        await bot.senders["main"]._task
+        bot.queue.storage.close()
+        return bot.queue, channel.sent
+
+    queue, sent = asyncio.run(scenario())
+    assert [request.requestee for request in queue.data] == ["a", "d"]
+    assert not queue.get_first().waiting
+    assert any("nobody hat keine Request" in text for text in sent)
+    assert sent[-1].endswith(
+        "1 übersprungen. Nächster Song: Muse - Hysteria requestet von a"
+    )
+
+
+def test_songlist_reload_keeps_ids(tmp_path):
+    async def scenario():
+        bot = make_bot(tmp_path, song_ids=str(tmp_path / "ids.json"))
+        await bot.prepare()
+        await bot.queue.process_request(2, "a")
+        old = bot.songs
+        (tmp_path / "songs.csv").write_text(
+            CSV.replace("Tool;Schism;Bass", "AC/DC;Thunderstruck;Lead")
+        )
+        key = next(iter(bot._catalog_builders))
+        songs = await bot.reload_songlist(key, old)
+        bot.queue.storage.close()
+        return bot, old, songs
+
+    bot, old, songs = asyncio.run(scenario())
+    assert bot.songs is songs is bot.queue.songs is bot.catalogs[0]
+    assert dict(songs) == {1: "Muse - Hysteria", 3: "AC/DC - Thunderstruck"}
+    # the queued request for the song that is gone keeps its name
+    assert bot.queue.song_name(2) == "Tool - Schism"
+    assert songs.search("thunderstruck", limit=1)[0][0] == 3
+
+
+def test_songlist_reload_keeps_ids_without_id_file(tmp_path):
+    async def scenario(catalog_file: str, warm: bool):
+        if warm:
+            # an earlier start compiled the catalog, this one only opens it
+            first = make_bot(tmp_path, catalog_file=catalog_file)
+            os.utime(tmp_path / "songs.csv", ns=(10**18, 10**18))
+            await first.prepare()
+            first.queue.storage.close()
+        bot = make_bot(tmp_path, catalog_file=catalog_file)
+        # make_bot writes the csv again, the same stamp keeps the catalog key
+        os.utime(tmp_path / "songs.csv", ns=(10**18, 10**18))
+        await bot.prepare()
+        await bot.queue.process_request(2, "a")
+        # sorts first, a fresh numbering would move Tool - Schism to 3
+        (tmp_path / "songs.csv").write_text(CSV + "ABBA;Waterloo;Lead\n")
+        key = next(iter(bot._catalog_builders))
+        songs = await bot.reload_songlist(key, bot.songs)
+        bot.queue.storage.close()
+        (tmp_path / "queue.bin").unlink()
+        return bot, songs
+
+    catalog_file = str(tmp_path / "songs.catalog")
+    for catalog, warm in (("", False), (catalog_file, False), (catalog_file, True)):
+        bot, songs = asyncio.run(scenario(catalog, warm))
+        assert dict(songs) == {
+            1: "Muse - Hysteria",
+            2: "Tool - Schism",
+            3: "ABBA - Waterloo",
+        }
+        assert bot.queue.song_name(bot.queue.get_first().song_id) == "Tool - Schism"
@@ -0,0 +1,230 @@
+import asyncio
+
+from mock_hackmd import MockHackMD
+from requestnonsense.requestnonsense import (
+    ApiBudget,
+    CircuitBreaker,
+    HackMDClient,
+    HackMDNote,
+    NotePublisher,
+    NoteRegistry,
+)
+
+
+def test_note_create_and_update():
+    async def scenario():
+        stub = MockHackMD()
+        endpoint = await stub.start()
+        client = HackMDClient("abc", endpoint=endpoint)
+        note = HackMDNote("erster Stand", client)
+        try:
+            assert await note.create()
+            assert await note.update("zweiter Stand")
+        finally:
+            await client.close()
+            await stub.stop()
+        return stub, note
+
+    stub, note = asyncio.run(scenario())
+    assert stub.notes[note.id] == "zweiter Stand"
+    assert stub.requests == [("POST", "Bearer abc"), ("PATCH", "Bearer abc")]
+
+
+def test_update_creates_missing_note():
+    async def scenario():
+        stub = MockHackMD()
+        endpoint = await stub.start()
+        client = HackMDClient("abc", endpoint=endpoint)
+        note = HackMDNote("", client)
+        try:
+            await asyncio.gather(note.update("eins"), note.update("zwei"))
+        finally:
+            await client.close()
+            await stub.stop()
+        return stub, note
+
+    stub, note = asyncio.run(scenario())
+    assert len(stub.notes) == 1
+    assert stub.notes[note.id] == "zwei"
+
+
+class FakeClient:
+    """records what would have been sent to hackmd"""
+
+    budget = None
+
+    def __init__(self):
+        self.calls = []
+
+    async def create_note(self, payload: dict) -> str:
+        self.calls.append(("POST", payload["content"]))
+        return "fresh"
+
+    async def update_note(self, note_id: str, payload: dict) -> int:
+        self.calls.append(("PATCH", payload["content"]))
+        return 202
+
+
+def test_publisher_coalesces_and_skips_unchanged():
+    state = {"content": "leer"}
+    client = FakeClient()
+
+    async def scenario():
+        note = HackMDNote(state["content"], client)
+        await note.create()
+        publisher = NotePublisher(note, lambda: state["content"], window=0.01)
+        for idx in range(50):
+            state["content"] = f"stand {idx}"
+            publisher.schedule()
+        await asyncio.sleep(0.05)
+        # same content again, no call
+        publisher.schedule()
+        await asyncio.sleep(0.05)
+
+    asyncio.run(scenario())
+    assert client.calls == [("POST", "leer"), ("PATCH", "stand 49")]
+
+
+def test_registry_reuses_note_across_restarts(tmp_path):
+    registry_path = str(tmp_path / "notes.json")
+    client = FakeClient()
+
+    async def start(content: str) -> HackMDNote:
+        note = HackMDNote(
+            content, client, name="queue", registry=NoteRegistry(registry_path)
+        )
+        await note.create()
+        return note
+
+    asyncio.run(start("eins"))
+    asyncio.run(start("eins"))
+    note = asyncio.run(start("zwei"))
+
+    assert note.id == "fresh"
+    assert client.calls == [("POST", "eins"), ("PATCH", "zwei")]
+
+
+def test_budget_persists_and_widens_window(tmp_path):
+    path = str(tmp_path / "usage.json")
+    budget = ApiBudget(path, monthly_limit=10)
+    budget.spend(9)
+    # throttled, only written on save (the client saves on close)
+    assert ApiBudget(path, monthly_limit=10).remaining == 10
+    budget.save()
+    assert ApiBudget(path, monthly_limit=10).remaining == 1
+
+    publisher = NotePublisher(None, str, window=1.0, budget=budget)
+    # one call left, so it has to last for the rest of the month
+    assert publisher.current_window() > budget.seconds_left_in_month() - 1
+
+    # within the month's pace the configured window is used as is
+    relaxed = NotePublisher(None, str, window=1.0, budget=ApiBudget(path, 10**9))
+    assert relaxed.current_window() == 1.0
+
+
+def test_publisher_flushes_first_change_after_idle():
+    client = FakeClient()
+
+    async def scenario():
+        note = HackMDNote("leer", client)
+        await note.create()
+        publisher = NotePublisher(note, lambda: "voll", window=60.0)
+        publisher.schedule()
+        await asyncio.sleep(0.05)
+        return publisher
+
+    publisher = asyncio.run(scenario())
+    assert client.calls == [("POST", "leer"), ("PATCH", "voll")]
+    assert not publisher._dirty
+
+
+def test_transient_errors_are_retried():
+    async def scenario():
+        stub = MockHackMD()
+        endpoint = await stub.start()
+        client = HackMDClient("abc", endpoint=endpoint, timeout=0.2, backoff=0.01)
+        note = HackMDNote("erster Stand", client)
+        try:
+            stub.faults = ["500", "reset", "slow"]
+            created = await note.create()
+            stub.faults = ["429"]
+            updated = await note.update("zweiter Stand")
+        finally:
+            await client.close()
+            await stub.stop()
+        return stub, note, created, updated
+
+    stub, note, created, updated = asyncio.run(scenario())
+    assert created and updated
+    assert stub.notes[note.id] == "zweiter Stand"
+    assert [method for method, _ in stub.requests] == ["POST", "PATCH"]
+
+
+def test_breaker_buffers_latest_content_until_recovery():
+    async def scenario():
+        stub = MockHackMD()
+        endpoint = await stub.start()
+        client = HackMDClient(
+            "abc",
+            endpoint=endpoint,
+            retries=1,
+            backoff=0.01,
+            max_backoff=0.05,
+            breaker=CircuitBreaker(threshold=2, cooldown=0.1),
+        )
+        note = HackMDNote("erster Stand", client)
+        try:
+            assert await note.create()
+            stub.faults = ["503"] * 2
+            assert not await note.update("zweiter Stand")
+            assert client.breaker.state == CircuitBreaker.OPEN
+            # no request at all while the breaker is open, only the content is kept
+            assert not await note.update("dritter Stand")
+            assert stub.faults == []
+            assert client.buffered == {note}
+            await asyncio.sleep(0.3)
+        finally:
+            await client.close()
+            await stub.stop()
+        return stub, note, client
+
+    stub, note, client = asyncio.run(scenario())
+    assert stub.notes[note.id] == "dritter Stand"
+    assert [method for method, _ in stub.requests] == ["POST", "PATCH"]
+    assert client.breaker.state == CircuitBreaker.CLOSED
+    assert not client.buffered
+
+
+def test_cancelled_probe_reopens_breaker():
+    async def scenario():
+        stub = MockHackMD(latency=0.5)
+        endpoint = await stub.start()
+        client = HackMDClient(
+            "abc",
+            endpoint=endpoint,
+            retries=0,
+            breaker=CircuitBreaker(threshold=1, cooldown=0.01),
+        )
+        try:
+            client.breaker.failure()
+            await asyncio.sleep(0.02)
+            probe = asyncio.create_task(client.create_note({"content": "erster Stand"}))
+            await asyncio.sleep(0.1)
+            assert client.breaker.state == CircuitBreaker.HALF_OPEN
+            probe.cancel()
+            await asyncio.gather(probe, return_exceptions=True)
+            assert client.breaker.state == CircuitBreaker.OPEN
+            # after the cooldown the next call is the new probe
+            await asyncio.sleep(0.05)
+            stub.latency = 0.0
+            return (
+                await client.create_note({"content": "zweiter Stand"}),
+                client.breaker.state,
+            )
+        finally:
+            await client.close()
+            await stub.stop()
+
+    note_id, state = asyncio.run(scenario())
+    assert note_id is not None
+    assert state == CircuitBreaker.CLOSED
@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+import aiohttp
+
+from requestnonsense.requestnonsense import LiveServer, RequestChannel, RequestQueue
+
+SONGS = {1: "Muse - Hysteria", 2: "Tool - Schism", 3: "Queen - Bicycle Race"}
+
+
+async def read_event(stream: aiohttp.StreamReader) -> tuple[str, object]:
+    event = await stream.readline()
+    data = await stream.readline()
+    await stream.readline()
+    return event.decode().split(": ")[1].strip(), json.loads(data.decode()[6:])
+
+
+def test_live_queue_pushes_diffs(tmp_path):
+    async def scenario():
+        queue = RequestQueue(
+            path=str(tmp_path / "queue.bin"),
+            hackmd_token="abc",
+            mirror=False,
+            songs=SONGS,
+        )
+        await queue.process_request(1, "A")
+        other = RequestQueue(
+            path=str(tmp_path / "other.bin"),
+            hackmd_token="abc",
+            mirror=False,
+            songs=SONGS,
+        )
+        await other.process_request(3, "C")
+        channels = {
+            "main": RequestChannel("Main", queue, {}),
+            "other": RequestChannel("Other", other, {}),
+        }
+        server = LiveServer(channels, "main", port=0)
+        await server.start()
+        base = f"http://127.0.0.1:{server.port}"
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"{base}/") as response:
+                    assert response.headers["Content-Encoding"] == "gzip"
+                    assert response.headers["Vary"] == "Accept-Encoding"
+                    assert "Hysteria" in await response.text()
+                    etag = response.headers["ETag"]
+                async with session.get(
+                    f"{base}/", headers={"If-None-Match": etag}
+                ) as response:
+                    assert response.status == 304
+                    assert response.headers["Vary"] == "Accept-Encoding"
+
+                async with session.get(f"{base}/other/queue.json") as response:
+                    assert await response.json() == [["Queen - Bicycle Race", "C"]]
+                async with session.get(f"{base}/nobody/queue.json") as response:
+                    assert response.status == 404
+
+                async with session.get(f"{base}/events") as response:
+                    snapshot = await read_event(response.content)
+                    await queue.process_request(2, "B")
+                    await queue.process_upgrade("B", "mod")
+                    diff = await read_event(response.content)
+                    second_diff = await read_event(response.content)
+
+                async with session.get(
+                    f"{base}/", headers={"If-None-Match": etag}
+                ) as response:
+                    assert response.status == 200
+        finally:
+            await server.stop()
+        return snapshot, diff, second_diff
+
+    snapshot, diff, second_diff = asyncio.run(scenario())
+    assert snapshot == ("snapshot", [["Muse - Hysteria", "A"]])
+    assert diff == ("diff", [["add", 1, "Tool - Schism", "B"]])
+    assert second_diff == (
+        "diff",
+        [["remove", 1, "Tool - Schism", "B"], ["add", 0, "Tool - Schism", "B"]],
+    )
@@ -0,0 +1,60 @@
+import asyncio
+
+import aiohttp
+
+from requestnonsense.requestnonsense import (
+    Metrics,
+    MetricsServer,
+    RequestQueue,
+    metrics,
+)
+
+SONGS = {1: "Muse - Hysteria", 2: "Tool - Schism", 3: "Queen - Bicycle Race"}
+
+
+def test_metrics_render():
+    registry = Metrics()
+    registry.inc("calls_total", call="update", status=202)
+    registry.inc("calls_total", call="update", status=202)
+    registry.set("queue_length", lambda: 3, channel='a"b')
+    registry.observe("command_seconds", 0.003, command="request")
+    registry.observe("command_seconds", 0.2, command="request")
+    registry.observe("command_seconds", 20, command="next")
+
+    text = registry.render()
+    assert 'calls_total{call="update",status="202"} 2' in text
+    assert 'queue_length{channel="a\\"b"} 3' in text
+    assert "# TYPE command_seconds histogram" in text
+    assert 'command_seconds_bucket{command="request",le="0.005"} 1' in text
+    assert 'command_seconds_bucket{command="request",le="+Inf"} 2' in text
+    assert 'command_seconds_count{command="next"} 1' in text
+    assert registry.total("command_seconds") == 3
+    assert registry.total("calls_total") == 2
+    assert registry.quantile("command_seconds", 0.5) == 0.25
+    assert registry.quantile("command_seconds", 0.99) == float("inf")
+    assert registry.quantile("missing", 0.5) is None
+
+
+def test_metrics_endpoint(tmp_path):
+    async def scenario():
+        queue = RequestQueue(
+            path=str(tmp_path / "queue.bin"),
+            hackmd_token="abc",
+            mirror=False,
+            songs=SONGS,
+        )
+        await queue.process_request(1, "A")
+        server = MetricsServer(metrics, port=0)
+        await server.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                url = f"http://127.0.0.1:{server.port}/metrics"
+                async with session.get(url) as response:
+                    return await response.text()
+        finally:
+            await server.stop()
+
+    text = asyncio.run(scenario())
+    assert (
+        'requestnonsense_storage_commit_seconds_count{storage="BinaryStorage"}' in text
+    )
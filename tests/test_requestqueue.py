@@ -1,11 +1,27 @@
+import asyncio
 import mock
+import random
 
-from requestnonsense.requestnonsense import RequestQueue, RequestTuple
+from requestnonsense.requestnonsense import (
+    POLICIES,
+    FenwickTree,
+    QueueStopped,
+    RequestIndex,
+    RequestQueue,
+    RequestTuple,
+)
+
+SONGS = {
+    1: "Muse - Hysteria",
+    2: "Tool - Schism",
+    3: "ABBA - Waterloo",
+    4: "Queen - Innuendo",
+}
 
 
 def test_append_simple():
     qu = RequestQueue(path="./testqueue.bin", hackmd_token="abc")
-    rq = RequestTuple(False, False, 1.0, "miau - meow", "Goethe")
+    rq = RequestTuple(False, False, 1.0, 7, "Goethe")
 
     old_len = qu.len()
     qu.append(rq)
@@ -17,17 +33,17 @@ def test_append_simple():
 
 @mock.patch("requestnonsense.requestnonsense.RequestQueue.safe_queue")
 def test_process_upgrade(mocked_safe_queue):
-    qu = RequestQueue(path="./testqueue.bin", hackmd_token="abc")
+    qu = RequestQueue(path="./testqueue.bin", hackmd_token="abc", songs=SONGS)
     requests = [
-        RequestTuple(True, True, 1.0, "1", "A"),
-        RequestTuple(True, True, 1.1, "2", "B"),
-        RequestTuple(True, True, 1.2, "3", "C"),
-        RequestTuple(True, True, 1.3, "4", "D"),
+        RequestTuple(True, True, 1.0, 1, "A"),
+        RequestTuple(True, True, 1.1, 2, "B"),
+        RequestTuple(True, True, 1.2, 3, "C"),
+        RequestTuple(True, True, 1.3, 4, "D"),
     ]
     for req in requests:
         qu.append(req)
 
-    message = qu.process_upgrade("C", "mod")
+    message = asyncio.run(qu.process_upgrade("C", "mod"))
     assert qu.len() == 4
     assert "C" in message
     assert "mod" in message
@@ -37,9 +53,9 @@ def test_process_upgrade(mocked_safe_queue):
         else:
             assert req.waiting
             assert not req.non_prio
-            assert req.song == "3"
+            assert req.song_id == 3
 
-    message = qu.process_upgrade("A", "mod")
+    message = asyncio.run(qu.process_upgrade("A", "mod"))
     assert qu.len() == 4
     for req in qu.data:
         if req.requestee not in ["C", "A"]:
@@ -47,17 +63,17 @@ def test_process_upgrade(mocked_safe_queue):
         else:
             assert req.waiting
             assert not req.non_prio
-            assert req.song in ["1", "3"]
+            assert req.song_id in [1, 3]
 
 
 @mock.patch("requestnonsense.requestnonsense.RequestQueue.safe_queue")
 def test_consume_all_next(mocked_safe_queue):
-    qu = RequestQueue(path="./testqueue.bin", hackmd_token="abc")
+    qu = RequestQueue(path="./testqueue.bin", hackmd_token="abc", songs=SONGS)
     requests = [
-        RequestTuple(True, True, 1.0, "1", "A"),
-        RequestTuple(True, True, 1.1, "2", "B"),
-        RequestTuple(True, True, 1.2, "3", "C"),
-        RequestTuple(True, True, 1.3, "4", "D"),
+        RequestTuple(True, True, 1.0, 1, "A"),
+        RequestTuple(True, True, 1.1, 2, "B"),
+        RequestTuple(True, True, 1.2, 3, "C"),
+        RequestTuple(True, True, 1.3, 4, "D"),
     ]
     for req in requests:
         qu.append(req)
@@ -67,10 +83,10 @@ def test_consume_all_next(mocked_safe_queue):
             if request.waiting:
                 next_song = request
                 break
-        message = qu.advance_queue(next_song)
+        message = asyncio.run(qu.advance_queue(next_song))
         if qu.len() != 0:
             assert next_song.requestee in message
-            assert next_song.song in message
+            assert SONGS[next_song.song_id] in message
             assert not qu.get_first().waiting
         else:
             assert "leer" in message
@@ -78,20 +94,303 @@ def test_consume_all_next(mocked_safe_queue):
 
 @mock.patch("requestnonsense.requestnonsense.RequestQueue.safe_queue")
 def test_overwrite_request(mocked_safe_queue):
-    qu = RequestQueue(path="./testqueue.bin", hackmd_token="abc")
-    message_old = qu.process_request("1", "A")
+    qu = RequestQueue(path="./testqueue.bin", hackmd_token="abc", songs=SONGS)
+    message_old = asyncio.run(qu.process_request(1, "A"))
     request_old = qu.get_first()
 
-    message_new = qu.process_request("2", "A")
+    message_new = asyncio.run(qu.process_request(2, "A"))
     request_new = qu.get_first()
 
     assert request_old.timestamp == request_new.timestamp
     assert request_old.non_prio == request_new.non_prio
     assert request_old.requestee == request_new.requestee
-    assert qu.get_first().song == "2"
+    assert qu.get_first().song_id == 2
 
     assert "aktualisiert" in message_new
-    assert "2" in message_new
+    assert SONGS[2] in message_new
 
     assert "eingetragen" in message_old
-    assert "1" in message_old
+    assert SONGS[1] in message_old
+
+
+def test_index_matches_sorted_list():
+    rng = random.Random(4)
+    index = RequestIndex()
+    reference = {}
+    for step in range(2000):
+        user = f"user{rng.randrange(200)}"
+        if rng.random() < 0.3 and user in reference:
+            assert index.discard(reference.pop(user))
+        else:
+            request = RequestTuple(
+                rng.random() < 0.9, rng.random() < 0.8, float(step), step, user
+            )
+            index.add(request)
+            reference[user] = request
+
+        if step % 100 == 0:
+            expected = sorted(reference.values())
+            assert list(index) == expected
+            assert len(index) == len(expected)
+            for position, request in enumerate(expected):
+                assert index[position] == request
+                assert index.rank(request) == position
+            waiting = [request for request in expected if request.waiting]
+            assert index.first_waiting() == (waiting[0] if waiting else None)
+
+
+def test_position_for_user():
+    qu = RequestQueue(path="./testqueue.bin", hackmd_token="abc")
+    for idx, user in enumerate("ABCD"):
+        qu.append(RequestTuple(True, True, float(idx), idx, user))
+    qu.append(RequestTuple(True, False, 9.0, 9, "E"))
+
+    assert qu.get_index_for_user("E") == 1
+    assert qu.get_index_for_user("C") == 4
+    assert qu.get_index_for_user("nobody") is None
+    assert qu.get_first_waiting().requestee == "E"
+
+
+@mock.patch("requestnonsense.requestnonsense.RequestQueue.safe_queue")
+def test_markdown_rows_follow_queue(mocked_safe_queue):
+    songs = {idx: f"song {idx}" for idx in range(5)}
+    songs[9] = "neu"
+    qu = RequestQueue(
+        path="./testqueue.bin", hackmd_token="abc", max_rows=3, songs=songs
+    )
+    assert "leer" in qu.generate_requests_markdown()
+    for idx, user in enumerate("ABCDE"):
+        asyncio.run(qu.process_request(idx, user))
+    asyncio.run(qu.process_upgrade("D", "mod"))
+    asyncio.run(qu.process_request(9, "B"))
+    asyncio.run(qu.advance_queue(qu.get_first_waiting()))
+
+    lines = qu.generate_requests_markdown().split("\n")
+    assert lines[-4:] == [
+        "| 1 | song 3 | D |",
+        "| 2 | song 0 | A |",
+        "| 3 | neu | B |",
+        "| ... | und 2 weitere Requests | |",
+    ]
+
+
+def test_transaction_commits_once_and_rolls_back(tmp_path):
+    async def scenario():
+        qu = RequestQueue(
+            path=str(tmp_path / "queue.bin"),
+            hackmd_token="abc",
+            mirror=False,
+            songs=SONGS,
+        )
+        calls = []
+        qu.listeners.append(calls.append)
+        for idx, user in enumerate("ABCD", start=1):
+            await qu.process_request(idx, user)
+        calls.clear()
+        before = list(qu.data)
+        markdown = qu.generate_requests_markdown()
+
+        async with qu.transaction():
+            await qu.process_upgrade("C", "mod")
+            await qu.process_remove("B", "mod")
+            await qu.advance_queue(qu.get_first_waiting())
+            assert calls == []
+        assert len(calls) == 1 and len(calls[0]) == 5
+        assert [request.requestee for request in qu.data] == ["C", "A", "D"]
+        assert not qu.get_first().waiting
+
+        after = list(qu.data)
+        try:
+            async with qu.transaction():
+                await qu.process_remove("A", "mod")
+                await qu.process_request(4, "E")
+                raise RuntimeError("kaputt")
+        except RuntimeError:
+            pass
+        assert list(qu.data) == after
+        assert len(calls) == 1
+        reloaded = RequestQueue(
+            path=str(tmp_path / "queue.bin"), hackmd_token="abc", mirror=False
+        )
+        assert list(reloaded.data) == after
+        return before, markdown, qu
+
+    before, markdown, qu = asyncio.run(scenario())
+    assert len(before) == 4 and "Queen - Innuendo" in markdown
+    assert "| 1 | ABBA - Waterloo | C |" in qu.generate_requests_markdown()
+    assert "| E |" not in qu.generate_requests_markdown()
+
+
+def test_actor_group_commits(tmp_path):
+    async def scenario():
+        qu = RequestQueue(
+            path=str(tmp_path / "queue.bin"),
+            hackmd_token="abc",
+            mirror=False,
+            songs=SONGS,
+        )
+        commits = []
+        qu.listeners.append(commits.append)
+
+        async def broken():
+            await qu.process_request(3, "X")
+            raise RuntimeError("kaputt")
+
+        results = await asyncio.gather(
+            *(
+                qu.submit(lambda idx=idx, user=user: qu.process_request(idx, user))
+                for idx, user in enumerate("ABCD", start=1)
+            ),
+            qu.submit(broken),
+            qu.submit(lambda: qu.advance_queue(qu.get_first_waiting())),
+            return_exceptions=True,
+        )
+        await qu.stop()
+        return qu, commits, results
+
+    qu, commits, results = asyncio.run(scenario())
+    assert len(commits) == 1
+    assert isinstance(results[4], RuntimeError)
+    assert results[5] == "Nächster Song: Muse - Hysteria requestet von A"
+    assert [request.requestee for request in qu.data] == ["A", "B", "C", "D"]
+    reloaded = RequestQueue(
+        path=str(tmp_path / "queue.bin"), hackmd_token="abc", mirror=False
+    )
+    assert list(reloaded.data) == list(qu.data)
+
+
+def test_cancelled_actor_fails_waiting_commands(tmp_path):
+    async def scenario():
+        qu = RequestQueue(
+            path=str(tmp_path / "queue.bin"),
+            hackmd_token="abc",
+            mirror=False,
+            songs=SONGS,
+        )
+
+        async def stuck():
+            await qu.process_request(1, "A")
+            await asyncio.Event().wait()
+
+        waiting = [asyncio.create_task(qu.submit(stuck))]
+        await asyncio.sleep(0.01)
+        # these arrive while the batch hangs and sit in the mailbox
+        waiting.append(
+            asyncio.create_task(qu.submit(lambda: qu.process_request(2, "B")))
+        )
+        await asyncio.sleep(0.01)
+        qu._actor.cancel()
+        results = await asyncio.wait_for(
+            asyncio.gather(*waiting, return_exceptions=True), 1
+        )
+        return qu, results
+
+    qu, results = asyncio.run(scenario())
+    assert all(isinstance(result, QueueStopped) for result in results)
+    assert len(qu.data) == 0
+
+
+def test_policies_match_brute_force():
+    tree = FenwickTree(5)
+    for slot, value in enumerate([3, 1, 4, 1, 5]):
+        tree.add(slot, value)
+    tree.grow(100)
+    assert [tree.prefix(count) for count in range(6)] == [0, 3, 4, 8, 9, 14]
+
+    now = 1000.0
+    requests = [
+        RequestTuple(idx != 0, idx % 3 == 0, 100.0 * idx, idx, f"user{idx}")
+        for idx in range(8)
+    ]
+    for name, weight in (
+        ("uniform", lambda request: 1.0),
+        ("wait", lambda request: now - request.timestamp),
+    ):
+        policy = POLICIES[name](clock=lambda: now)
+        for request in requests:
+            policy.add(request)
+        policy.discard(requests[5])
+        assert len(policy) == 6
+        rng = random.Random(1)
+        with mock.patch("random.random", rng.random):
+            picks = [policy.pick() for _ in range(6000)]
+        expected = {r: weight(r) for r in requests[1:] if r is not requests[5]}
+        total = sum(expected.values())
+        for request, w in expected.items():
+            assert abs(picks.count(request) / len(picks) - w / total) < 0.03
+        # the active song is never picked again
+        assert requests[0] not in picks
+
+    tiers = POLICIES["tiers"]()
+    for request in requests:
+        tiers.add(request)
+    assert tiers.pick().non_prio is False
+
+    fair = POLICIES["fair"](clock=lambda: now)
+    fair.played(RequestTuple(False, True, 0.0, 1, "user1"))
+    fair.add(requests[1])
+    fair.add(requests[2])
+    rng = random.Random(2)
+    with mock.patch("random.random", rng.random):
+        picks = [fair.pick() for _ in range(1000)]
+    # user2 never had a song, user1 just did
+    assert picks.count(requests[2]) == len(picks)
+
+
+def test_play_history_and_cooldown(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "queue.bin")
+        history = str(tmp_path / "history.sqlite")
+        qu = RequestQueue(
+            path=path,
+            hackmd_token="abc",
+            mirror=False,
+            songs=SONGS,
+            history_path=history,
+            cooldown=600,
+        )
+        await qu.process_request(1, "A")
+        await qu.process_request(2, "B")
+        await qu.process_request(1, "C")
+        message = await qu.advance_queue(qu.get_first_waiting())
+        assert message.endswith("requestet von A")
+        assert qu.history.top(2) == [(1, 2), (2, 1)]
+        assert qu.cooldown_left(1) > 590
+        message = await qu.process_request(1, "D")
+        assert "wieder requestbar in 10 Minuten" in message
+        assert qu.get_request_for_user("D") is None
+
+        # a rolled back transaction leaves no trace in the history
+        try:
+            async with qu.transaction():
+                await qu.process_request(3, "E")
+                raise RuntimeError("kaputt")
+        except RuntimeError:
+            pass
+        qu.history.close()
+        qu.storage.close()
+
+        reloaded = RequestQueue(
+            path=path,
+            hackmd_token="abc",
+            mirror=False,
+            songs=SONGS,
+            history_path=history,
+            cooldown=600,
+        )
+        history_rows = reloaded.history.db.execute(
+            "SELECT kind, song_id, user FROM events ORDER BY rowid"
+        ).fetchall()
+        assert history_rows == [
+            ("request", 1, "A"),
+            ("request", 2, "B"),
+            ("request", 1, "C"),
+            ("play", 1, "A"),
+        ]
+        assert reloaded.history.user_requests == {"A": 1, "B": 1, "C": 1}
+        assert reloaded.history.month_requests[1] == 2
+        assert [song_id for _, song_id, _ in reloaded.history.recent] == [1]
+        assert reloaded.cooldown_left(1) > 590
+        reloaded.history.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,247 @@
+import itertools
+import mock
+import multiprocessing
+import os
+import random
+import time
+
+from requestnonsense.requestnonsense import HackMDClient, SongCatalog, SongIndex, Songs
+
+CSV = """sep=;
+Artist;Title;Arrangements
+Muse;Hysteria;Lead, Bass
+Muse;Hysteria;Lead, Bass
+ABBA;Waterloo;Vocals
+Tool;Schism;Bass
+"""
+
+
+def load(path, cache_path="", ids_path="", catalog_path=""):
+    return Songs(
+        csv_path=str(path),
+        hackmd_client=HackMDClient("abc"),
+        bot_prefix="?",
+        cfsm=True,
+        instruments=["Lead", "Bass"],
+        cache_path=cache_path,
+        ids_path=ids_path,
+        catalog_path=catalog_path,
+    )
+
+
+def test_songs_from_csv(tmp_path):
+    path = tmp_path / "songlist.csv"
+    path.write_text(CSV)
+    songs = load(path)
+
+    assert dict(songs) == {1: "Muse - Hysteria", 2: "Tool - Schism"}
+    assert "| Tool | Schism | ?request 2 |" in songs.note.content
+
+
+def test_songs_cache_skips_parsing(tmp_path):
+    path = tmp_path / "songlist.csv"
+    path.write_text(CSV)
+    cache_path = str(tmp_path / "songlist.cache.json")
+    first = load(path, cache_path)
+
+    with mock.patch.object(Songs, "read_csv") as read_csv:
+        second = load(path, cache_path)
+    read_csv.assert_not_called()
+    assert dict(second) == dict(first)
+    assert second.note.content == first.note.content
+
+    path.write_text(CSV + "Queen;Innuendo;Lead\n")
+    assert len(load(path, cache_path)) == 3
+
+
+def test_songs_from_utf16_export(tmp_path):
+    path = tmp_path / "songlist.csv"
+    path.write_text(
+        CSV.replace(";", ",") + "Motörhead,Ace of Spades,Lead2\n", encoding="utf-16"
+    )
+    songs = load(path)
+
+    assert sorted(songs.values()) == [
+        "Motörhead - Ace of Spades",
+        "Muse - Hysteria",
+        "Tool - Schism",
+    ]
+
+
+def test_search_index():
+    catalog = [
+        (1, "Muse - Hysteria"),
+        (2, "Def Leppard - Hysteria"),
+        (3, "Motörhead - Ace of Spades"),
+        (4, "Tool - Schism"),
+        (5, "The Beatles - Hey Jude"),
+    ]
+    index = SongIndex(catalog)
+
+    assert [song_id for song_id, _ in index.search("muse hysteria")][0] == 1
+    assert {song_id for song_id, _ in index.search("hysteria")} == {1, 2}
+    # accents, prefixes and typos
+    assert index.search("motorhead ace")[0][0] == 3
+    assert index.search("schi")[0][0] == 4
+    assert index.search("beatels jude")[0][0] == 5
+    assert index.search("nirvana") == []
+
+
+def test_sharded_songlist(tmp_path):
+    path = tmp_path / "songlist.csv"
+    path.write_text(CSV + "Tenacious D;Tribute;Lead\n")
+    songs = Songs(
+        csv_path=str(path),
+        hackmd_client=HackMDClient("abc"),
+        bot_prefix="?",
+        instruments=["Lead", "Bass"],
+        shards="letter",
+    )
+    for key, note in songs.shard_notes.items():
+        note.id = f"note-{key}"
+
+    assert sorted(songs.shard_notes) == ["M", "T"]
+    assert "Tribute" in songs.shard_notes["T"].content
+    assert "Tribute" not in songs.shard_notes["M"].content
+    assert songs.url_for("schism") == "https://hackmd.io/note-T"
+    assert songs.url_for("m") == "https://hackmd.io/note-M"
+    assert "[T](https://hackmd.io/note-T) | 2 |" in songs.index_markdown()
+
+
+def test_song_ids_survive_songlist_changes(tmp_path):
+    path = tmp_path / "songlist.csv"
+    path.write_text(CSV)
+    ids_path = str(tmp_path / "ids.json")
+    cache_path = str(tmp_path / "cache.json")
+    assert dict(load(path, cache_path, ids_path)) == {
+        1: "Muse - Hysteria",
+        2: "Tool - Schism",
+    }
+
+    # a song that sorts first comes in, one goes away
+    path.write_text(CSV.replace("Tool;Schism;Bass", "AC/DC;Thunderstruck;Lead"))
+    songs = load(path, cache_path, ids_path)
+    assert dict(songs) == {1: "Muse - Hysteria", 3: "AC/DC - Thunderstruck"}
+    assert "| AC/DC | Thunderstruck | ?request 3 |" in songs.note.content
+
+    # and back, the old id again
+    path.write_text(CSV)
+    assert dict(load(path, cache_path, ids_path)) == {
+        1: "Muse - Hysteria",
+        2: "Tool - Schism",
+    }
+
+
+def test_compiled_catalog(tmp_path):
+    path = tmp_path / "songlist.csv"
+    path.write_text(CSV + "Björk;Jóga;Lead\n")
+    catalog_path = str(tmp_path / "songlist.catalog")
+    first = load(path, catalog_path=catalog_path)
+    assert isinstance(first.names, SongCatalog)
+
+    with mock.patch.object(Songs, "read_csv") as read_csv:
+        songs = load(path, catalog_path=catalog_path)
+    read_csv.assert_not_called()
+    assert dict(songs) == {
+        1: "Björk - Jóga",
+        2: "Muse - Hysteria",
+        3: "Tool - Schism",
+    }
+    assert songs.get(1) == "Björk - Jóga"
+    assert 3 in songs and 4 not in songs and -1 not in songs and "1" not in songs
+    assert songs.get(4) is None
+    assert list(songs.names.entries())[0] == (1, "Björk", "Jóga")
+    assert songs.search("joga", limit=1)[0][0] == 1
+    # the compiled index answers like one built in memory
+    built = SongIndex(songs.items())
+    for query in ("muse", "hyst", "tol schism", "bjork joga", "nirvana"):
+        assert songs.search(query) == built.search(query)
+    assert songs.note.content == first.note.content
+
+    # another csv means another catalog
+    path.write_text(CSV)
+    assert dict(load(path, catalog_path=catalog_path)) == {
+        1: "Muse - Hysteria",
+        2: "Tool - Schism",
+    }
+
+
+def test_compiled_catalog_shards(tmp_path):
+    path = tmp_path / "songlist.csv"
+    path.write_text(CSV + "Tenacious D;Tribute;Lead\n")
+    songs = Songs(
+        csv_path=str(path),
+        hackmd_client=HackMDClient("abc"),
+        bot_prefix="?",
+        instruments=["Lead", "Bass"],
+        shards="letter",
+        catalog_path=str(tmp_path / "songlist.catalog"),
+    )
+    for key, note in songs.shard_notes.items():
+        note.id = f"note-{key}"
+
+    assert dict(songs.shard_of) == {1: "M", 2: "T", 3: "T"}
+    assert songs.url_for("tribute") == "https://hackmd.io/note-T"
+    assert "[T](https://hackmd.io/note-T) | 2 |" in songs.index_markdown()
+
+
+def test_concurrent_catalog_compiles(tmp_path):
+    catalog_path = str(tmp_path / "songlist.catalog")
+    songs = [(idx, f"Artist {idx % 300}", f"Title {idx}") for idx in range(1, 5001)]
+    pages = {"": "x" * 1000000}
+    context = multiprocessing.get_context("fork")
+    errors = context.Queue()
+
+    def compile_and_open():
+        # several bots reloading the same songlist at the same moment
+        try:
+            for _ in range(3):
+                SongCatalog.compile(catalog_path, ["key"], songs, pages)
+                assert len(SongCatalog.open(catalog_path, ["key"])) == len(songs)
+        except Exception as error:
+            errors.put(repr(error))
+            raise
+
+    workers = [context.Process(target=compile_and_open) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert errors.empty()
+    assert [worker.exitcode for worker in workers] == [0, 0, 0]
+    assert os.listdir(tmp_path) == ["songlist.catalog"]
+
+
+def test_search_latency_with_common_words(tmp_path):
+    # 100k songs with zipf distributed words, "the" is in a third of them
+    rng = random.Random(1)
+    words = "the of love you me my in a to night i heart".split()
+    words += [f"w{idx}x" for idx in range(30000)]
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+
+    def phrase(most):
+        return " ".join(rng.choices(words, cum_weights=weights, k=rng.randint(1, most)))
+
+    songs = [(idx, phrase(2), phrase(4)) for idx in range(1, 100001)]
+    catalog_path = str(tmp_path / "songlist.catalog")
+    SongCatalog.compile(catalog_path, ["key"], songs, {"": ""})
+    indexes = {
+        "memory": SongIndex(
+            (song_id, f"{artist} - {title}") for song_id, artist, title in songs
+        ),
+        "catalog": SongCatalog.open(catalog_path, ["key"]).index(),
+    }
+
+    for query in ("the love", "love you", "heart of the night", "the", "lov", "w123y"):
+        results = []
+        for name, index in indexes.items():
+            took = []
+            for _ in range(3):
+                start = time.perf_counter()
+                found = index.search(query, limit=3)
+                took.append(time.perf_counter() - start)
+            assert found, query
+            assert min(took) < 0.015, f"{name} {query!r}: {min(took) * 1000:.1f} ms"
+            results.append(found)
+        # the compiled index answers like one built in memory
+        assert results[0] == results[1], query
@@ -0,0 +1,196 @@
+import pickle
+import sqlite3
+
+from requestnonsense.requestnonsense import (
+    BinaryStorage,
+    JournalStorage,
+    RequestIndex,
+    RequestQueue,
+    RequestTuple,
+    SqliteStorage,
+)
+
+SONGS = {1: "Muse - Hysteria", 2: "Tool - Schism"}
+
+
+def song_id(name: str) -> int:
+    return {song: song_id for song_id, song in SONGS.items()}[name]
+
+
+def commit_add(storage: JournalStorage, data: RequestIndex, request: RequestTuple):
+    data.add(request)
+    storage.commit([("add", request)], data)
+
+
+def test_journal_replays_log(tmp_path):
+    path = str(tmp_path / "queue.bin")
+    storage = JournalStorage(path)
+    data = RequestIndex(storage.load(song_id))
+    first = RequestTuple(True, True, 1.0, 1, "A")
+    commit_add(storage, data, first)
+    commit_add(storage, data, RequestTuple(True, True, 2.0, 2, "B"))
+    data.discard(first)
+    active = RequestTuple(False, True, 1.0, 1, "A")
+    data.add(active)
+    storage.commit([("remove", first), ("add", active)], data)
+    storage.close()
+
+    assert JournalStorage(path).load(song_id) == list(data)
+
+
+def test_journal_compacts_and_ignores_torn_write(tmp_path):
+    path = str(tmp_path / "queue.bin")
+    storage = JournalStorage(path, compact_bytes=512)
+    data = RequestIndex(storage.load(song_id))
+    for idx in range(50):
+        commit_add(storage, data, RequestTuple(True, True, float(idx), idx, f"u{idx}"))
+    storage.close()
+
+    # compaction kept the log small
+    assert (tmp_path / "queue.bin.log").stat().st_size <= 1024
+    with open(tmp_path / "queue.bin.log", mode="ab") as fh:
+        fh.write(b'{"seq": 999, "ops": [["add", [tru')
+
+    assert JournalStorage(path).load(song_id) == list(data)
+
+
+def test_sqlite_queries_and_reload(tmp_path):
+    path = str(tmp_path / "queue.bin")
+    storage = SqliteStorage(path)
+    requests = [
+        RequestTuple(True, True, 1.0, 1, "A"),
+        RequestTuple(True, True, 2.0, 2, "B"),
+        RequestTuple(True, False, 3.0, 3, "C"),
+    ]
+    storage.commit([("add", request) for request in requests], None)
+    active = RequestTuple(False, True, 1.0, 1, "A")
+    storage.commit([("remove", requests[0]), ("add", active)], None)
+
+    reader = SqliteStorage(path, readonly=True)
+    assert reader.position("A") == 1
+    assert reader.position("C") == 2
+    assert reader.position("nobody") is None
+    assert reader.next_waiting() == requests[2]
+    assert reader.lookup("B") == requests[1]
+    reader.close()
+    storage.close()
+
+    assert SqliteStorage(path).load(song_id) == [active, requests[2], requests[1]]
+
+
+class LegacyRequest(tuple):
+    """stands in for the old RequestTuple with song names when writing an old queue file"""
+
+    def __reduce__(self):
+        return (RequestTuple, tuple(self))
+
+
+def test_binary_format_migrates_pickle(tmp_path):
+    path = tmp_path / "queue.bin"
+    legacy = [
+        LegacyRequest((False, True, 1.0, "Muse - Hysteria", "A")),
+        LegacyRequest((True, True, 2.0, "Weggefallen - Song", "B")),
+    ]
+    path.write_bytes(pickle.dumps(legacy))
+
+    queue = RequestQueue(path=str(path), hackmd_token="abc", songs=SONGS)
+    assert list(queue.data) == [
+        RequestTuple(False, True, 1.0, 1, "A"),
+        RequestTuple(True, True, 2.0, -1, "B"),
+    ]
+    assert queue.song_name(-1) == "Weggefallen - Song"
+    assert path.read_bytes().startswith(BinaryStorage.MAGIC)
+    assert (tmp_path / "queue.bin.pickle").exists()
+
+    reloaded = RequestQueue(path=str(path), hackmd_token="abc", songs=SONGS)
+    assert list(reloaded.data) == list(queue.data)
+    assert reloaded.song_name(-1) == "Weggefallen - Song"
+    assert reloaded.storage.synthetic_id == -1
+
+
+def test_binary_format_refuses_foreign_pickles(tmp_path):
+    path = tmp_path / "queue.bin"
+    path.write_bytes(pickle.dumps([sqlite3.connect]))
+    try:
+        BinaryStorage(str(path)).load(song_id)
+    except pickle.UnpicklingError:
+        pass
+    else:
+        raise AssertionError("loaded a pickle that is not a queue")
+
+
+def test_sqlite_migrates_song_names(tmp_path):
+    path = str(tmp_path / "queue.bin")
+    db = sqlite3.connect(f"{path}.sqlite")
+    db.execute(
+        "CREATE TABLE requests (requestee TEXT PRIMARY KEY, waiting INTEGER NOT NULL, "
+        "non_prio INTEGER NOT NULL, timestamp REAL NOT NULL, song TEXT NOT NULL)"
+    )
+    db.execute("INSERT INTO requests VALUES ('A', 1, 1, 1.0, 'Tool - Schism')")
+    db.commit()
+    db.close()
+
+    storage = SqliteStorage(path)
+    assert storage.load(song_id) == [RequestTuple(True, True, 1.0, 2, "A")]
+    (version,) = storage.db.execute("PRAGMA user_version").fetchone()
+    assert version == SqliteStorage.VERSION
+    storage.close()
+
+
+def test_sqlite_imports_legacy_file_once(tmp_path):
+    path = str(tmp_path / "queue.bin")
+    request = RequestTuple(True, True, 1.0, 1, "A")
+    BinaryStorage(path).commit([], [request])
+
+    storage = SqliteStorage(path)
+    assert storage.load(song_id) == [request]
+    assert (tmp_path / "queue.bin.imported").exists()
+    storage.commit([("remove", request)], None)
+    storage.close()
+
+    # an emptied queue stays empty
+    assert SqliteStorage(path).load(song_id) == []
+
+
+def test_titles_and_synthetic_ids_survive_restart(tmp_path):
+    for storage in ("binary", "journal", "sqlite"):
+        path = str(tmp_path / f"{storage}.bin")
+        queue = RequestQueue(path, "abc", storage=storage, songs=SONGS, mirror=False)
+        queue.append(RequestTuple(True, True, 1.0, 2, "A"))
+        queue.commit(queue._pending)
+        queue._pending = []
+        # Tool - Schism left the songlist
+        queue.set_songs({1: SONGS[1], 3: "Yes - Roundabout"})
+        queue.storage.close()
+
+        reloaded = RequestQueue(
+            path, "abc", storage=storage, songs={1: SONGS[1]}, mirror=False
+        )
+        assert reloaded.song_name(2) == "Tool - Schism"
+        # synthetic ids don't count down from the kept title, that would hit song 1
+        assert reloaded.song_id_for("Weggefallen - Song") == -1
+        reloaded.storage.close()
+
+
+def test_journal_keeps_log_of_failed_compaction(tmp_path):
+    path = str(tmp_path / "queue.bin")
+    storage = JournalStorage(path, compact_bytes=512)
+    data = RequestIndex(storage.load(song_id))
+    write_snapshot = storage.write_snapshot
+
+    def broken(*args):
+        raise OSError("disk full")
+
+    storage.write_snapshot = broken
+    for idx in range(15):
+        commit_add(storage, data, RequestTuple(True, True, float(idx), idx, f"u{idx}"))
+    assert (tmp_path / "queue.bin.log.old").exists()
+
+    # the next compaction has to keep the records of the failed one
+    storage.write_snapshot = write_snapshot
+    for idx in range(15, 30):
+        commit_add(storage, data, RequestTuple(True, True, float(idx), idx, f"u{idx}"))
+    storage.close()
+
+    assert not (tmp_path / "queue.bin.log.old").exists()
+    assert JournalStorage(path).load(song_id) == list(data)